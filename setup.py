@@ -37,6 +37,7 @@ def main() -> None:
             'lxml'         , # TODO for xml module, make optional later
             'orjson'       , # faster json processing, could be optional
             'kompress'     , # for compressed files processing (could be optional if they don't use compressed files?)
+            'tomli; python_version < "3.11"', # for batch runner configs
 
             # vvv example of git repo dependency
             # 'repo @ git+https://github.com/karlicoss/repo.git',
@@ -49,8 +50,10 @@ def main() -> None:
                 'pytest',
                 'ruff',
                 'mypy', 'lxml',  # lxml for mypy coverage report
+                'pyarrow',  # otherwise columnar tests are skipped
             ],
             'zstd'   : ['kompress[zstd]'],
+            'columnar': ['pyarrow'],  # for COLUMNAR normalised files, see core/columnar.py
             'HPI': [  # for bleanser.modules.hpi
                 'HPI', # pypi version
                 # 'HPI @ git+https://github.com/karlicoss/hpi.git',   # uncomment to test against github version (useful for one-off CI run)
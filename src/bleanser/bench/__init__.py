@@ -0,0 +1,10 @@
+"""
+Reproducible benchmarks for bleanser core, on synthetic backup histories (so no private data is needed)
+
+    python3 -m bleanser.bench run --output baseline.json
+    # ... change some code
+    python3 -m bleanser.bench run --output current.json
+    python3 -m bleanser.bench compare baseline.json current.json
+
+See python3 -m bleanser.bench run --help for knobs (history size, churn, rollover, etc.)
+"""
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+
+from . import importtime
+from .generate import KINDS, History
+from .run import MODES, compare, load, run_all, save
+
+
+def _csv(s: str) -> list[str]:
+    return [x.strip() for x in s.split(',') if x.strip() != '']
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command(name='run', short_help='run benchmarks on synthetic data')
+@click.option('--output'        , type=Path , required=True          , help='JSON file to write results to')
+@click.option('--kinds'         , type=str  , default=','.join(KINDS), help='comma separated, out of ' + ','.join(KINDS))
+@click.option('--modes'         , type=str  , default='twoway,multiway', help='comma separated, out of ' + ','.join(MODES))
+@click.option('--threads'       , type=str  , default='serial,1,2,4' , help="comma separated thread counts, 'serial' means no process pool")
+@click.option('--repeat'        , type=int  , default=3              , help='how many times to run each case (best time is used for comparison)')
+@click.option('--files'         , type=int  , default=20             , help='number of backups in each history')
+@click.option('--items'         , type=int  , default=5000           , help='number of items in the first backup')
+@click.option('--churn'         , type=float, default=0.01           , help='new items in each backup, as a fraction of --items')
+@click.option('--rollover'      , type=int  , default=None           , help='only keep this many latest items in each backup (by default, backups are full)')
+@click.option('--duplicate-rate', type=float, default=0.2            , help='probability of a backup being the same as the previous one')
+@click.option('--seed'          , type=int  , default=0)
+@click.option('--workdir'       , type=Path , default=None           , help='where to generate the data (temporary directory by default)')
+@click.option('--import-modules', type=str  , default=','.join(importtime.MODULES), help='comma separated modules to measure import time for')
+def run(*, output: Path, kinds: str, modes: str, threads: str, repeat: int, files: int, items: int, churn: float, rollover: int | None, duplicate_rate: float, seed: int, workdir: Path | None, import_modules: str) -> None:
+    histories = [
+        History(kind=kind, files=files, items=items, churn=churn, rollover=rollover, duplicate_rate=duplicate_rate, seed=seed)
+        for kind in _csv(kinds)
+    ]
+    mlist = _csv(modes)
+    for m in mlist:
+        assert m in MODES, m
+    tlist = [None if t == 'serial' else int(t) for t in _csv(threads)]
+
+    with TemporaryDirectory(prefix='bleanser-bench') as td:
+        wdir = Path(td) if workdir is None else workdir
+        res = run_all(
+            workdir=wdir.absolute(),
+            histories=histories,
+            modes=mlist,
+            threads=tlist,
+            repeat=repeat,
+            import_modules=_csv(import_modules),
+        )
+    save(res, output)
+
+
+@main.command(name='import-time', short_help='check import time of core modules')
+@click.option('--modules'  , type=str  , default=','.join(importtime.MODULES), help='comma separated modules to check')
+@click.option('--repeat'   , type=int  , default=10)
+@click.option('--budget-ms', type=float, default=None, help='fail if importing any of the modules takes longer than this')
+def import_time(*, modules: str, repeat: int, budget_ms: float | None) -> None:
+    failed = False
+    for m in _csv(modules):
+        best = min(importtime.measure(m, repeat=repeat)) * 1000
+        heavy = importtime.heavy_imports(m)
+        over = budget_ms is not None and best > budget_ms
+        print(f'{m:<40} {best:>7.1f}ms' + (' OVER BUDGET' if over else '') + (f' heavy imports: {heavy}' if heavy else ''), file=sys.stderr)
+        failed |= over or len(heavy) > 0
+    sys.exit(1 if failed else 0)
+
+
+@main.command(name='compare', short_help='compare benchmark results against a baseline')
+@click.argument('baseline', type=Path)
+@click.argument('current' , type=Path)
+@click.option('--threshold', type=float, default=0.1, help='relative slowdown to consider a regression')
+def compare_cmd(*, baseline: Path, current: Path, threshold: float) -> None:
+    problems = compare(load(baseline), load(current), threshold=threshold)
+    for p in problems:
+        print(p, file=sys.stderr)
+    sys.exit(1 if len(problems) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Generators for synthetic backup histories, i.e. a sequence of backups of the same (evolving) data
+"""
+
+from __future__ import annotations
+
+import random
+import sqlite3
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator
+
+import orjson
+
+KINDS = ('json', 'xml', 'sqlite')
+
+Item = Dict[str, Any]
+
+
+@dataclass
+class History:
+    kind: str
+    """
+    json/xml/sqlite
+    """
+
+    files: int = 20
+    """
+    number of backups in the history
+    """
+
+    items: int = 1000
+    """
+    number of items in the first backup
+    """
+
+    churn: float = 0.05
+    """
+    new items in each backup, as a fraction of 'items'
+    """
+
+    rollover: int | None = None
+    """
+    if set, only the latest 'rollover' items are kept in each backup (like a feed that only exposes recent items)
+    otherwise backups are 'full', i.e. each one contains everything from the previous one
+    """
+
+    duplicate_rate: float = 0.2
+    """
+    probability of a backup being exactly the same as the previous one (e.g. nothing happened since the last export)
+    """
+
+    seed: int = 0
+
+    def __post_init__(self) -> None:
+        assert self.kind in KINDS, self.kind
+        assert 0 <= self.duplicate_rate <= 1, self.duplicate_rate
+
+    def snapshots(self) -> Iterator[list[Item]]:
+        rng = random.Random(self.seed)
+        next_id = 0
+
+        def new_item() -> Item:
+            nonlocal next_id
+            next_id += 1
+            return {
+                'id'     : next_id,
+                'created': 1_600_000_000 + next_id * 60,
+                'text'   : ' '.join(_word(rng) for _ in range(rng.randint(3, 12))),
+                'score'  : rng.randint(0, 1000),
+            }
+
+        items = [new_item() for _ in range(self.items)]
+        for i in range(self.files):
+            if i > 0 and rng.random() >= self.duplicate_rate:
+                new = max(1, round(self.items * self.churn))
+                items.extend(new_item() for _ in range(new))
+                if self.rollover is not None:
+                    items = items[-self.rollover:]
+            yield list(items)
+
+
+def _word(rng: random.Random) -> str:
+    return ''.join(rng.choice('bcdfghklmnprstvz') + rng.choice('aeiou') for _ in range(rng.randint(1, 4)))
+
+
+def _write_json(items: list[Item], path: Path) -> None:
+    path.write_bytes(orjson.dumps({'items': items}))
+
+
+def _write_xml(items: list[Item], path: Path) -> None:
+    root = ET.Element('items')
+    for it in items:
+        e = ET.SubElement(root, 'item', id=str(it['id']), created=str(it['created']), score=str(it['score']))
+        e.text = it['text']
+    path.write_bytes(ET.tostring(root))
+
+
+def _write_sqlite(items: list[Item], path: Path) -> None:
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, created INTEGER, text TEXT, score INTEGER)')
+        conn.executemany(
+            'INSERT INTO items VALUES (?, ?, ?, ?)',
+            [(it['id'], it['created'], it['text'], it['score']) for it in items],
+        )
+    conn.close()
+
+
+_WRITERS = {
+    'json'  : (_write_json  , 'json'),
+    'xml'   : (_write_xml   , 'xml'),
+    'sqlite': (_write_sqlite, 'sqlite'),
+}
+
+
+def generate(history: History, odir: Path) -> list[Path]:
+    '''
+    Writes backups into odir, returns their paths (in chronological order, which is also name order)
+    Deterministic for the same history parameters
+    '''
+    write, ext = _WRITERS[history.kind]
+    odir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i, items in enumerate(history.snapshots()):
+        path = odir / f'backup_{i:05d}.{ext}'
+        write(items, path)
+        paths.append(path)
+    return paths
+
+
+def test_snapshots() -> None:
+    h = History(kind='json', files=10, items=10, churn=0.2, duplicate_rate=0.3, seed=1)
+    snapshots = list(h.snapshots())
+    assert snapshots == list(h.snapshots())  # deterministic
+    assert len(snapshots) == 10
+
+    ids = [[it['id'] for it in s] for s in snapshots]
+    assert ids[0] == list(range(1, 11))
+    dups = 0
+    for prev, cur in zip(ids, ids[1:]):
+        if prev == cur:
+            dups += 1
+        else:
+            assert cur[:len(prev)] == prev  # full backups, so only growing
+            assert len(cur) == len(prev) + 2
+    assert 0 < dups < 9
+
+    h = History(kind='json', files=10, items=10, churn=0.5, rollover=12, duplicate_rate=0.0)
+    for s in list(h.snapshots())[1:]:
+        assert len(s) == 12
+
+
+def test_generate(tmp_path: Path) -> None:
+    for kind in KINDS:
+        h = History(kind=kind, files=3, items=5)
+        paths = generate(h, tmp_path / kind)
+        assert paths == sorted(paths)
+        assert len(paths) == 3
+    with sqlite3.connect(tmp_path / 'sqlite' / 'backup_00000.sqlite') as conn:
+        [(cnt,)] = conn.execute('SELECT COUNT(*) FROM items')
+    conn.close()
+    assert cnt == 5
@@ -0,0 +1,58 @@
+"""
+Import time of bleanser modules, i.e. startup overhead of each python3 -m bleanser.modules.X invocation
+"""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+from typing import Sequence
+
+MODULES = (
+    'bleanser.core.processor',
+    'bleanser.core.modules.json',
+    'bleanser.core.modules.xml',
+    'bleanser.core.modules.sqlite',
+)
+
+# these should only be imported on first use, not when the module is imported
+HEAVY = (
+    'click',
+    'kompress',
+    'lxml',
+    'magic',
+    'more_itertools',
+    'orjson',
+    'plumbum',
+)
+
+
+def measure(module: str, *, repeat: int) -> list[float]:
+    '''
+    Time to import the module (in seconds) in a fresh interpreter, so nothing is cached in sys.modules
+    '''
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    return [float(subprocess.check_output([sys.executable, '-c', code], text=True)) for _ in range(repeat)]
+
+
+def heavy_imports(module: str) -> list[str]:
+    '''
+    Returns heavy dependencies that get imported along with the module
+    '''
+    code = f'import sys; import {module}; print(*sorted(sys.modules), sep="\\n")'
+    loaded = set(subprocess.check_output([sys.executable, '-c', code], text=True).splitlines())
+    return [m for m in HEAVY if m in loaded]
+
+
+def run_all(modules: Sequence[str], *, repeat: int) -> dict[str, list[float]]:
+    return {m: measure(m, repeat=repeat) for m in modules}
+
+
+def test_no_heavy_imports() -> None:
+    for m in MODULES:
+        assert heavy_imports(m) == [], m
+
+
+def test_measure() -> None:
+    [t] = measure('bleanser.core.processor', repeat=1)
+    assert 0 < t < 10
@@ -0,0 +1,245 @@
+"""
+Timing compute_groups on synthetic histories, and comparing results against a baseline
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Sequence
+from unittest.mock import patch
+
+from ..core.common import Prune, logger
+from ..core.modules.json import JsonNormaliser as _JsonNormaliser
+from ..core.modules.sqlite import SqliteNormaliser as _SqliteNormaliser
+from ..core.modules.xml import Normaliser as _XmlNormaliser
+from ..core.processor import BaseNormaliser, compute_groups, groups_to_instructions
+from . import importtime
+from .generate import History, generate
+
+
+# NOTE: these need to be defined on the module level so they can be pickled by the process pool
+# subclassing so overriding MULTIWAY etc doesn't affect the 'real' normalisers
+class JsonNormaliser(_JsonNormaliser):
+    pass
+
+
+class XmlNormaliser(_XmlNormaliser):
+    pass
+
+
+class SqliteNormaliser(_SqliteNormaliser):
+    pass
+
+
+NORMALISERS: dict[str, type[BaseNormaliser]] = {
+    'json'  : JsonNormaliser,
+    'xml'   : XmlNormaliser,
+    'sqlite': SqliteNormaliser,
+}
+
+# mode -> (MULTIWAY, PRUNE_DOMINATED)
+MODES = {
+    'twoway'   : (False, False),
+    'dominated': (False, True),
+    'multiway' : (True , True),
+}
+
+
+@dataclass
+class Result:
+    name: str
+    kind: str
+    mode: str
+    threads: int | None
+    files: int
+    total_bytes: int
+    pruned: int
+    """
+    number of pruned files -- if this changes between runs, it's not just a performance change!
+    """
+    times: list[float]
+
+    @property
+    def best(self) -> float:
+        return min(self.times)
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.times)
+
+
+def run_case(paths: Sequence[Path], *, kind: str, mode: str, threads: int | None, repeat: int) -> Result:
+    Normaliser = NORMALISERS[kind]
+    multiway, prune_dominated = MODES[mode]
+    name = f'{kind}/{mode}/threads={threads}'
+    times = []
+    pruned = -1
+    with patch.object(Normaliser, 'MULTIWAY', multiway), patch.object(Normaliser, 'PRUNE_DOMINATED', prune_dominated):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            groups = list(compute_groups(paths, Normaliser=Normaliser, threads=threads))
+            times.append(time.perf_counter() - start)
+            npruned = sum(1 for i in groups_to_instructions(groups) if isinstance(i, Prune))
+            assert pruned in {-1, npruned}, (name, pruned, npruned)  # should be deterministic
+            pruned = npruned
+    res = Result(
+        name=name,
+        kind=kind,
+        mode=mode,
+        threads=threads,
+        files=len(paths),
+        total_bytes=sum(p.stat().st_size for p in paths),
+        pruned=pruned,
+        times=times,
+    )
+    logger.info('%-40s: best %.3fs, median %.3fs (pruned %d/%d)', name, res.best, res.median, res.pruned, res.files)
+    return res
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).parent,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        # e.g. installed as a package
+        return None
+
+
+def run_all(
+    *,
+    workdir: Path,
+    histories: Sequence[History],
+    modes: Sequence[str],
+    threads: Sequence[int | None],
+    repeat: int,
+    import_modules: Sequence[str] = (),
+) -> dict[str, Any]:
+    results = []
+    for h in histories:
+        paths = generate(h, workdir / h.kind)
+        for mode in modes:
+            for t in threads:
+                results.append(run_case(paths, kind=h.kind, mode=mode, threads=t, repeat=repeat))
+    return {
+        'meta': {
+            'commit'   : _git_commit(),
+            'python'   : sys.version,
+            'platform' : platform.platform(),
+            'cpus'     : os.cpu_count(),
+            'histories': [asdict(h) for h in histories],
+            'repeat'   : repeat,
+        },
+        'results': [asdict(r) for r in results],
+        # import times are just a few ms, so more noisy -- hence more repeats
+        'imports': importtime.run_all(import_modules, repeat=max(repeat, 5)),
+    }
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any], *, threshold: float) -> list[str]:
+    '''
+    threshold: relative slowdown (of the best time) to consider a regression, e.g. 0.1 for 10%
+
+    Prints the comparison table and returns the list of problems (regressions, or different pruning results)
+    '''
+    if baseline['meta']['histories'] != current['meta']['histories']:
+        logger.warning("histories are different between baseline and current run, comparison doesn't make much sense")
+
+    bres = {r['name']: r for r in baseline['results']}
+    problems = []
+    print(f'{"case":<30} {"baseline":>9} {"current":>9} {"change":>8}', file=sys.stderr)
+    for c in current['results']:
+        name = c['name']
+        b = bres.get(name)
+        if b is None:
+            print(f'{name:<30} {"-":>9} {min(c["times"]):>8.3f}s', file=sys.stderr)
+            continue
+        bbest = min(b['times'])
+        cbest = min(c['times'])
+        change = (cbest - bbest) / bbest
+        mark = ''
+        if change > threshold:
+            mark = ' REGRESSION'
+            problems.append(f'{name}: {bbest:.3f}s -> {cbest:.3f}s ({change:+.1%})')
+        if b['pruned'] != c['pruned']:
+            mark += ' PRUNED MISMATCH'
+            problems.append(f"{name}: pruned {b['pruned']} files in baseline vs {c['pruned']} now")
+        print(f'{name:<30} {bbest:>8.3f}s {cbest:>8.3f}s {change:>+8.1%}{mark}', file=sys.stderr)
+
+    bimports = baseline.get('imports', {})
+    for module, ctimes in current.get('imports', {}).items():
+        name = f'import {module}'
+        btimes = bimports.get(module)
+        if btimes is None:
+            continue
+        bbest = min(btimes)
+        cbest = min(ctimes)
+        change = (cbest - bbest) / bbest
+        mark = ''
+        if change > threshold:
+            mark = ' REGRESSION'
+            problems.append(f'{name}: {bbest * 1000:.1f}ms -> {cbest * 1000:.1f}ms ({change:+.1%})')
+        print(f'{name:<30} {bbest * 1000:>7.1f}ms {cbest * 1000:>7.1f}ms {change:>+8.1%}{mark}', file=sys.stderr)
+    return problems
+
+
+def save(res: dict[str, Any], path: Path) -> None:
+    path.write_text(json.dumps(res, indent=1))
+
+
+def load(path: Path) -> dict[str, Any]:
+    return json.loads(path.read_text())
+
+
+def test_run_all(tmp_path: Path) -> None:
+    histories = [
+        History(kind='json', files=6, items=20, duplicate_rate=0.5),
+        History(kind='sqlite', files=4, items=20, rollover=20),
+    ]
+    res = run_all(
+        workdir=tmp_path,
+        histories=histories,
+        modes=['twoway', 'multiway'],
+        threads=[None, 2],
+        repeat=1,
+        import_modules=['bleanser.core.processor'],
+    )
+    results = res['results']
+    assert [r['name'] for r in results] == [
+        'json/twoway/threads=None',
+        'json/twoway/threads=2',
+        'json/multiway/threads=None',
+        'json/multiway/threads=2',
+        'sqlite/twoway/threads=None',
+        'sqlite/twoway/threads=2',
+        'sqlite/multiway/threads=None',
+        'sqlite/multiway/threads=2',
+    ]
+    [json_twoway_serial] = [r for r in results if r['name'] == 'json/twoway/threads=None']
+    assert json_twoway_serial['pruned'] > 0  # should have some duplicates
+    # 'real' normalisers shouldn't be affected
+    assert _JsonNormaliser.MULTIWAY is False
+
+    bpath = tmp_path / 'baseline.json'
+    save(res, bpath)
+    baseline = load(bpath)
+    assert compare(baseline, baseline, threshold=0.1) == []
+
+    slower = json.loads(json.dumps(baseline))
+    r = slower['results'][0]
+    r['times'] = [t * 2 for t in r['times']]
+    r['pruned'] += 1
+    slower['imports']['bleanser.core.processor'] = [t * 2 for t in baseline['imports']['bleanser.core.processor']]
+    problems = compare(baseline, slower, threshold=0.1)
+    assert len(problems) == 3
@@ -1,12 +1,46 @@
-# TODO hmm so we kind of need a specific Normaliser for bleanser, so calling
-# python3 -m bleanser.core (or just -m bleanser) doesn't make much sense
-# it could probs take in module name, and then call it? like python3 -m bleanser modules.xxx
-# but it's the same as calling python -m bleanser.modules.xxx
-# TODO maybe this thing could do module discovery or something?
+# NOTE: to run a specific normaliser, use python3 -m bleanser.modules.xxx
+# this entrypoint is for things spanning multiple modules
+from __future__ import annotations
+
+from pathlib import Path
+
+import click
+
+
+@click.group(context_settings={'max_content_width': 120, 'show_default': True})
 def main() -> None:
     pass
 
 
+@main.command(name='run', short_help='prune multiple sources specified in the config, sharing a single process pool')
+@click.option('--config', type=Path, required=True, help='TOML config with the sources, see bleanser.core.batch for the format')
+@click.option('--threads', type=int, default=None, help='Number of processes to use (overrides config). By default uses all available')
+@click.option('--yes', is_flag=True, default=False, help="Do not prompt before pruning files (useful for cron etc)")
+def run(*, config: Path, threads: int | None, yes: bool) -> None:
+    import sys
+
+    from .batch import _load_toml, load_sources, print_reports, run_sources
+
+    cfg = _load_toml(config)
+    if threads is None:
+        threads = cfg.get('threads')
+    max_inflight_mb = cfg.get('max_inflight_mb')
+    max_inflight_bytes = None if max_inflight_mb is None else max_inflight_mb * 2 ** 20
+
+    sources = load_sources(cfg)
+    reports = run_sources(sources, threads=threads, max_inflight_bytes=max_inflight_bytes, need_confirm=not yes)
+    print_reports(reports)
+    sys.exit(max((r.exit_code for r in reports), default=0))
+
+
+def test_run_empty_config(tmp_path: Path) -> None:
+    from click.testing import CliRunner
+
+    config = tmp_path / 'config.toml'
+    config.write_text('threads = 2\n')
+    res = CliRunner().invoke(main, ['run', '--config', str(config), '--yes'])
+    assert res.exit_code == 0, res.output
+
+
 if __name__ == '__main__':
-    # FIXME warn if we're running this command? kinda confusing otherwise
     main()
@@ -0,0 +1,310 @@
+"""
+Running many sources (i.e. different normaliser modules/inputs) in one go, sharing a single process pool
+
+Config is a TOML file like this:
+
+    threads = 8            # optional, by default uses all cpus
+    max_inflight_mb = 4096 # optional, limits total size of inputs processed at the same time
+
+    [[source]]
+    module = "bleanser.modules.reddit"
+    path = "/backups/reddit"
+    mode = "move"             # dry (default)/move/remove
+    move_to = "/backups/pruned"
+
+    [[source]]
+    module = "bleanser.core.modules.json"
+    normaliser = "JsonNormaliser"  # optional, 'Normaliser' by default
+    path = "/backups/rescuetime/*.json"
+    glob = true
+    multiway = true
+    prune_dominated = true
+    compress_tmp = true    # optional, keeps temporary files zstd-compressed
+"""
+
+from __future__ import annotations
+
+import importlib
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+
+from . import instrument
+from .common import (
+    Dry,
+    Group,
+    Mode,
+    Move,
+    PackedGroup,
+    PathTable,
+    Prune,
+    Remove,
+    divide_by_size,
+    logger,
+)
+from .processor import (
+    BaseNormaliser,
+    _apply_instructions,
+    _compute_groups_serial_as_list,
+    _stitched,
+    bleanser_tmp_directory,
+    groups_to_instructions,
+)
+
+
+@dataclass
+class Source:
+    name: str
+    Normaliser: type[BaseNormaliser]
+    paths: Sequence[Path]
+    mode: Mode
+    overrides: dict[str, Any]
+    """
+    Normaliser class attributes to override, e.g. MULTIWAY
+    """
+
+
+def _load_toml(config: Path) -> dict[str, Any]:
+    if sys.version_info[:2] >= (3, 11):
+        import tomllib
+    else:
+        import tomli as tomllib
+    with config.open('rb') as fo:
+        return tomllib.load(fo)
+
+
+def load_sources(cfg: dict[str, Any]) -> list[Source]:
+    from .main import _get_paths
+
+    res = []
+    for s in cfg.get('source', []):
+        module = s['module']
+        nname = s.get('normaliser', 'Normaliser')
+        Normaliser = getattr(importlib.import_module(module), nname)
+        assert issubclass(Normaliser, BaseNormaliser), Normaliser
+
+        mode: Mode
+        mode_name = s.get('mode', 'dry')
+        if mode_name == 'dry':
+            mode = Dry()
+        elif mode_name == 'move':
+            mode = Move(path=Path(s['move_to']))
+        elif mode_name == 'remove':
+            mode = Remove()
+        else:
+            raise RuntimeError(f'unknown mode: {mode_name}')
+
+        overrides = {}
+        if 'multiway' in s:
+            overrides['MULTIWAY'] = s['multiway']
+        if 'prune_dominated' in s:
+            overrides['PRUNE_DOMINATED'] = s['prune_dominated']
+        if 'compress_tmp' in s:
+            overrides['COMPRESS_TMP'] = s['compress_tmp']
+
+        path = s['path']
+        paths = _get_paths(path=path, glob=s.get('glob', False), from_=None, to=None, sort_by=s.get('sort_by', 'name'))
+        res.append(Source(
+            name=s.get('name', f'{module}:{path}'),
+            Normaliser=Normaliser,
+            paths=paths,
+            mode=mode,
+            overrides=overrides,
+        ))
+    return res
+
+
+def _with_overrides(Normaliser: type[BaseNormaliser], overrides: dict[str, Any]) -> type[BaseNormaliser]:
+    # each source gets its own subclass with the overrides, so sources sharing the normaliser don't interfere
+    if len(overrides) == 0:
+        return Normaliser
+    return type(Normaliser.__name__, (Normaliser,), dict(overrides))
+
+
+def _compute_chunk(*, Normaliser: type[BaseNormaliser], overrides: dict[str, Any], **kwargs: Any) -> list[PackedGroup]:
+    # NOTE: subclass is created in the worker, since dynamically created classes can't be pickled
+    return _compute_groups_serial_as_list(Normaliser=_with_overrides(Normaliser, overrides), **kwargs)
+
+
+@dataclass
+class _Task:
+    source_idx: int
+    chunk_idx: int
+    paths: Sequence[Path]
+    size: int
+
+
+def compute_groups_batch(
+    sources: Sequence[Source],
+    *,
+    threads: int | None,
+    max_inflight_bytes: int | None = None,
+) -> list[list[Group]]:
+    '''
+    Computes groups for all sources, scheduling their chunks on one shared process pool
+    Largest chunks are started first, so small sources fill in the gaps instead of leaving cpus idle at the end
+
+    max_inflight_bytes: don't start new chunks if total size of inputs being processed would exceed this
+      (at least one chunk is always running, even if it's bigger)
+    '''
+    workers = (os.cpu_count() or 1) if threads in {None, 0} else threads
+    assert workers is not None  # make mypy happy
+
+    tasks = []
+    chunks: list[list[Sequence[Path]]] = []
+    for si, src in enumerate(sources):
+        buckets = min(workers, len(src.paths))
+        chunks.append([c for c in divide_by_size(buckets=buckets, paths=src.paths) if len(c) > 0])
+        for ci, chunk in enumerate(chunks[si]):
+            tasks.append(_Task(source_idx=si, chunk_idx=ci, paths=chunk, size=sum(p.stat().st_size for p in chunk)))
+    tasks.sort(key=lambda t: t.size, reverse=True)
+    logger.info('%d sources, %d chunks in total, using %d workers', len(sources), len(tasks), workers)
+
+    results: dict[tuple[int, int], list[Group]] = {}
+    with ExitStack() as stack:
+        base_tmp_dir = stack.enter_context(bleanser_tmp_directory())
+        pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=instrument.init_worker))
+
+        pending = list(tasks)
+        inflight: dict[Future, _Task] = {}
+        inflight_bytes = 0
+        while len(pending) > 0 or len(inflight) > 0:
+            # keep submitting (largest first) while we have free workers and fit in the budget
+            while len(inflight) < workers:
+                fits = [
+                    t for t in pending
+                    if max_inflight_bytes is None or len(inflight) == 0 or inflight_bytes + t.size <= max_inflight_bytes
+                ]
+                if len(fits) == 0:
+                    break
+                t = fits[0]
+                pending.remove(t)
+                src = sources[t.source_idx]
+                f = pool.submit(
+                    _compute_chunk,
+                    paths=t.paths,
+                    Normaliser=src.Normaliser,
+                    overrides=src.overrides,
+                    base_tmp_dir=base_tmp_dir,
+                    chunk=t.chunk_idx,
+                )
+                inflight[f] = t
+                inflight_bytes += t.size
+
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for f in done:
+                t = inflight.pop(f)
+                inflight_bytes -= t.size
+                table = PathTable(t.paths)
+                results[(t.source_idx, t.chunk_idx)] = [table.unpack(pg) for pg in f.result()]
+                logger.info('finished chunk %d of %s (%d files)', t.chunk_idx, sources[t.source_idx].name, len(t.paths))
+
+        res = []
+        for si, src in enumerate(sources):
+            # groups can span chunk boundaries, so stitching them same way as _compute_groups does
+            # otherwise the result would depend on the number of threads
+            groups = list(_stitched(
+                src.paths,
+                chunks=chunks[si],
+                result=lambda ci: results.pop((si, ci)),
+                Normaliser=_with_overrides(src.Normaliser, src.overrides),
+                base_tmp_dir=base_tmp_dir,
+            ))
+            emitted = {p for g in groups for p in g.items}
+            assert emitted == set(src.paths), (src.name, src.paths, emitted)  # just in case
+            res.append(groups)
+    return res
+
+
+@dataclass
+class Report:
+    source: str
+    files: int
+    pruned: int
+    total_bytes: int
+    pruned_bytes: int
+    errors: int
+    exit_code: int
+
+
+def run_sources(sources: Sequence[Source], *, threads: int | None, max_inflight_bytes: int | None, need_confirm: bool) -> list[Report]:
+    all_groups = compute_groups_batch(sources, threads=threads, max_inflight_bytes=max_inflight_bytes)
+
+    reports = []
+    for src, groups in zip(sources, all_groups):
+        logger.info('applying instructions for %s', src.name)
+        instructions = list(groups_to_instructions(groups))
+        # NOTE: collecting stats before applying, otherwise pruned files might be gone
+        pruned = [i.path for i in instructions if isinstance(i, Prune)]
+        report = Report(
+            source=src.name,
+            files=len(instructions),
+            pruned=len(pruned),
+            total_bytes=sum(i.path.stat().st_size for i in instructions),
+            pruned_bytes=sum(p.stat().st_size for p in pruned),
+            errors=sum(1 for i in instructions if i.group.error),
+            exit_code=-1,
+        )
+        report.exit_code = _apply_instructions(instructions, mode=src.mode, need_confirm=need_confirm)
+        reports.append(report)
+    return reports
+
+
+def print_reports(reports: Sequence[Report]) -> None:
+    mb = lambda b: f'{b / 2 ** 20:.1f}'
+    width = max((len(r.source) for r in reports), default=len('source'))
+    print(f'{"source":<{width}}  {"pruned":>13}  {"pruned Mb":>17}  errors', file=sys.stderr)
+    for r in reports:
+        print(f'{r.source:<{width}}  {r.pruned:>5} / {r.files:<5}  {mb(r.pruned_bytes):>7} / {mb(r.total_bytes):<7}  {r.errors:>6}', file=sys.stderr)
+
+
+def test_run_sources(tmp_path: Path) -> None:
+    import orjson
+
+    def make(d: Path, sets: list[list[str]]) -> None:
+        d.mkdir()
+        for i, s in enumerate(sets):
+            (d / f'{i}.json').write_bytes(orjson.dumps(s))
+
+    make(tmp_path / 'aaa', [['a'], ['a', 'b'], ['a', 'b', 'c'], ['x']])
+    make(tmp_path / 'bbb', [['a'], ['a'], ['a'], ['a'], ['a']])
+
+    cfg = {
+        'source': [
+            {'module': 'bleanser.core.modules.json', 'normaliser': 'JsonNormaliser', 'path': str(tmp_path / 'aaa'), 'prune_dominated': True},
+            {'module': 'bleanser.core.modules.json', 'normaliser': 'JsonNormaliser', 'path': str(tmp_path / 'bbb'), 'prune_dominated': True},
+        ],
+    }
+    from .modules.json import JsonNormaliser
+    prev = JsonNormaliser.PRUNE_DOMINATED
+
+    sources = load_sources(cfg)
+    reports = run_sources(sources, threads=2, max_inflight_bytes=1, need_confirm=False)
+    # note: each source is split in two chunks here, but groups are stitched across the boundary, same as in prune
+    assert [(r.files, r.pruned, r.errors) for r in reports] == [
+        (4, 1, 0),
+        (5, 3, 0),
+    ]
+    assert JsonNormaliser.PRUNE_DOMINATED == prev  # shouldn't leak overrides
+
+    # sources sharing the normaliser can still have different config
+    cfg['source'][0]['prune_dominated'] = False
+    reports = run_sources(load_sources(cfg), threads=2, max_inflight_bytes=None, need_confirm=False)
+    assert [(r.files, r.pruned, r.errors) for r in reports] == [
+        (4, 0, 0),
+        (5, 3, 0),
+    ]
+    assert JsonNormaliser.PRUNE_DOMINATED == prev
+
+    # same groups as processing each source serially
+    serial = compute_groups_batch(load_sources(cfg), threads=1)
+    assert compute_groups_batch(load_sources(cfg), threads=2) == serial
+    assert compute_groups_batch(load_sources(cfg), threads=5) == serial
+
+    # shouldn't crash without any sources
+    assert run_sources(load_sources({}), threads=2, max_inflight_bytes=None, need_confirm=False) == []
+    print_reports([])
@@ -0,0 +1,184 @@
+"""
+Columnar (Parquet) normalised files: an optional alternative to text dumps for tabular sources (see COLUMNAR in json/sqlite normalisers)
+
+Each row is a (key, value) pair, e.g. (table name, row serialised as json), and gets a 64 bit hash of its canonical rendering.
+Then set comparisons are vectorised membership checks over the hash column rather than sort/merge/diff over text,
+and normalised files don't need sorting at all. Rows are only rendered to text lines if a human readable diff is needed.
+
+Requires pyarrow (pip3 install --user pyarrow)
+"""
+
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+from typing import Any, Iterable, Sequence
+
+# deliberately unusual suffix, so we never confuse it with a user's parquet file (e.g. with 'identity' normaliser)
+SUFFIX = '.bleanser.parquet'
+
+KEY = 'key'
+VALUE = 'value'
+HASH = '_row_hash'
+
+# rows are written in batches, so we don't need to keep the whole table in memory
+_BATCH = 1 << 16
+
+
+def _pa():
+    try:
+        import pyarrow as pa
+    except ModuleNotFoundError as e:
+        if e.name == 'pyarrow':
+            raise RuntimeError('columnar normalised files require pyarrow (pip3 install --user pyarrow)') from e
+        raise
+    return pa
+
+
+def is_columnar(path: Path) -> bool:
+    return path.name.endswith(SUFFIX)
+
+
+def render(key: str, value: str) -> str:
+    '''
+    Text line for the row, same format as json normaliser uses for text dumps
+    '''
+    return f'{key} ::: {value}'
+
+
+def row_hash(key: str, value: str) -> int:
+    # NOTE: needs to be deterministic across processes (unlike builtin hash()), and 64 bits make collisions very unlikely
+    digest = hashlib.blake2b(render(key, value).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def write(rows: Iterable[tuple[str, str]], *, to: Path) -> Path:
+    '''
+    rows: (key, value) pairs, duplicates are fine
+    '''
+    assert is_columnar(to), to
+    pa = _pa()
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(KEY, pa.string()), (VALUE, pa.string()), (HASH, pa.int64())])
+    with pq.ParquetWriter(str(to), schema) as writer:
+        batch: list[tuple[str, str]] = []
+
+        def flush() -> None:
+            writer.write_table(pa.Table.from_pydict({
+                KEY  : [k for k, _ in batch],
+                VALUE: [v for _, v in batch],
+                HASH : [row_hash(k, v) for k, v in batch],
+            }, schema=schema))
+            batch.clear()
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= _BATCH:
+                flush()
+        if len(batch) > 0:
+            flush()
+    return to
+
+
+def _hashes(path: Path) -> Any:  # pyarrow.ChunkedArray
+    import pyarrow.parquet as pq
+
+    # that's the point of columnar format: only need to read this column, not the actual data
+    return pq.read_table(str(path), columns=[HASH]).column(HASH)
+
+
+def row_hashes(path: Path) -> list[int]:
+    return _hashes(path).to_pylist()
+
+
+def merge_hashes(paths: Sequence[Path], *, to: Path) -> None:
+    '''
+    Writes distinct hashes of all rows in the files (which could be either normalised files, or results of merge_hashes)
+    '''
+    pa = _pa()
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    chunks = [c for p in paths for c in _hashes(p).chunks]
+    unique = pc.unique(pa.chunked_array(chunks, type=pa.int64()))
+    pq.write_table(pa.table({HASH: unique}), str(to))
+
+
+def is_subset(lpath: Path, rpath: Path) -> bool:
+    '''
+    True if all row hashes of the left file are present in the right file, i.e. an anti-join is empty
+    '''
+    import pyarrow.compute as pc
+
+    lhashes = _hashes(lpath)
+    if len(lhashes) == 0:
+        return True
+    rhashes = _hashes(rpath).combine_chunks()
+    return pc.all(pc.is_in(lhashes, value_set=rhashes)).as_py()
+
+
+def issame(lpath: Path, rpath: Path) -> bool:
+    '''
+    Both files need to have distinct hashes (i.e. be results of merge_hashes)
+    '''
+    return len(_hashes(lpath)) == len(_hashes(rpath)) and is_subset(lpath, rpath)
+
+
+def flatten(paths: Sequence[Path], *, to: Path) -> Path:
+    '''
+    Renders distinct rows of all the files as sorted text lines, e.g. for diffing
+    '''
+    import pyarrow.parquet as pq
+
+    from .processor import get_sort_binary
+
+    # going batch by batch (rather than reading whole tables), so memory use is bounded even for huge files
+    with to.open('wb') as fo:
+        for p in paths:
+            for batch in pq.ParquetFile(str(p)).iter_batches(batch_size=_BATCH, columns=[KEY, VALUE]):
+                keys, values = (batch.column(c).to_pylist() for c in [KEY, VALUE])
+                fo.writelines(render(k, v).encode('utf8') + b'\n' for k, v in zip(keys, values))
+    # then external sort takes care of ordering & duplicates, also without loading everything in memory
+    # (C locale, so it's consistent with text dumps)
+    get_sort_binary()['-u', '-o', str(to), str(to)]()
+    return to
+
+
+def test_columnar(tmp_path: Path) -> None:
+    import pytest
+    pytest.importorskip('pyarrow')
+
+    from unittest.mock import patch
+
+    def write_rows(name: str, values: list[str]) -> Path:
+        return write([('t', v) for v in values], to=tmp_path / (name + SUFFIX))
+
+    ab  = write_rows('ab' , ['a', 'b', 'a'])
+    abc = write_rows('abc', ['c', 'b', 'a'])
+    empty = write_rows('empty', [])
+
+    assert sorted(row_hashes(ab)) == sorted(row_hash('t', v) for v in ['a', 'a', 'b'])
+    assert is_subset(ab, abc)
+    assert not is_subset(abc, ab)
+    assert is_subset(empty, ab)
+    assert not is_subset(ab, empty)
+
+    m1 = tmp_path / 'm1'
+    merge_hashes([ab], to=m1)
+    assert len(row_hashes(m1)) == 2  # duplicates are gone
+    m2 = tmp_path / 'm2'
+    merge_hashes([m1, abc], to=m2)
+    m3 = tmp_path / 'm3'
+    merge_hashes([abc], to=m3)
+    assert issame(m2, m3)
+    assert not issame(m1, m3)
+
+    assert flatten([ab, abc], to=tmp_path / 'flat').read_text() == 't ::: a\nt ::: b\nt ::: c\n'
+    assert flatten([empty], to=tmp_path / 'flat_empty').read_text() == ''
+
+    # batching shouldn't change anything
+    with patch.dict(globals(), {'_BATCH': 2}):
+        batched = write([('t', v) for v in ['c', 'b', 'a']], to=tmp_path / ('batched' + SUFFIX))
+        assert flatten([ab, batched], to=tmp_path / 'flat_batched').read_text() == 't ::: a\nt ::: b\nt ::: c\n'
+    assert sorted(row_hashes(batched)) == sorted(row_hashes(abc))
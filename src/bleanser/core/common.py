@@ -2,15 +2,18 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from pathlib import Path
-from typing import TYPE_CHECKING, Sequence, Union
+from typing import TYPE_CHECKING, Any, Mapping, Sequence, Tuple, Union
 
 from .ext.logging import LazyLogger
 
 logger = LazyLogger(__name__, level='debug')
 
 
-@dataclass
+@dataclass(frozen=True)
 class Group:
+    # there might be lots of groups (and instructions), so slots save quite a bit of memory
+    __slots__ = ('error', 'items', 'pivots')
+
     items: Sequence[Path]
     """
     All items in group are tied via 'domination' relationship
@@ -29,34 +32,92 @@ class Group:
     error: bool
 
     def __post_init__(self) -> None:
-        sp = set(self.pivots)
+        pivots = self.pivots
+        # in theory could have more pivots, but shouldn't happen for now
+        assert 1 <= len(pivots) <= 2, pivots
+        if len(pivots) == 2 and pivots[0] == pivots[1]:
+            raise RuntimeError(f'duplicate pivots: {self}')
         si = set(self.items)
         if len(self.items) != len(si):
             raise RuntimeError(f'duplicate items: {self}')
-        if len(self.pivots) != len(sp):
-            raise RuntimeError(f'duplicate pivots: {self}')
-        # in theory could have more pivots, but shouldn't happen for now
-        assert 1 <= len(sp) <= 2, sp
-        if not (sp <= si):
+        if not all(p in si for p in pivots):
             raise RuntimeError(f"pivots aren't fully contained in items: {self}")
 
+    @classmethod
+    def _unchecked(cls, *, items: Sequence[Path], pivots: Sequence[Path], error: bool) -> Group:
+        # for groups that were already validated when they were created (e.g. in a worker process)
+        g = object.__new__(cls)
+        object.__setattr__(g, 'items', items)
+        object.__setattr__(g, 'pivots', pivots)
+        object.__setattr__(g, 'error', error)
+        return g
 
-@dataclass
+    def __reduce__(self) -> tuple[Any, ...]:
+        # default pickling doesn't work for frozen dataclasses with slots (before python 3.10)
+        return (type(self), (self.items, self.pivots, self.error))
+
+
+PackedGroup = Tuple[Tuple[int, ...], Tuple[int, ...], bool]
+"""
+Group as indices into a PathTable: (items, pivots, error)
+"""
+
+
+class PathTable:
+    """
+    Maps paths to their positions in the input sequence
+
+    Passing groups between processes as indices is much cheaper than pickling Path objects,
+    and unpacked groups share path objects with the inputs instead of holding their own copies
+    """
+    __slots__ = ('_index', 'paths')
+
+    def __init__(self, paths: Sequence[Path]) -> None:
+        self.paths = paths
+        self._index: dict[Path, int] | None = None  # only needed for packing
+
+    def pack(self, group: Group) -> PackedGroup:
+        index = self._index
+        if index is None:
+            index = {p: i for i, p in enumerate(self.paths)}
+            self._index = index
+        return (
+            tuple(index[p] for p in group.items),
+            tuple(index[p] for p in group.pivots),
+            group.error,
+        )
+
+    def unpack(self, packed: PackedGroup) -> Group:
+        (items, pivots, error) = packed
+        paths = self.paths
+        return Group._unchecked(
+            items =[paths[i] for i in items],
+            pivots=[paths[i] for i in pivots],
+            error=error,
+        )
+
+
+@dataclass(frozen=True)
 class Instruction:
+    __slots__ = ('group', 'path')
+
     path: Path
     group: Group
     """
     'Reason' why the path got a certain instruction
     """
 
+    def __reduce__(self) -> tuple[Any, ...]:
+        return (type(self), (self.path, self.group))
 
-@dataclass
+
+@dataclass(frozen=True)
 class Prune(Instruction):
-    pass
+    __slots__ = ()
 
-@dataclass
+@dataclass(frozen=True)
 class Keep(Instruction):
-    pass
+    __slots__ = ()
 
 
 ### helper to define paramertized tests in function's body
@@ -93,16 +154,19 @@ class Remove(BaseMode):
 Mode = Union[Dry, Move, Remove]
 
 
-def divide_by_size(*, buckets: int, paths: Sequence[Path]) -> Sequence[Sequence[Path]]:
+def divide_by_size(*, buckets: int, paths: Sequence[Path], weights: Mapping[Path, float] | None = None) -> Sequence[Sequence[Path]]:
     """
     Divide paths into approximately equally sized groups, while preserving order
+
+    weights: how much work each file is, e.g. sizes if they are already known, or predicted processing time
+        by default, file sizes
     """
     res = []
-    with_size = [(p, p.stat().st_size) for p in paths]
+    with_size = [(p, p.stat().st_size if weights is None else weights[p]) for p in paths]
     bucket_size = sum(sz for _, sz in with_size) / buckets
 
     group: list[Path] = []
-    group_size = 0
+    group_size: float = 0
 
     def dump() -> None:
         nonlocal group_size, group
@@ -135,3 +199,30 @@ def divide_by_size(*, buckets: int, paths: Sequence[Path]) -> Sequence[Sequence[
     assert paths == flattened, res  # just a safety check
 
     return res
+
+
+def test_path_table() -> None:
+    import pickle
+
+    import pytest
+
+    paths = [Path(f'/data/{i}.json') for i in range(5)]
+    table = PathTable(paths)
+    g = Group(items=paths[1:4], pivots=[paths[1], paths[3]], error=False)
+    packed = table.pack(g)
+    assert packed == ((1, 2, 3), (1, 3), False)
+
+    # e.g. in the main process, which doesn't need the index
+    ug = PathTable(paths).unpack(pickle.loads(pickle.dumps(packed)))
+    assert ug == g
+    # shares path objects with the inputs
+    assert ug.items[0] is paths[1]
+
+    assert pickle.loads(pickle.dumps(g)) == g
+    ins = Keep(path=paths[1], group=g)
+    assert pickle.loads(pickle.dumps(ins)) == ins
+
+    with pytest.raises(RuntimeError, match='pivots'):
+        Group(items=paths[:2], pivots=[paths[3]], error=False)
+    with pytest.raises(RuntimeError, match='duplicate'):
+        Group(items=[paths[0], paths[0]], pivots=[paths[0]], error=False)
@@ -0,0 +1,190 @@
+"""
+Per-normaliser cost model: predicts how long it takes to process a file, learned from timings of the previous runs (see prune --cost-model)
+
+Time per byte differs a lot between formats (e.g. xz compressed json vs raw sqlite database), so balancing chunks
+by predicted time rather than by file size makes it less likely that a single worker ends up a straggler.
+
+For each file suffix (which is normally enough to tell the format & compression), it's a linear fit: seconds = a + b * bytes
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Mapping, Sequence
+
+from .common import logger
+
+# stages done for each file at the top level (i.e. not nested within each other), so their times add up
+_PER_FILE_STAGES = {'normalise', 'sketch', 'hashes', 'compress', 'compare'}
+
+# how much weight older runs keep every time the model learns from a new run
+_DECAY = 0.5
+
+_ALL = ''
+
+
+@dataclass
+class _Fit:
+    """
+    Sufficient statistics for least squares, so the fit can be updated incrementally
+    """
+    n  : float = 0.0
+    sx : float = 0.0
+    sy : float = 0.0
+    sxx: float = 0.0
+    sxy: float = 0.0
+
+    def add(self, x: float, y: float) -> None:
+        self.n   += 1
+        self.sx  += x
+        self.sy  += y
+        self.sxx += x * x
+        self.sxy += x * y
+
+    def decay(self, f: float) -> None:
+        self.n   *= f
+        self.sx  *= f
+        self.sy  *= f
+        self.sxx *= f
+        self.sxy *= f
+
+    def predict(self, x: float) -> float:
+        assert self.n > 0
+        mx = self.sx / self.n
+        my = self.sy / self.n
+        var = self.sxx / self.n - mx * mx
+        if var <= 0:
+            # all files had the same size, so can't tell the slope -- assume time is proportional to size
+            slope = my / mx if mx > 0 else 0.0
+        else:
+            slope = max(0.0, (self.sxy / self.n - mx * my) / var)
+        intercept = max(0.0, my - slope * mx)
+        return intercept + slope * x
+
+
+def _key(path: Path) -> str:
+    return path.suffix.lower()
+
+
+class CostModel:
+    def __init__(self, fits: dict[str, _Fit] | None = None) -> None:
+        self.fits: dict[str, _Fit] = {} if fits is None else fits
+
+    @classmethod
+    def load(cls, sfile: Path) -> CostModel:
+        if not sfile.exists():
+            return cls()
+        j = json.loads(sfile.read_text())
+        return cls({k: _Fit(**f) for k, f in j.items()})
+
+    def save(self, sfile: Path) -> None:
+        sfile.parent.mkdir(parents=True, exist_ok=True)
+        tmp = sfile.with_suffix('.tmp')
+        tmp.write_text(json.dumps({k: asdict(f) for k, f in self.fits.items()}, indent=1))
+        tmp.replace(sfile)  # atomic, so we don't end up with half written state if interrupted
+
+    def learn(self, records: Sequence[dict[str, Any]], *, sizes: Mapping[Path, int]) -> None:
+        '''
+        records: instrumentation records for the run (see instrument.reporting)
+        sizes  : sizes of the input files
+        '''
+        took: dict[Path, float] = {}
+        for r in records:
+            if r['stage'] not in _PER_FILE_STAGES or r['path'] is None:
+                continue
+            p = Path(r['path'])
+            if p not in sizes:
+                continue
+            took[p] = took.get(p, 0.0) + r['wall']
+        if len(took) == 0:
+            return
+
+        for f in self.fits.values():
+            f.decay(_DECAY)
+        for p, t in took.items():
+            for k in [_ALL, _key(p)]:
+                self.fits.setdefault(k, _Fit()).add(sizes[p], t)
+        logger.debug('cost model: learned from %d files', len(took))
+
+    def weights(self, paths: Sequence[Path], *, sizes: Mapping[Path, int]) -> dict[Path, float]:
+        '''
+        Predicted time for processing each file
+        If nothing was learnt yet, just falls back onto file sizes
+        '''
+        if _ALL not in self.fits:
+            return {p: float(sizes[p]) for p in paths}
+        res = {}
+        for p in paths:
+            fit = self.fits.get(_key(p)) or self.fits[_ALL]
+            res[p] = fit.predict(sizes[p])
+        return res
+
+
+def test_fit() -> None:
+    f = _Fit()
+    for x in [100, 200, 300]:
+        f.add(x, 1 + 0.01 * x)
+    assert abs(f.predict(400) - 5) < 1e-6
+
+    # can't tell the slope from a single point
+    g = _Fit()
+    g.add(100, 2)
+    assert g.predict(50) == 1
+
+
+def test_cost_model(tmp_path: Path) -> None:
+    def rec(stage: str, path: Path, wall: float) -> dict[str, Any]:
+        return {'stage': stage, 'path': str(path), 'wall': wall}
+
+    fast = [tmp_path / f'{i}.db' for i in range(4)]
+    slow = [tmp_path / f'{i}.json.xz' for i in range(4)]
+    sizes = {p: 1000 * (i + 1) for ps in [fast, slow] for i, p in enumerate(ps)}
+
+    model = CostModel()
+    # nothing learnt yet, so using sizes
+    assert model.weights(fast, sizes=sizes) == {p: float(sizes[p]) for p in fast}
+
+    records = [
+        *(rec('normalise', p, sizes[p] * 1e-6) for p in fast),
+        *(rec('normalise', p, sizes[p] * 1e-4) for p in slow),
+        *(rec('compare'  , p, 0.1) for p in slow),
+        # nested stage shouldn't be counted
+        *(rec('sort'     , p, 100.0) for p in slow),
+    ]
+    model.learn(records, sizes=sizes)
+
+    sfile = tmp_path / 'model.json'
+    model.save(sfile)
+    model = CostModel.load(sfile)
+
+    w = model.weights([*fast, *slow, tmp_path / 'other.txt'], sizes={**sizes, tmp_path / 'other.txt': 1000})
+    assert abs(w[fast[0]] - 1000 * 1e-6) < 1e-9
+    assert abs(w[slow[0]] - (1000 * 1e-4 + 0.1)) < 1e-9
+    # xz files are way slower even though they are the same size
+    assert w[slow[1]] > 50 * w[fast[1]]
+    # unknown suffix gets the overall estimate
+    assert w[fast[0]] < w[tmp_path / 'other.txt'] < w[slow[0]]
+
+
+def test_learn_from_run(tmp_path: Path) -> None:
+    from .instrument import reporting
+    from .processor import BaseNormaliser, compute_groups
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+    paths = []
+    for i in range(5):
+        p = tmp_path / f'{i}.txt'
+        p.write_text(''.join(f'{x}\n' for x in range(i * 100 + 1)))
+        paths.append(p)
+    sizes = {p: p.stat().st_size for p in paths}
+
+    model = CostModel()
+    with reporting(on_records=lambda records: model.learn(records, sizes=sizes)):
+        list(compute_groups(paths, Normaliser=TestNormaliser, weights=model.weights(paths, sizes=sizes)))
+    assert model.fits['.txt'].n == len(paths)
+    assert all(w > 0 for w in model.weights(paths, sizes=sizes).values())
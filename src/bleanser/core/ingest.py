@@ -0,0 +1,107 @@
+"""
+Listing input files along with their stat results, in a single pass
+
+On network filesystems with lots of files, metadata calls are the slow bit, so each file is only stat-ed once here,
+and the results are passed through (e.g. for sorting, divide_by_size and sanity checks) instead of calling stat() again.
+"""
+
+from __future__ import annotations
+
+import os
+import stat
+from glob import glob as do_glob
+from pathlib import Path
+from typing import Dict, Iterator
+
+Stats = Dict[Path, os.stat_result]
+
+
+def _walk(d: str) -> Iterator[tuple[str, os.stat_result]]:
+    try:
+        it = os.scandir(d)
+    except (NotADirectoryError, FileNotFoundError, PermissionError):
+        return
+    with it:
+        entries = list(it)
+    for e in entries:
+        # glob ignores hidden files, so keeping it consistent
+        if e.name.startswith('.'):
+            continue
+        try:
+            # note: follows symlinks, same as glob and is_file()
+            st = e.stat()
+        except FileNotFoundError:
+            # e.g. broken symlink, or removed in the meantime
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            yield from _walk(e.path)
+        elif stat.S_ISREG(st.st_mode):
+            yield (e.path, st)
+
+
+def scan(root: Path) -> Stats:
+    '''
+    All regular files under the directory (recursively)
+    '''
+    return {Path(p): st for p, st in _walk(str(root))}
+
+
+def scan_glob(pattern: str) -> Stats:
+    '''
+    All regular files matching the glob (in the glob.glob sense)
+    '''
+    res: Stats = {}
+    for p in do_glob(pattern, recursive=True):  # noqa: PTH207
+        try:
+            st = os.stat(p)  # noqa: PTH116
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            res[Path(p)] = st
+    return res
+
+
+def identity(st: os.stat_result) -> tuple[int, int, int, int]:
+    '''
+    Changes if the file was modified or replaced
+    '''
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def changed(path: Path, st: os.stat_result) -> bool:
+    '''
+    True if the file was modified/replaced since it was stat-ed (or doesn't exist anymore)
+    '''
+    try:
+        cur = path.stat()
+    except FileNotFoundError:
+        return True
+    return identity(cur) != identity(st)
+
+
+def test_scan(tmp_path: Path) -> None:
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'a' / 'b' / '2.txt').write_text('22')
+    (tmp_path / 'a' / '1.txt').write_text('1')
+    (tmp_path / '0.txt').write_text('')
+    (tmp_path / '.hidden').write_text('hidden')
+    (tmp_path / '.hidden_dir').mkdir()
+    (tmp_path / '.hidden_dir' / 'x.txt').write_text('x')
+    (tmp_path / 'link.txt').symlink_to(tmp_path / 'a' / '1.txt')
+    (tmp_path / 'broken.txt').symlink_to(tmp_path / 'nonexistent')
+
+    # should be consistent with glob + is_file
+    expected = sorted(p for p in map(Path, do_glob(str(tmp_path) + os.sep + '**', recursive=True)) if p.is_file())  # noqa: PTH207
+    stats = scan(tmp_path)
+    assert sorted(stats) == expected
+    assert {p.name: st.st_size for p, st in stats.items()} == {'0.txt': 0, '1.txt': 1, '2.txt': 2, 'link.txt': 1}
+
+    assert sorted(scan_glob(str(tmp_path / '**' / '*.txt'))) == expected
+
+    p = tmp_path / '0.txt'
+    st = stats[p]
+    assert not changed(p, st)
+    p.write_text('changed')
+    assert changed(p, st)
+    p.unlink()
+    assert changed(p, st)
@@ -0,0 +1,387 @@
+"""
+Per-stage instrumentation: timings & resource usage for each processed file, used by prune --report/--trace
+
+It's disabled unless BLEANSER_INSTRUMENT_DIR is set, in which case every process (including pool workers)
+appends its records to a separate jsonl file in that directory. The records are then aggregated by the main process.
+
+Note that io stats (read/written bytes) are only tracked for the python process itself,
+the kernel doesn't expose them for children (e.g. sort/diff). For them we track cpu time and peak memory instead.
+
+cpu time, io and forks are counted per thread, so stages running concurrently in other threads
+(thread executor, PREFETCH) don't get into each other's numbers. Children cpu and peak memory are only available
+for the whole process though, so with multiple threads they are overcounted (the report has a note if that's the case).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Iterator
+
+from .common import logger
+
+_ENV = 'BLEANSER_INSTRUMENT_DIR'
+
+_local = threading.local()
+_forks_lock = threading.Lock()
+
+# span start times are derived from perf_counter, so they are consistent with durations
+# (time.time() might be adjusted while running, and then nested spans wouldn't line up)
+_EPOCH = time.time() - time.perf_counter()
+# set while forks are being counted (see _install_fork_counter)
+_orig_popen_init: Callable[..., None] | None = None
+
+
+def _install_fork_counter() -> None:
+    global _orig_popen_init
+    # might be called from multiple threads, and patching twice would double count
+    with _forks_lock:
+        if _orig_popen_init is not None:
+            return
+
+        # NOTE: patching __init__ rather than the module attribute, since plumbum does 'from subprocess import Popen'
+        orig_init = subprocess.Popen.__init__
+
+        def __init__(self, *args, **kwargs) -> None:
+            # counted per thread, same as other stats (see _snapshot)
+            _local.forks = getattr(_local, 'forks', 0) + 1
+            orig_init(self, *args, **kwargs)
+
+        subprocess.Popen.__init__ = __init__  # type: ignore[method-assign]
+        _orig_popen_init = orig_init
+
+
+def _uninstall_fork_counter() -> None:
+    global _orig_popen_init
+    with _forks_lock:
+        if _orig_popen_init is None:
+            return
+        subprocess.Popen.__init__ = _orig_popen_init  # type: ignore[method-assign]
+        _orig_popen_init = None
+
+
+def init_worker() -> None:
+    '''
+    Initializer for process pool workers
+    Forked workers already inherit the fork counter from reporting(), but spawned ones need to install it themselves
+    (no need to uninstall, workers are gone by the time reporting() is done)
+    '''
+    if enabled():
+        _install_fork_counter()
+
+
+def _proc_io() -> tuple[int, int]:
+    try:
+        lines = Path('/proc/thread-self/io').read_text().splitlines()
+    except OSError:
+        # not linux (or an old kernel without thread-self)?
+        return (0, 0)
+    d = dict(l.split(': ') for l in lines)
+    return (int(d['rchar']), int(d['wchar']))
+
+
+def _snapshot() -> dict[str, float]:
+    ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    (rchar, wchar) = _proc_io()
+    return {
+        'wall'          : time.perf_counter(),
+        'cpu'           : time.thread_time(),
+        # NOTE: process-wide, there is no way to tell which thread the children belong to
+        'children_cpu'  : ru_children.ru_utime + ru_children.ru_stime,
+        'read_bytes'    : rchar,
+        'written_bytes' : wchar,
+        'forks'         : getattr(_local, 'forks', 0),
+    }
+
+
+def enabled() -> bool:
+    return _ENV in os.environ
+
+
+@contextmanager
+def stage(name: str, path: Path | None = None, **extra: Any) -> Iterator[None]:
+    '''
+    name: stage name, e.g. 'sort'
+    path: input file the stage is working on. If not passed, inherited from the enclosing stage
+    '''
+    odir = os.environ.get(_ENV)
+    if odir is None:
+        yield
+        return
+
+    stack: list[Path | None] = getattr(_local, 'stack', None) or []
+    _local.stack = stack
+    if path is None and len(stack) > 0:
+        path = stack[-1]
+    stack.append(path)
+
+    before = _snapshot()
+    start = _EPOCH + before['wall']
+    try:
+        yield
+    finally:
+        after = _snapshot()
+        stack.pop()
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record = {
+            'stage': name,
+            'path' : None if path is None else str(path),
+            'pid'  : os.getpid(),
+            'tid'  : threading.get_ident(),
+            'depth': len(stack),  # i.e. how many stages it's nested in
+            'start': start,
+            **{k: after[k] - before[k] for k in before},
+            # note: maxrss is the peak for the whole process lifetime, not just this stage
+            'max_rss_kb'         : ru_self.ru_maxrss,
+            'children_max_rss_kb': ru_children.ru_maxrss,
+            **extra,
+        }
+        with (Path(odir) / f'{os.getpid()}.jsonl').open('a') as fo:
+            fo.write(json.dumps(record) + '\n')
+
+
+def collect(odir: Path) -> list[dict[str, Any]]:
+    records: list[dict[str, Any]] = []
+    for f in sorted(odir.glob('*.jsonl')):
+        records.extend(json.loads(l) for l in f.read_text().splitlines())
+    records.sort(key=lambda r: r['start'])
+    return records
+
+
+_SUMMED = ('wall', 'cpu', 'children_cpu', 'read_bytes', 'written_bytes', 'forks')
+
+
+def make_report(records: list[dict[str, Any]], *, wall: float) -> dict[str, Any]:
+    '''
+    Aggregates the records per stage and per file
+    Note that stages might be nested (e.g. 'sort' happens within 'normalise'), so numbers across stages don't add up
+    '''
+    stages: dict[str, dict[str, Any]] = {}
+    files: dict[str, dict[str, dict[str, Any]]] = {}
+    for r in records:
+        for agg in [
+            stages.setdefault(r['stage'], {}),
+            files.setdefault(str(r['path']), {}).setdefault(r['stage'], {}),
+        ]:
+            agg['count'] = agg.get('count', 0) + 1
+            for k in _SUMMED:
+                agg[k] = agg.get(k, 0) + r[k]
+            agg['max_rss_kb'] = max(agg.get('max_rss_kb', 0), r['max_rss_kb'])
+            agg['children_max_rss_kb'] = max(agg.get('children_max_rss_kb', 0), r['children_max_rss_kb'])
+    # NOTE: 'wait' is the main process waiting for workers, so would double count their time
+    toplevel = [r for r in records if r['depth'] == 0 and r['stage'] != 'wait']
+    res: dict[str, Any] = {
+        'wall'   : wall,
+        'total'  : {k: sum(r[k] for r in toplevel) for k in _SUMMED},
+        'stages' : stages,
+        'files'  : files,
+        'records': records,
+    }
+    threads: dict[int, set[int]] = {}
+    for r in records:
+        threads.setdefault(r['pid'], set()).add(r['tid'])
+    if any(len(tids) > 1 for tids in threads.values()):
+        res['note'] = 'some stages ran in multiple threads of the same process, so their children_cpu and max_rss are overcounted'
+    return res
+
+
+def make_trace(records: list[dict[str, Any]]) -> dict[str, Any]:
+    '''
+    Converts the records to Chrome trace event format, which can be loaded in chrome://tracing or https://ui.perfetto.dev
+    See https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    '''
+    _skip = {'stage', 'pid', 'tid', 'depth', 'start', 'wall', *_SUMMED}
+    main_pid = os.getpid()
+    events: list[dict[str, Any]] = []
+    for pid in sorted({r['pid'] for r in records}):
+        events.append({
+            'name': 'process_name',
+            'ph'  : 'M',
+            'pid' : pid,
+            'args': {'name': 'main' if pid == main_pid else f'worker {pid}'},
+        })
+    for r in records:
+        events.append({
+            'name': r['stage'],
+            'cat' : 'bleanser',
+            'ph'  : 'X',  # 'complete' event, i.e. has both start and duration
+            'ts'  : r['start'] * 1_000_000,
+            'dur' : r['wall'] * 1_000_000,
+            'pid' : r['pid'],
+            'tid' : r['tid'],
+            'args': {
+                **{k: v for k, v in r.items() if k not in _skip},
+                'cpu': r['cpu'],
+                'children_cpu': r['children_cpu'],
+                'forks': r['forks'],
+            },
+        })
+    return {
+        'traceEvents'    : events,
+        'displayTimeUnit': 'ms',
+    }
+
+
+@contextmanager
+def reporting(
+    *,
+    report: Path | None = None,
+    trace: Path | None = None,
+    on_records: Callable[[list[dict[str, Any]]], None] | None = None,
+) -> Iterator[None]:
+    '''
+    Enables instrumentation within the context (including pool workers started within it)
+
+    report: write aggregated json report here
+    trace : write a Chrome trace (timeline of all stages across processes) here
+    on_records: called with all the records in the end (e.g. to update the cost model)
+    '''
+    assert not enabled(), 'nested reporting is not supported'
+    with TemporaryDirectory(prefix='bleanser-instrument') as td:
+        os.environ[_ENV] = td
+        # only counting forks while reporting, otherwise the patched Popen would leak into the rest of the process
+        _install_fork_counter()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _uninstall_fork_counter()
+            del os.environ[_ENV]
+        wall = time.perf_counter() - start
+        records = collect(Path(td))
+    if report is not None:
+        report.write_text(json.dumps(make_report(records, wall=wall), indent=1))
+        logger.info('written report to %s', report)
+    if trace is not None:
+        trace.write_text(json.dumps(make_trace(records)))
+        logger.info('written trace to %s', trace)
+    if on_records is not None:
+        on_records(records)
+
+
+def test_reporting(tmp_path: Path) -> None:
+    from .processor import BaseNormaliser, compute_groups, sort_file
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = True
+        PRUNE_DOMINATED = True
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Path]:
+            res = self.tmp_dir / 'normalised'
+            res.write_text(path.read_text())
+            sort_file(res)
+            yield res
+
+    paths = []
+    for i in range(5):
+        p = tmp_path / f'{i}.txt'
+        p.write_text(''.join(f'{x}\n' for x in range(i + 1)))
+        paths.append(p)
+
+    orig_popen_init = subprocess.Popen.__init__
+    report = tmp_path / 'report.json'
+    with reporting(report=report):
+        assert subprocess.Popen.__init__ is not orig_popen_init
+        list(compute_groups(paths, Normaliser=TestNormaliser))
+    assert not enabled()
+    # shouldn't leak outside of reporting
+    assert subprocess.Popen.__init__ is orig_popen_init
+
+    j = json.loads(report.read_text())
+    stages = j['stages']
+    assert stages['normalise']['count'] == 5
+    assert stages['sort']['count'] == 5
+    assert stages['sort']['forks'] == 5
+    assert stages['union']['count'] > 0
+    assert stages['subset']['count'] > 0
+    assert j['total']['forks'] > 5
+
+    # compare stages are attributed to the right file being compared
+    assert set(j['files'][str(paths[3])]) == {'unpack', 'normalise', 'sort', 'hashes', 'compare', 'union', 'subset'}
+
+    # shouldn't do anything if not enabled
+    with stage('whatever'):
+        pass
+
+
+def test_threads(tmp_path: Path) -> None:
+    started = threading.Event()
+    done = threading.Event()
+
+    def busy() -> None:
+        with stage('busy'):
+            started.set()
+            subprocess.check_call(['true'])
+            deadline = time.thread_time() + 0.3
+            while time.thread_time() < deadline:
+                pass
+        done.set()
+
+    report = tmp_path / 'report.json'
+    with reporting(report=report):
+        t = threading.Thread(target=busy)
+        t.start()
+        started.wait()
+        with stage('idle'):
+            done.wait()
+        t.join()
+
+    j = json.loads(report.read_text())
+    busy_, idle = j['stages']['busy'], j['stages']['idle']
+    # the other thread's work shouldn't end up in the idle stage, even though they overlap
+    assert busy_['cpu'] >= 0.3
+    assert idle['cpu'] < 0.1
+    assert (busy_['forks'], idle['forks']) == (1, 0)
+    assert 'overcounted' in j['note']
+
+
+def test_trace(tmp_path: Path) -> None:
+    # note: normaliser needs to be picklable for the process pool, so can't define it locally
+    from .modules.json import JsonNormaliser
+    from .processor import compute_groups
+
+    paths = []
+    for i in range(6):
+        p = tmp_path / f'{i}.json'
+        # files don't dominate each other, so the main process only needs to stitch a single group at the chunk boundary
+        p.write_text(json.dumps([i]))
+        paths.append(p)
+
+    trace = tmp_path / 'trace.json'
+    with reporting(trace=trace):
+        groups = list(compute_groups(paths, Normaliser=JsonNormaliser, threads=2))
+
+    j = json.loads(trace.read_text())
+    spans = [e for e in j['traceEvents'] if e['ph'] == 'X']
+    main_pid = os.getpid()
+    workers = {e['pid'] for e in spans} - {main_pid}
+    assert len(workers) == 2
+
+    # main process is only waiting on workers, and stitching groups at the chunk boundary
+    main = [e for e in spans if e['pid'] == main_pid]
+    toplevel = {'wait', 'stitch'}
+    assert {e['name'] for e in main} >= toplevel
+    outer = [e for e in main if e['name'] in toplevel]
+    for e in main:
+        assert any(o['ts'] <= e['ts'] <= e['ts'] + e['dur'] <= o['ts'] + o['dur'] for o in outer), e
+    assert sorted(e['args']['chunk'] for e in spans if e['name'] == 'wait') == [0, 1]
+
+    chunks = [e for e in spans if e['name'] == 'chunk']
+    assert sorted(e['args']['chunk'] for e in chunks) == [0, 1]
+    for e in spans:
+        if e['name'] in {'normalise', 'compare', 'emit'} and e['pid'] != main_pid:
+            assert e['pid'] in workers
+            # should be nested within one of the chunk spans of the same worker
+            [c] = [c for c in chunks if c['pid'] == e['pid'] and c['ts'] <= e['ts'] <= c['ts'] + c['dur']]
+            assert e['ts'] + e['dur'] <= c['ts'] + c['dur']
+    # last group of the first chunk is redone in the main process
+    assert sum(1 for e in spans if e['name'] == 'emit') == len(groups) + 1
@@ -1,20 +1,29 @@
 # not to confuse with __main__.py... meh
 from __future__ import annotations
 
+import logging
 import os
-from glob import glob as do_glob
+import sys
+from contextlib import ExitStack
 from pathlib import Path
-from typing import cast
+from typing import Any, Callable, Iterable, Iterator, Mapping, cast
 
 import click
 
-from .common import Dry, Mode, Move, Remove, logger
+from . import ingest, instrument, shards
+from .common import Dry, Instruction, Mode, Move, Remove, logger
+from .costmodel import CostModel
 from .processor import (
     BaseNormaliser,
-    apply_instructions,
+    ExecutorKind,
+    _apply_instructions,
     bleanser_tmp_directory,
     compute_instructions,
+    groups_to_instructions,
+    verify_groups,
+    watch_groups,
 )
+from .state import Checkpoint, IncrementalState, state_file
 
 
 # TODO use context and default_map
@@ -76,6 +85,8 @@ def main(*, Normaliser: type[BaseNormaliser]) -> None:
             n = Normaliser(original=path, base_tmp_dir=base_tmp_dir)
             with n.do_normalise() as cleaned:
                 if stdout:
+                    if shards.is_sharded(cleaned):
+                        cleaned = shards.flatten(cleaned, to=base_tmp_dir / 'flat')
                     print(cleaned.read_text())
                 else:
                     click.secho(f'You can examine normalised file: {cleaned}', fg='green')
@@ -96,65 +107,213 @@ def main(*, Normaliser: type[BaseNormaliser]) -> None:
         type=int, is_flag=False, flag_value=0, default=None,
         help="Number of threads (processes) to use. Without the flag won't use any, with the flag will try using all available, can also take a specific value. Passed down to PoolExecutor.",
     )
+    @click.option(
+        '--executor',
+        type=click.Choice(['thread', 'process']), default=None,
+        help=f"Whether --threads are threads or processes. Threads have much less overhead, but only make sense if the time is mostly spent in subprocesses. Default for this normaliser: {Normaliser.EXECUTOR}",
+    )
     ##
     @click.option  ('--from', 'from_', type=int    , default=None)
     @click.option  ('--to'           , type=int    , default=None)
     ##
     @click.option  ('--multiway'       , is_flag=True, default=None                , help='force "multiway" cleanup')
     @click.option  ('--prune-dominated', is_flag=True, default=None)
-    def prune(*, path: str, sort_by: str, glob: bool, dry: bool, move: Path | None, remove: bool, threads: int | None, from_: int | None, to: int | None, multiway: bool | None, prune_dominated: bool | None, yes: bool) -> None:
-        modes: list[Mode] = []
-        if dry is True:
-            modes.append(Dry())
-        if move is not None:
-            modes.append(Move(path=move))
-        if remove is True:
-            modes.append(Remove())
-        if len(modes) == 0:
-            modes.append(Dry())
-        assert len(modes) == 1, f'please specify exactly one of modes (got {modes})'
-        [mode] = modes
-        # TODO eh, would be nice to use some package for mutually exclusive args..
-        # e.g. https://stackoverflow.com/questions/37310718/mutually-exclusive-option-groups-in-python-click
-
-        paths = _get_paths(path=path, glob=glob, from_=from_, to=to, sort_by=sort_by)
+    @click.option  ('--compress-tmp'   , is_flag=True, default=None                , help='Keep temporary normalised files zstd-compressed (less disk space, but more cpu)')
+    @click.option  ('--prefetch'       , type=int    , default=None                , help='Normalise up to this many files ahead in background, while comparing the current ones (more temporary disk space)')
+    ##
+    @click.option('--incremental', is_flag=True, default=False, help="Only process files that arrived since the previous (non-dry) --incremental run, resuming from the pivots of its last group")
+    @click.option('--resume', is_flag=True, default=False, help="Checkpoint groups as they're computed, and skip the ones computed by the previous interrupted --resume run")
+    @click.option('--stream', is_flag=True, default=False, help="Prune files as soon as their group is computed, rather than after processing everything (requires --yes). Files modified while running are kept")
+    @click.option('--verify', is_flag=True, default=False, help="Before pruning, double check that lines of each pruned file are present in the pivots of its group (costs about one extra normalisation per file)")
+    @click.option('--cost-model', is_flag=True, default=False, help="Balance work between threads by processing time predicted from the previous --cost-model runs (rather than by file size)")
+    @click.option('--report', type=Path, default=None, help='Write per-stage/per-file timings and resource usage to this JSON file')
+    @click.option('--trace', type=Path, default=None, help='Write timeline of all stages across worker processes to this file (Chrome trace format, can be opened in ui.perfetto.dev)')
+    def prune(*, path: str, sort_by: str, glob: bool, dry: bool, move: Path | None, remove: bool, threads: int | None, executor: ExecutorKind | None, from_: int | None, to: int | None, multiway: bool | None, prune_dominated: bool | None, compress_tmp: bool | None, prefetch: int | None, yes: bool, incremental: bool, resume: bool, stream: bool, verify: bool, cost_model: bool, report: Path | None, trace: Path | None) -> None:
+        mode = _get_mode(dry=dry, move=move, remove=remove)
+
+        stats = _scan_paths(path=path, glob=glob, from_=from_, to=to, sort_by=sort_by)
+        paths = list(stats)
+
+        incremental_state_file: Path | None = None
+        if incremental:
+            assert sort_by == 'name', "--incremental relies on new files being at the end, so only makes sense with --sort-by name"
+            incremental_state_file = state_file(kind='incremental', Normaliser=Normaliser, key=path)
+            state = IncrementalState.load(incremental_state_file)
+            if state is not None:
+                paths = state.paths_to_process(paths)
 
         if multiway is not None:
             Normaliser.MULTIWAY = multiway
         if prune_dominated is not None:
             Normaliser.PRUNE_DOMINATED = prune_dominated
+        if compress_tmp is not None:
+            Normaliser.COMPRESS_TMP = compress_tmp
+        if prefetch is not None:
+            assert prefetch >= 0, prefetch
+            Normaliser.PREFETCH = prefetch
+
+        checkpoint: Checkpoint | None = None
+        if resume:
+            checkpoint = Checkpoint(state_file(kind='checkpoint', Normaliser=Normaliser, key=path), Normaliser=Normaliser)
+
+        identities: dict[Path, tuple[int, int, int, int]] | None = None
+        if stream:
+            assert yes, "can't confirm when pruning files as we go, please pass --yes if you really want to prune files"
+            assert not verify, "can't verify when pruning files as we go"
+            # taking these before processing, so if a file changes while we're running, it's never pruned
+            identities = {p: ingest.identity(stats[p]) for p in paths}
+
+        sizes = {p: stats[p].st_size for p in paths}
+        weights: Mapping[Path, float] = sizes
+        on_records: Callable[[list[dict[str, Any]]], None] | None = None
+        if cost_model:
+            model_file = state_file(kind='costmodel', Normaliser=Normaliser, key='')
+            model = CostModel.load(model_file)
+            weights = model.weights(paths, sizes=sizes)
+
+            def learn(records: list[dict[str, Any]]) -> None:
+                model.learn(records, sizes=sizes)
+                model.save(model_file)
+                logger.info('updated cost model %s', model_file)
+            on_records = learn
+
+        instructions: list[Instruction] = []
+        exit_code = 0
+        with ExitStack() as stack:
+            if report is not None or trace is not None or on_records is not None:
+                stack.enter_context(instrument.reporting(report=report, trace=trace, on_records=on_records))
+            it = compute_instructions(
+                paths,
+                Normaliser=Normaliser,
+                threads=threads,
+                checkpoint=None if checkpoint is None else checkpoint.sfile,
+                weights=weights,
+                executor=executor,
+            )
+            if identities is not None:
+                exit_code = _apply_instructions(_collect(it, into=instructions), mode=mode, need_confirm=False, identities=identities)
+            else:
+                instructions.extend(it)
+        if identities is None:
+            if verify:
+                groups = list({id(i.group): i.group for i in instructions}.values())
+                failed = verify_groups(groups, Normaliser=Normaliser, threads=threads, executor=executor)
+                if len(failed) > 0:
+                    logger.error('verification failed for %d files, not pruning anything', len(failed))
+                    sys.exit(1)
+                logger.info('verification passed')
 
-        instructions = list(compute_instructions(paths, Normaliser=Normaliser, threads=threads))
-        # NOTE: for now, forcing list() to make sure instructions compute before path check
-        # not strictly necessary
-        for p in paths:
-            # just in case, to make sure no one messed with files in the meantime
-            assert p.exists(), p
+            # NOTE: for now, forcing list() to make sure instructions compute before path check
+            # not strictly necessary
+            for p in paths:
+                # just in case, to make sure no one messed with files in the meantime
+                assert not ingest.changed(p, stats[p]), f'{p} was changed while processing'
 
-        need_confirm = not yes
-        apply_instructions(instructions, mode=mode, need_confirm=need_confirm)
+            need_confirm = not yes
+            exit_code = _apply_instructions(instructions, mode=mode, need_confirm=need_confirm)
+
+        if incremental_state_file is not None and not isinstance(mode, Dry):
+            # only saving after the instructions were applied, otherwise next run would skip files we haven't pruned
+            last_group = instructions[-1].group
+            IncrementalState.from_last_group(group=last_group, paths=paths).save(incremental_state_file)
+            logger.info('saved incremental state to %s', incremental_state_file)
+        if checkpoint is not None and not isinstance(mode, Dry):
+            # files were pruned, so no use for it anymore (after dry runs it's kept, so the real run can reuse it)
+            checkpoint.remove()
+        sys.exit(exit_code)
+
+    @call_main.command(name='watch', short_help='keep watching for new files & prune them as soon as possible')
+    @click.argument('path', type=str)
+    @click.option('--glob', is_flag=True, default=False, help='Treat the path as glob (in the glob.glob sense)')
+    ##
+    @click.option  ('--dry'   , is_flag=True, default=None, help='Do not prune the input files, just print what would happen after pruning.')
+    @click.option  ('--remove', is_flag=True, default=None, help='Prune the input files by REMOVING them (be careful!)')
+    @click.option  ('--move'  , type=Path                 , help='Prune the input files by MOVING them to the specified path. A bit safer than --remove mode.')
+    ##
+    @click.option('--yes', is_flag=True, default=False, help="Required to actually prune files (since there is no one to confirm in watch mode)")
+    @click.option('--interval', type=float, default=60.0, help='How often to check for new files (seconds)')
+    @click.option('--idle-timeout', type=float, default=None, help='Stop if no new files arrived for this many seconds (by default, watch forever)')
+    ##
+    @click.option  ('--multiway'       , is_flag=True, default=None                , help='force "multiway" cleanup')
+    @click.option  ('--prune-dominated', is_flag=True, default=None)
+    @click.option  ('--compress-tmp'   , is_flag=True, default=None                , help='Keep temporary normalised files zstd-compressed (less disk space, but more cpu)')
+    def watch(*, path: str, glob: bool, dry: bool, move: Path | None, remove: bool, yes: bool, interval: float, idle_timeout: float | None, multiway: bool | None, prune_dominated: bool | None, compress_tmp: bool | None) -> None:
+        mode = _get_mode(dry=dry, move=move, remove=remove)
+        assert isinstance(mode, Dry) or yes, 'watch mode has no one to confirm pruning, please pass --yes if you really want to prune files'
+
+        if multiway is not None:
+            Normaliser.MULTIWAY = multiway
+        if prune_dominated is not None:
+            Normaliser.PRUNE_DOMINATED = prune_dominated
+        if compress_tmp is not None:
+            Normaliser.COMPRESS_TMP = compress_tmp
+
+        def get_paths() -> list[Path]:
+            # quiet, otherwise it would log on every poll
+            return _get_paths(path=path, glob=glob, from_=None, to=None, allow_empty=True, quiet=True)
+
+        # groups are closed once emitted, so it's safe to prune straight away -- same as prune --stream
+        identities: dict[Path, tuple[int, int, int, int]] = {}
+        groups = watch_groups(get_paths, Normaliser=Normaliser, interval=interval, idle_timeout=idle_timeout, identities=identities)
+        exit_code = _apply_instructions(groups_to_instructions(groups), mode=mode, need_confirm=False, identities=identities)
+        sys.exit(exit_code)
     call_main()
 
 
-def _get_paths(*, path: str, from_: int | None, to: int | None, sort_by: str = "name", glob: bool=False) -> list[Path]:
+def _collect(instructions: Iterable[Instruction], *, into: list[Instruction]) -> Iterator[Instruction]:
+    # keeps the instructions as they're consumed, e.g. to save incremental state after streaming prune
+    for ins in instructions:
+        into.append(ins)
+        yield ins
+
+
+def _get_mode(*, dry: bool, move: Path | None, remove: bool) -> Mode:
+    modes: list[Mode] = []
+    if dry is True:
+        modes.append(Dry())
+    if move is not None:
+        modes.append(Move(path=move))
+    if remove is True:
+        modes.append(Remove())
+    if len(modes) == 0:
+        modes.append(Dry())
+    assert len(modes) == 1, f'please specify exactly one of modes (got {modes})'
+    [mode] = modes
+    # TODO eh, would be nice to use some package for mutually exclusive args..
+    # e.g. https://stackoverflow.com/questions/37310718/mutually-exclusive-option-groups-in-python-click
+    return mode
+
+
+def _get_paths(*, path: str, from_: int | None, to: int | None, sort_by: str = "name", glob: bool=False, allow_empty: bool=False, quiet: bool=False) -> list[Path]:
+    return list(_scan_paths(path=path, from_=from_, to=to, sort_by=sort_by, glob=glob, allow_empty=allow_empty, quiet=quiet))
+
+
+def _scan_paths(*, path: str, from_: int | None, to: int | None, sort_by: str = "name", glob: bool=False, allow_empty: bool=False, quiet: bool=False) -> ingest.Stats:
+    """
+    Same as _get_paths, but also returns stat results (in the same order), so there is no need to stat files again
+
+    quiet: only log at debug level (e.g. when listing files repeatedly in watch mode)
+    """
     if not glob:
         pp = Path(path)
         assert pp.is_dir(), pp
-        path = str(pp) + os.sep + '**'
-    paths = [Path(p) for p in do_glob(path, recursive=True)]  # noqa: PTH207
-    paths = [p for p in paths if p.is_file()]
+        stats = ingest.scan(pp)
+    else:
+        stats = ingest.scan_glob(path)
     if sort_by == "name":
         # assumes sort order is same as date order? guess it's reasonable
-        paths = sorted(paths)
+        paths = sorted(stats)
     else:
-        paths = sorted(paths, key=lambda s: s.stat().st_size)
+        paths = sorted(stats, key=lambda s: stats[s].st_size)
 
     if from_ is None:
         from_ = 0
     if to is None:
         to = len(paths)
     paths = paths[from_:to]
+    if allow_empty and len(paths) == 0:
+        return {}
     assert len(paths) > 0
 
-    logger.info('processing %d files (%s ... %s)', len(paths), paths[0], paths[-1])
-    return paths
+    logger.log(logging.DEBUG if quiet else logging.INFO, 'processing %d files (%s ... %s)', len(paths), paths[0], paths[-1])
+    return {p: stats[p] for p in paths}
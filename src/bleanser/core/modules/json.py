@@ -1,9 +1,12 @@
+from __future__ import annotations
+
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterator
-
-import orjson
+from typing import IO, ClassVar, Iterator
 
+from bleanser.core import columnar, shards
+from bleanser.core.common import parametrize
+from bleanser.core.instrument import stage
 from bleanser.core.processor import (
     BaseNormaliser,
     Normalised,
@@ -17,6 +20,13 @@ from bleanser.core.utils import Json, delkeys, patch_atoms  # noqa: F401
 class JsonNormaliser(BaseNormaliser):
     PRUNE_DOMINATED = False
 
+    # if True, emits a shard per top-level key instead of a single file (see core/shards.py)
+    SHARDED: ClassVar[bool] = False
+
+    # if True, emits a Parquet file with a row per item instead of text lines (see core/columnar.py), requires pyarrow
+    # then there is no need to sort, and comparisons work on row hashes -- worth it for big tabular data (e.g. lastfm scrobbles)
+    COLUMNAR: ClassVar[bool] = False
+
     def cleanup(self, j: Json) -> Json:
         '''
         subclasses should override this function, to do the actual cleanup
@@ -38,25 +48,56 @@ class JsonNormaliser(BaseNormaliser):
         #         'application/json',
         # }, mp
 
+        import orjson
+
         j = orjson.loads(path.read_text())
-        j = self.cleanup(j)
+        with stage('cleanup'):
+            j = self.cleanup(j)
 
         # create a tempfile to write flattened data to
         cleaned = unique_file_in_tempdir(input_filepath=path, dir=self.tmp_dir, suffix='.json')
 
-        with cleaned.open('w') as fo:
-            if isinstance(j, list):
-                j = {'<toplevel>': j} # meh
+        if isinstance(j, list):
+            j = {'<toplevel>': j} # meh
+
+        assert isinstance(j, dict), j
+
+        def rows(k: str, v: Json) -> Iterator[tuple[str, str]]:
+            if not isinstance(v, list):
+                # something like 'profile' data in hypothesis could be a dict
+                # something like 'notes' in rescuetime could be a scalar (str)
+                v = [v] # meh
+            assert isinstance(v, list), (k, v)
+            for i in v:
+                yield (k, orjson.dumps(i, option=orjson.OPT_SORT_KEYS).decode('utf8'))
+
+        def write(fo: IO[str], k: str, v: Json) -> None:
+            for row in rows(k, v):
+                print(columnar.render(*row), file=fo)
+
+        if self.COLUMNAR:
+            cfile = cleaned.with_name(cleaned.name + columnar.SUFFIX)
+            with stage('columnar'):
+                columnar.write((row for k, v in j.items() for row in rows(k, v)), to=cfile)
+            yield cfile
+            return
+
+        if self.SHARDED:
+            # lines are prefixed with the key, so they always end up in the same shard
+            cleaned.mkdir()
+            sfiles = {}
+            for idx, (k, v) in enumerate(j.items()):
+                sfile = cleaned / f'{idx:05d}.json'
+                with sfile.open('w') as fo:
+                    write(fo, k, v)
+                sfiles[k] = sfile
+            shards.finalise(cleaned, sfiles)
+            yield cleaned
+            return
 
-            assert isinstance(j, dict), j
+        with cleaned.open('w') as fo:
             for k, v in j.items():
-                if not isinstance(v, list):
-                    # something like 'profile' data in hypothesis could be a dict
-                    # something like 'notes' in rescuetime could be a scalar (str)
-                    v = [v] # meh
-                assert isinstance(v, list), (k, v)
-                for i in v:
-                    print(f'{k} ::: {orjson.dumps(i, option=orjson.OPT_SORT_KEYS).decode("utf8")}', file=fo)
+                write(fo, k, v)
 
         # todo meh... see Fileset._union
         # this gives it a bit of a speedup, just calls out to unix sort
@@ -72,6 +113,8 @@ if __name__ == '__main__':
 # TODO actually implement some artificial json test
 #
 def test_nonidempotence(tmp_path: Path) -> None:
+    import orjson
+
     from bleanser.tests.common import actions, hack_attribute
     '''
     Just demonstrates that multiway processing might be
@@ -107,3 +150,38 @@ def test_nonidempotence(tmp_path: Path) -> None:
             '4.json',
         ]
 
+
+
+@parametrize('attr', ['SHARDED', 'COLUMNAR'])
+def test_output_format(tmp_path: Path, attr: str) -> None:
+    '''
+    Alternative normalised formats shouldn't change the results
+    '''
+    if attr == 'COLUMNAR':
+        import pytest
+        pytest.importorskip('pyarrow')
+
+    import orjson
+
+    from bleanser.core.processor import compute_groups
+    from bleanser.tests.common import hack_attribute
+
+    paths = []
+    for i in range(12):
+        # 'static' key never changes, so its shards can be skipped during comparisons
+        j = {
+            'static': ['x', 'y'],
+            'growing': list(range(i if i % 5 != 0 else i // 2)),
+            **({'rare': [i]} if i % 4 == 0 else {}),
+        }
+        p = tmp_path / f'{i:02d}.json'
+        p.write_bytes(orjson.dumps(j))
+        paths.append(p)
+
+    for multiway in [False, True]:
+        with hack_attribute(JsonNormaliser, 'MULTIWAY', value=multiway), hack_attribute(JsonNormaliser, 'PRUNE_DOMINATED', value=True):
+            groups = list(compute_groups(paths, Normaliser=JsonNormaliser))
+            with hack_attribute(JsonNormaliser, attr, value=True):
+                fgroups = list(compute_groups(paths, Normaliser=JsonNormaliser))
+        assert groups == fgroups, multiway
+        assert len(groups) < len(paths)
@@ -8,18 +8,20 @@ import re
 import shutil
 import sqlite3
 from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from sqlite3 import Connection
-from typing import Any, Iterator, Sequence, Set, Tuple
-
-from plumbum import local  # type: ignore
+from typing import Any, ClassVar, Iterator, Sequence, Set, Tuple
 
+from .. import columnar, shards
 from ..common import Keep, Prune, parametrize
+from ..instrument import stage
 from ..processor import (
     BaseNormaliser,
     Normalised,
     compute_groups,
     compute_instructions,
+    get_sort_binary,
     sort_file,
     unique_file_in_tempdir,
 )
@@ -107,8 +109,98 @@ def checked_db(db: Path, *, allowed_blobs: AllowedBlobs | None) -> Path:
     return db
 
 
-grep = local['grep']
-sqlite_cmd = local['sqlite3']
+@lru_cache(1)
+def get_sqlite_binary():
+    from plumbum import local
+    return local['sqlite3']
+
+
+_HEX_RE = re.compile(b"X'([0-9a-f]*)'")
+
+
+def _unhex(dump: Path, *, to: Path, skip: frozenset[bytes] = frozenset()) -> list[bytes]:
+    '''
+    Returns lines that were skipped
+    '''
+    ## one issue is that .dump dumps sometimes text columns as hex-encoded and prefixed with X
+    ## this makes sense if you're using .dump output to create another db
+    ## but in our case makes diffs very cryptic
+    # TODO hmm this might break if it's a legit binary BLOB?
+    skipped: list[bytes] = []
+    with dump.open('rb') as fi, to.open('wb') as fo:
+        while True:
+            lines = fi.readlines(1 << 20)
+            if len(lines) == 0:
+                break
+            # readlines splits by newlines, so only the very last line might not end with one
+            assert lines[-1].endswith(b'\n')
+            if len(skip) > 0:
+                skipped.extend(l for l in lines if l in skip)
+                lines = [l for l in lines if l not in skip]
+            block = b''.join(lines)
+            if b"X'" not in block:
+                # fast path, most of the dump doesn't have any hex
+                fo.write(block)
+                continue
+            for line in lines:
+                # fixme need to find all in case of multiple hex columns
+                m = _HEX_RE.search(line)
+                if m is not None:
+                    hh = m.group(1).decode('utf8')
+                    ss = bytes.fromhex(hh)
+                    if len(ss) > 0 and ss[0] == b'{' and ss[-1] == b'}':  # type: ignore[comparison-overlap]
+                        # json-ish
+                        # replace newlines just in case, otherwise it might mangle the sorting
+                        ss = re.sub(rb'(\r\n|\r|\n)', b'<NEWLINE>', ss)
+                        line = line[:m.start(1)] + ss + line[m.end(1):]
+                fo.write(line)
+    return skipped
+
+
+# .dump emits these for every invocation, so when dumping tables separately they are kept in a separate shard
+_DUMP_PREAMBLE = frozenset({
+    b'PRAGMA foreign_keys=OFF;\n',
+    b'BEGIN TRANSACTION;\n',
+    b'COMMIT;\n',
+})
+_PREAMBLE_SHARD = '<preamble>'
+
+
+def _dump_shards(db: Path, *, tables: Sequence[str], odir: Path, workers: int) -> dict[str, Path]:
+    '''
+    Dumps each table into a separate sorted shard (same as .dump + _unhex + sort_file), in parallel
+    Threads are enough here, since most of the work happens in sqlite3/sort processes
+
+    Returns shard name (table name or _PREAMBLE_SHARD) -> shard file
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    odir.mkdir(exist_ok=True)
+
+    def dump_table(idx: int, table: str) -> tuple[Path, list[bytes]]:
+        # .dump takes LIKE patterns, so need to escape, otherwise e.g. a_b would also dump axb
+        pattern = table.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        # and quote, in case of spaces (single quoted args aren't unescaped by sqlite shell)
+        assert "'" not in table, table
+        raw   = odir / f'{idx:05d}.raw'
+        shard = odir / f'{idx:05d}.sql'
+        cmd = get_sqlite_binary()['-readonly', f'file://{db}?immutable=1', f".dump '{pattern}'"] > str(raw)
+        cmd()
+        preamble = _unhex(raw, to=shard, skip=_DUMP_PREAMBLE)
+        raw.unlink()
+        get_sort_binary()['-o', str(shard), str(shard)]()
+        return (shard, preamble)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(dump_table, range(len(tables)), tables))
+
+    pfile = odir / 'preamble.sql'
+    # it's the same for all tables, so just keep the first one
+    pfile.write_bytes(b''.join(sorted(results[0][1])) if len(results) > 0 else b'')
+    return {
+        _PREAMBLE_SHARD: pfile,
+        **{table: shard for table, (shard, _) in zip(tables, results)},
+    }
 
 
 def _dict2db(d: dict, *, to: Path) -> Path:
@@ -254,6 +346,136 @@ def test_sqlite_many(*, tmp_path: Path, multiway: bool) -> None:
     ))
 
 
+def test_dump_workers(tmp_path: Path) -> None:
+    class ParallelNormaliser(SqliteNormaliser):
+        DUMP_WORKERS = 4
+
+    db = tmp_path / 'test.db'
+    with sqlite3.connect(db) as conn:
+        # a_b is also a LIKE pattern for axb, so checks escaping
+        conn.execute('CREATE TABLE a_b (x)')
+        conn.execute('CREATE TABLE axb (x)')
+        conn.execute('CREATE TABLE blobs (id INTEGER PRIMARY KEY, v BLOB)')
+        conn.execute('CREATE TABLE other (x)')
+        conn.executemany('INSERT INTO a_b VALUES (?)', [(i,) for i in range(1000)])
+        conn.executemany('INSERT INTO axb VALUES (?)', [(i,) for i in range(1000)])
+        conn.execute("INSERT INTO other VALUES ('COMMIT;')")
+        conn.executemany('INSERT INTO blobs(v) VALUES (?)', [(b'{\n}',), (b'\x00blob',)])
+    conn.close()
+
+    def dump(Normaliser: type[SqliteNormaliser]) -> bytes:
+        n = Normaliser(original=db, base_tmp_dir=tmp_path / 'tmp')
+        with n.do_normalise() as res:
+            return res.read_bytes()
+
+    serial = dump(SqliteNormaliser)
+    assert serial.count(b'COMMIT;\n') == 1
+    assert dump(ParallelNormaliser) == serial
+
+    class ShardedNormaliser(SqliteNormaliser):
+        SHARDED = True
+
+    n = ShardedNormaliser(original=db, base_tmp_dir=tmp_path / 'tmp')
+    with n.do_normalise() as res:
+        assert shards.is_sharded(res)
+        assert set(shards.read_manifest(res)) == {'<preamble>', 'a_b', 'axb', 'blobs', 'other'}
+        flat = shards.flatten(res, to=tmp_path / 'flat')
+        # shards are deduplicated, but otherwise should be the same
+        assert flat.read_bytes() == serial
+
+
+# names starting with sqlite_ are reserved, so can't clash with a user table
+_SCHEMA_KEY = 'sqlite_master'
+
+
+def _dump_columnar(db: Path, *, tables: Sequence[str], to: Path) -> Path:
+    '''
+    Dumps rows of all tables into a columnar file (see core/columnar.py): table name as the key, row as json object as the value
+    Similar to .dump, schema is included too (as rows under _SCHEMA_KEY), so e.g. renamed columns or empty tables aren't lost
+    '''
+    import orjson
+
+    def default(o: Any) -> str:
+        if isinstance(o, bytes):
+            # same as .dump does
+            return f"X'{o.hex()}'"
+        raise TypeError(o)
+
+    def rows() -> Iterator[tuple[str, str]]:
+        with sqlite3.connect(f'file:{db}?immutable=1', uri=True) as conn:
+            for table in tables:
+                [(sql,)] = conn.execute('SELECT sql FROM sqlite_master WHERE type = "table" AND name = ?', (table,))
+                yield (_SCHEMA_KEY, sql)
+                cursor = conn.execute(f'SELECT * FROM `{table}`')
+                columns = [c[0] for c in cursor.description]
+                for row in cursor:
+                    # NOTE: orjson keeps the key order, so it's the same as column order
+                    yield (table, orjson.dumps(dict(zip(columns, row)), default=default).decode('utf8'))
+        conn.close()
+
+    return columnar.write(rows(), to=to)
+
+
+def test_columnar(tmp_path: Path) -> None:
+    import pytest
+    pytest.importorskip('pyarrow')
+
+    paths = []
+    d: dict[str, Any] = {}
+    for i in range(30):
+        if i % 10 == 0:
+            # flush so sometimes it emits groups
+            d = {'t': [('number', 'data')]}
+        d['t'].append((i, b'\x00blob'))
+        paths.append(_dict2db(d, to=tmp_path / f'{i:04}.db'))
+
+    for multiway in [False, True]:
+        class TextNormaliser(SqliteNormaliser):
+            MULTIWAY = multiway
+            PRUNE_DOMINATED = True
+
+        class ColumnarNormaliser(TextNormaliser):
+            COLUMNAR = True
+
+        n = ColumnarNormaliser(original=paths[0], base_tmp_dir=tmp_path / 'tmp')
+        with n.do_normalise() as res:
+            assert columnar.is_columnar(res)
+            assert columnar.flatten([res], to=tmp_path / 'flat').read_text() == (
+                'sqlite_master ::: CREATE TABLE `t` (`number` , `data` )\n'
+                't ::: {"number":0,"data":"X\'00626c6f62\'"}\n'
+            )
+
+        expected = list(compute_groups(paths, Normaliser=TextNormaliser))
+        assert list(compute_groups(paths, Normaliser=ColumnarNormaliser)) == expected
+
+    # schema changes should be detected even if the data stays the same
+    sds: list[dict[str, Any]] = [
+        {'t': [('a', 'b'), (1, 2)]},
+        {'t': [('a', 'c'), (1, 2)]},  # renamed column
+        {'t': [('a', 'c'), (1, 2)], 'empty': [('x',)]},  # extra empty table
+        {'t': [('a', 'c'), (1, 2)]},  # dropped empty table
+        {'t': [('a', 'c'), (1, 2), (3, 4)]},
+        {'t': [('a', 'c'), (1, 2), (3, 4), (5, 6)]},
+    ]
+    spaths = [_dict2db(sd, to=tmp_path / f'schema{i}.db') for i, sd in enumerate(sds)]
+
+    class SchemaNormaliser(SqliteNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+    def pruned(Normaliser: type[SqliteNormaliser]) -> list[Path]:
+        return [i.path for i in compute_instructions(spaths, Normaliser=Normaliser, threads=None) if isinstance(i, Prune)]
+
+    tpruned = pruned(SchemaNormaliser)
+    assert spaths[0] not in tpruned  # column was renamed
+    assert spaths[4] in tpruned  # only rows were added around it
+
+    class SchemaColumnarNormaliser(SchemaNormaliser):
+        COLUMNAR = True
+
+    assert pruned(SchemaColumnarNormaliser) == tpruned
+
+
 # TODO add some tests for my own dbs? e.g. stashed
 
 class SqliteNormaliser(BaseNormaliser):
@@ -261,6 +483,21 @@ class SqliteNormaliser(BaseNormaliser):
 
     ALLOWED_BLOBS: AllowedBlobs = set()
 
+    # if > 1, each table is dumped & sorted separately, in parallel, and then the results are merged
+    # worth it for huge databases, otherwise the single .dump + sort is the slowest part of normalising
+    DUMP_WORKERS: ClassVar[int] = 1
+
+    # if True, emits a shard per table instead of a single dump (see core/shards.py)
+    # then tables that didn't change are skipped during comparisons
+    SHARDED: ClassVar[bool] = False
+
+    # if True, emits a Parquet file with a row per table row instead of a text dump (see core/columnar.py), requires pyarrow
+    # then there is no need to sort, and comparisons work on row hashes
+    COLUMNAR: ClassVar[bool] = False
+
+    # most of the time is spent in sqlite3 queries/dump and sort/diff, all of them release the GIL
+    EXECUTOR = 'thread'
+
     @classmethod
     def checked(cls, db: Path) -> Path:
         """common schema checks (for both cleanup/extract)"""
@@ -301,7 +538,8 @@ class SqliteNormaliser(BaseNormaliser):
         unique_tmp_dir = cleaned_db.parent
 
         from bleanser.core.ext.sqlite_dumben import run as dumben
-        dumben(db=upath, output=cleaned_db, output_as_db=True)
+        with stage('dumben'):
+            dumben(db=upath, output=cleaned_db, output_as_db=True)
 
         # eh.. not sure if really necessary
         # but we don't wanna check for blobs yet, better to do this after the cleanup
@@ -323,7 +561,8 @@ class SqliteNormaliser(BaseNormaliser):
 
             # cleanup might take a bit of time, especially with UPDATE statements
             # but probably unavoidable?
-            self.cleanup(conn)
+            with stage('cleanup'):
+                self.cleanup(conn)
 
             # for possible later use
             master_info = tool.get_sqlite_master()
@@ -334,30 +573,41 @@ class SqliteNormaliser(BaseNormaliser):
         ## prepare a fake path for dump, just to preserve original file paths at least to some extent
         dump_file = unique_tmp_dir / 'dump.sql'
 
+        tables = [name for name, type_ in master_info.items() if type_ == 'table']
+        if self.COLUMNAR:
+            with stage('dump'):
+                cfile = _dump_columnar(cleaned_db, tables=tables, to=unique_tmp_dir / ('dump' + columnar.SUFFIX))
+            cleaned_db.unlink()
+            yield cfile
+            return
+        if self.SHARDED:
+            sharded = unique_tmp_dir / 'dump'
+            with stage('dump'):
+                sfiles = _dump_shards(cleaned_db, tables=tables, odir=sharded, workers=self.DUMP_WORKERS)
+                shards.finalise(sharded, sfiles, presorted=True)
+            cleaned_db.unlink()
+            yield sharded
+            return
+
+        if self.DUMP_WORKERS > 1 and len(tables) > 1:
+            shards_dir = unique_tmp_dir / 'shards'
+            with stage('dump'):
+                sfiles = _dump_shards(cleaned_db, tables=tables, odir=shards_dir, workers=self.DUMP_WORKERS)
+                # shards are already sorted, so just need to merge
+                get_sort_binary().bound_command('--merge', '-o', str(dump_file), *map(str, sfiles.values()))()
+            shutil.rmtree(shards_dir)
+            cleaned_db.unlink()
+            yield dump_file
+            return
+
         # dumping also takes a bit of time for big databases...
-        dump_cmd = sqlite_cmd['-readonly', f'file://{cleaned_db}?immutable=1', '.dump']
+        dump_cmd = get_sqlite_binary()['-readonly', f'file://{cleaned_db}?immutable=1', '.dump']
         cmd = dump_cmd > str(dump_file)
-        cmd()
+        with stage('dump'):
+            cmd()
 
-        ## one issue is that .dump dumps sometimes text columns as hex-encoded and prefixed with X
-        ## this makes sense if you're using .dump output to create another db
-        ## but in our case makes diffs very cryptic
         dump_file_nohex = unique_tmp_dir / 'dump_nohex.sql'
-        # TODO hmm this might break if it's a legit binary BLOB?
-        with dump_file.open('rb') as fi, dump_file_nohex.open('wb') as fo:
-            for line in fi:
-                assert line.endswith(b'\n')
-                # fixme need to find all in case of multiple hex columns
-                m = re.search(b"X'([0-9a-f]*)'", line)
-                if m is not None:
-                    hh = m.group(1).decode('utf8')
-                    ss = bytes.fromhex(hh)
-                    if len(ss) > 0 and ss[0] == b'{' and ss[-1] == b'}':  # type: ignore[comparison-overlap]
-                        # json-ish
-                        # replace newlines just in case, otherwise it might mangle the sorting
-                        ss = re.sub(rb'(\r\n|\r|\n)', b'<NEWLINE>', ss)
-                        line = line[:m.start(1)] + ss + line[m.end(1):]
-                fo.write(line)
+        _unhex(dump_file, to=dump_file_nohex)
         # TODO maybe only do it in diff mode? not sure
         shutil.move(str(dump_file_nohex), str(dump_file))
         ##
@@ -371,7 +621,7 @@ class SqliteNormaliser(BaseNormaliser):
         # - replace \n in output with space or something
         # - replace the -newline symbol with actual \n
         # for table in master_info:
-        #     query_cmd = sqlite_cmd['-readonly', f'file://{cleaned_db}?immutable=1', f'SELECT "{table}", * FROM `{table}`']
+        #     query_cmd = get_sqlite_binary()['-readonly', f'file://{cleaned_db}?immutable=1', f'SELECT "{table}", * FROM `{table}`']
         #     cmd = query_cmd >> str(dump_file)
         #     cmd()
 
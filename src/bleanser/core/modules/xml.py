@@ -1,9 +1,10 @@
+from __future__ import annotations
+
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterator
-
-from lxml import etree
+from typing import TYPE_CHECKING, Iterator
 
+from bleanser.core.instrument import stage
 from bleanser.core.processor import (
     BaseNormaliser,
     Normalised,
@@ -11,6 +12,9 @@ from bleanser.core.processor import (
     unique_file_in_tempdir,
 )
 
+if TYPE_CHECKING:
+    from lxml import etree
+
 
 class Normaliser(BaseNormaliser):
     PRUNE_DOMINATED = False
@@ -20,6 +24,8 @@ class Normaliser(BaseNormaliser):
 
     @contextmanager
     def normalise(self, *, path: Path) -> Iterator[Normalised]:
+        from lxml import etree
+
         # todo not sure if need to release some resources here...
         parser = etree.XMLParser(remove_blank_text=True)
         # TODO we seem to lose comments here... meh
@@ -31,7 +37,8 @@ class Normaliser(BaseNormaliser):
             assert c.tail is None, c.tail
             c.tail = '\n'
 
-        et = self.cleanup(et)
+        with stage('cleanup'):
+            et = self.cleanup(et)
 
         cleaned = unique_file_in_tempdir(input_filepath=path, dir=self.tmp_dir, suffix='.xml')
         cleaned.write_text(etree.tounicode(et))
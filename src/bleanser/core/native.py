@@ -0,0 +1,158 @@
+"""
+In-process comparisons of normalised (sorted) files, working directly over mmap-ed buffers
+
+Compared to diff/cmp this saves a fork per comparison, doesn't keep whole files in memory (only the current line),
+and can bail out early at the first missing line.
+
+NOTE: relies on files being sorted bytewise, i.e. with LC_ALL=C (see get_sort_binary/sort_file)
+If they aren't, is_subset might return false negatives -- which is safe, it just means files won't be pruned
+"""
+
+from __future__ import annotations
+
+import mmap
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Union
+
+Buffer = Union[mmap.mmap, bytes]
+
+
+@contextmanager
+def mapped(path: Path) -> Iterator[Buffer]:
+    with path.open('rb') as fo:
+        # can't mmap empty files
+        if path.stat().st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def issame(lfile: Path, rfile: Path) -> bool:
+    if lfile.stat().st_size != rfile.stat().st_size:
+        return False
+    chunk = 1 << 20
+    with mapped(lfile) as lbuf, mapped(rfile) as rbuf:
+        for i in range(0, len(lbuf), chunk):
+            if lbuf[i: i + chunk] != rbuf[i: i + chunk]:
+                return False
+    return True
+
+
+def is_subset(lfile: Path, rfile: Path) -> bool:
+    '''
+    Checks that every line in lfile is present in rfile (both are expected to be sorted)
+    Equivalent to diff not emitting any '<' lines
+    '''
+    with mapped(lfile) as lbuf, mapped(rfile) as rbuf:
+        return _is_subset(lbuf, rbuf)
+
+
+_MIN_BLOCK = 256
+_MAX_BLOCK = 1 << 20
+
+
+def _is_subset(lbuf: Buffer, rbuf: Buffer) -> bool:
+    ln = len(lbuf)
+    rn = len(rbuf)
+    lfind = lbuf.find
+    rfind = rbuf.find
+    i = 0
+    j = 0
+
+    # fast path: successive backups are mostly the same, so try skipping long identical runs in one go
+    # block size adapts: grows while the files are identical, and shrinks after it hits a difference
+    block = 4096
+    no_fast_until = 0
+
+    while i < ln:
+        if i >= no_fast_until:
+            lblock = lbuf[i: i + block]
+            if lblock == rbuf[j: j + block]:
+                nl = lblock.rfind(b'\n')
+                if nl != -1:
+                    # advance to the last complete line within the block
+                    i += nl + 1
+                    j += nl + 1
+                    block = min(block * 2, _MAX_BLOCK)
+                    continue
+            block = max(block // 4, _MIN_BLOCK)
+            no_fast_until = i + _MIN_BLOCK
+
+        # slow path: merge scan line by line
+        ie = lfind(b'\n', i)
+        if ie == -1:
+            ie = ln
+        lline = lbuf[i: ie]
+        while True:
+            if j >= rn:
+                return False
+            je = rfind(b'\n', j)
+            if je == -1:
+                je = rn
+            rline = rbuf[j: je]
+            j = je + 1
+            if rline == lline:
+                break
+            if rline > lline:
+                # went past the position where lline would be
+                return False
+        i = ie + 1
+    return True
+
+
+def test_is_subset(tmp_path: Path) -> None:
+    def write(name: str, lines: list[str], *, newline: bool = True) -> Path:
+        p = tmp_path / name
+        data = '\n'.join(lines)
+        if newline and len(lines) > 0:
+            data += '\n'
+        p.write_text(data)
+        return p
+
+    empty = write('empty', [])
+    abc = write('abc', ['a', 'b', 'c'])
+    ac = write('ac', ['a', 'c'])
+    bd = write('bd', ['b', 'd'])
+    abc_nonl = write('abc_nonl', ['a', 'b', 'c'], newline=False)
+    # line prefixes shouldn't match
+    a_prefix = write('a_prefix', ['aa', 'b', 'c'])
+
+    assert is_subset(empty, empty)
+    assert is_subset(empty, abc)
+    assert not is_subset(abc, empty)
+    assert is_subset(ac, abc)
+    assert not is_subset(abc, ac)
+    assert not is_subset(bd, abc)
+    assert is_subset(abc, abc)
+    assert is_subset(abc, abc_nonl)
+    assert is_subset(abc_nonl, abc)
+    assert not is_subset(abc, a_prefix)
+    assert not is_subset(a_prefix, abc)
+
+    # exercise the fast path/block size adaptation on bigger files
+    base = [f'line {i:06d}' for i in range(20000)]
+    extra = sorted({*base, *(f'line {i:06d}x' for i in range(0, 20000, 997))})
+    big = write('big', base)
+    bigger = write('bigger', extra)
+    assert is_subset(big, bigger)
+    assert not is_subset(bigger, big)
+    missing = write('missing', [l for l in base if l != 'line 019999'])
+    assert not is_subset(big, missing)
+    assert is_subset(missing, big)
+
+
+def test_issame(tmp_path: Path) -> None:
+    a = tmp_path / 'a'
+    b = tmp_path / 'b'
+    c = tmp_path / 'c'
+    e = tmp_path / 'e'
+    a.write_text('a\nb\n')
+    b.write_text('a\nb\n')
+    c.write_text('a\nc\n')
+    e.touch()
+    assert issame(a, b)
+    assert not issame(a, c)
+    assert not issame(a, e)
+    assert issame(e, e)
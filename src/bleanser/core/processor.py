@@ -2,34 +2,38 @@ from __future__ import annotations
 
 import inspect
 import os
+import queue
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import warnings
-from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
-from functools import lru_cache
+from functools import lru_cache, partial
 from pathlib import Path
 from subprocess import check_call
 from tempfile import NamedTemporaryFile, TemporaryDirectory, gettempdir
-from time import time
+from time import sleep, time
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     ClassVar,
+    Generator,
     Iterable,
     Iterator,
+    Literal,
+    Mapping,
     NoReturn,
     Sequence,
+    Sized,
     Union,
 )
 
-import more_itertools
-from kompress import CPath, is_compressed
-from plumbum import local  # type: ignore
-
+from . import columnar, ingest, instrument, native, shards, ztmp
 from .common import (
     Dry,
     Group,
@@ -37,6 +41,8 @@ from .common import (
     Keep,
     Mode,
     Move,
+    PackedGroup,
+    PathTable,
     Prune,
     Remove,
     divide_by_size,
@@ -45,6 +51,8 @@ from .common import (
 )
 from .compat import Self
 from .ext.dummy_executor import DummyExecutor
+from .instrument import stage
+from .sketch import Sketch, all_lines_in, line_hashes, strong_line_hashes
 from .utils import total_dir_size
 
 
@@ -84,10 +92,23 @@ def unique_file_in_tempdir(*, input_filepath: Path, dir: Path, suffix: str | Non
     return cleaned_path
 
 
+# more chunks than workers, so a worker that finished early picks up the next pending chunk (the pool hands them out
+# as workers free up) rather than idling while some chunk with a slow file is still running
+# groups spanning chunk boundaries are stitched back (see _compute_groups), but that means redoing some work -- hence not too many
+_CHUNKS_PER_WORKER = 4
+# and not splitting into extra chunks smaller than this, otherwise most of the work would be stitching
+_MIN_CHUNK_FILES = 10
+
+
+# NOTE: using C locale so lines are sorted bytewise -- it's faster, and native comparisons rely on it
+_SORT_ENV = {'LC_ALL': 'C'}
+
+
 # meh... see Fileset._union
 # this gives it a bit of a speedup when comparing
 def sort_file(filepath: str | Path) -> None:
-    check_call(['sort', '-o', str(filepath), str(filepath)])
+    with stage('sort'):
+        check_call(['sort', '-o', str(filepath), str(filepath)], env={**os.environ, **_SORT_ENV})
 
 
 Input = Path
@@ -95,16 +116,37 @@ Normalised = Path
 
 _FILTER_ALL_ADDED = '> '
 
+# process: workers are separate processes, so python code runs in parallel
+# thread : much cheaper per task (no pickling, no imports & libmagic init in each worker, warm caches are shared),
+#   but python code is serialized by the GIL, so only makes sense if most time is spent in subprocesses (e.g. sqlite3/sort/diff)
+ExecutorKind = Literal['thread', 'process']
+
 
 class BaseNormaliser:
     ## user overridable configs
     PRUNE_DOMINATED: ClassVar[bool] = False
     MULTIWAY: ClassVar[bool] = False
+    # keep normalised files & merged filesets zstd-compressed: trades some cpu for much less temporary disk space
+    COMPRESS_TMP: ClassVar[bool] = False
+    # what sort of workers to use with --threads (see ExecutorKind), can be overridden with --executor
+    EXECUTOR: ClassVar[ExecutorKind] = 'process'
+    # normalise up to this many files ahead in a background thread, so it overlaps with comparing the current ones
+    # normalisers & comparisons are mostly waiting on subprocesses (e.g. sqlite3/sort/diff), so they don't fight over the GIL much
+    # costs extra temporary disk space for the normalised files computed in advance
+    PREFETCH: ClassVar[int] = 0
     ##
 
     # todo maybe get rid of it? might be overridden by subclasses but probs. shouldn't
     _DIFF_FILTER: ClassVar[str | None] = _FILTER_ALL_ADDED
 
+    # in two-way mode, compute a small sketch for each normalised file, which can quickly prove that files are different
+    # without merging & comparing them. Costs an extra pass over each normalised file, so could be disabled if it doesn't help
+    _SKETCH_PRESCREEN: ClassVar[bool] = True
+
+    # in multiway mode, keep hashes of all lines of each normalised file, to quickly rule out pivots that can't contain all items
+    # memory use is proportional to the normalised file size, but only hashes for a few files are kept at a time
+    _PIVOT_FILTER: ClassVar[bool] = True
+
     def __init__(self, *, original: Input, base_tmp_dir: Path) -> None:
         ## some sanity checks just in case
         assert original.is_absolute(), original
@@ -168,7 +210,9 @@ class BaseNormaliser:
         self.tmp_dir.mkdir(parents=True)
         try:
             # FIXME write a test for compressed stuff
-            with self.unpacked(path=self.original, wdir=self.tmp_dir) as unpacked:
+            with ExitStack() as stack:
+                with stage('unpack', self.original):
+                    unpacked = stack.enter_context(self.unpacked(path=self.original, wdir=self.tmp_dir))
                 ## backwards compatibility -- do_cleanup used to take input path and tmp dir
                 do_cleanup = getattr(self, 'do_cleanup', None)
                 if do_cleanup is None:
@@ -203,6 +247,8 @@ class BaseNormaliser:
 
         Then, in do_normalise, it uses the unpacked/extracted file from here
         '''
+        from kompress import CPath, is_compressed
+
         if not is_compressed(path):
             # if not compressed, no need to create copies
             yield path
@@ -234,19 +280,65 @@ def compute_groups(
     *,
     Normaliser: type[BaseNormaliser],
     threads: int | None = None,
+    checkpoint: Path | None = None,
+    weights: Mapping[Path, float] | None = None,
+    executor: ExecutorKind | None = None,
+) -> Iterator[Group]:
+    '''
+    checkpoint: file to save emitted groups into as we go
+        if it already exists, groups from it are reused, and only the unfinished part is processed (see prune --resume)
+    weights: how much work each file is, for balancing the chunks between workers (see divide_by_size)
+    executor: whether workers are threads or processes, by default Normaliser.EXECUTOR
+    '''
+    if checkpoint is None:
+        yield from _compute_groups(paths, Normaliser=Normaliser, threads=threads, weights=weights, executor=executor)
+        return
+
+    from .state import Checkpoint
+
+    cp = Checkpoint(checkpoint, Normaliser=Normaliser)
+    (done, todo) = cp.load(paths)
+    with cp.writer(done) as add:
+        yield from done
+        if len(todo) == 0:
+            return
+        for g in _compute_groups(todo, Normaliser=Normaliser, threads=threads, weights=weights, executor=executor):
+            add(g)
+            yield g
+
+
+def _make_pool(*, threads: int | None, kind: ExecutorKind) -> Executor:
+    if threads is None:
+        return DummyExecutor()
+    if kind == 'thread':
+        # NOTE: ThreadPoolExecutor defaults to more workers than cpus, but keeping it consistent with processes
+        return ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) if threads == 0 else threads)
+    return ProcessPoolExecutor(max_workers=None if threads == 0 else threads, initializer=instrument.init_worker)
+
+
+def _compute_groups(
+    paths: Sequence[Path],
+    *,
+    Normaliser: type[BaseNormaliser],
+    threads: int | None,
+    weights: Mapping[Path, float] | None,
+    executor: ExecutorKind | None,
 ) -> Iterator[Group]:
     assert len(paths) == len(set(paths)), paths  # just in case
     assert len(paths) > 0 # just in case
 
-    pool = DummyExecutor() if threads is None else ProcessPoolExecutor(max_workers=None if threads == 0 else threads)
+    kind = Normaliser.EXECUTOR if executor is None else executor
+    pool = _make_pool(threads=threads, kind=kind)
     with pool, bleanser_tmp_directory() as base_tmp_dir:
         workers = getattr(pool, '_max_workers')
         workers = min(workers, len(paths))  # no point in using too many workers
-        logger.info('using %d workers', workers)
+        # with a single worker there is nobody to pick up the remaining work, so no point splitting
+        nchunks = 1 if workers == 1 else max(workers, min(workers * _CHUNKS_PER_WORKER, len(paths) // _MIN_CHUNK_FILES))
+        logger.info('using %d workers (%s), %d chunks', workers, 'serial' if threads is None else kind, nchunks)
 
         chunks = []
         futures: list[Future] = []
-        for paths_chunk in divide_by_size(buckets=workers, paths=paths):
+        for paths_chunk in divide_by_size(buckets=nchunks, paths=paths, weights=weights):
             pp = list(paths_chunk)
             if len(pp) == 0:
                 continue
@@ -254,10 +346,11 @@ def compute_groups(
             # force iterator if we're using more than one thread
             # otherwise it'll still be basically serial execution
             # in addition, multiprocess would fail to pickle returned iterator
-            func: Callable[..., Iterable[Group]]
+            # (thread pool doesn't need packing, but it's cheap, so keeping the same code path for both)
+            func: Callable[..., Iterable[Group | PackedGroup]]
             # note: separate declaration and if statement makes mypy happy
             if threads is not None:
-                func = _compute_groups_serial_as_list
+                func = partial(_compute_groups_serial_as_list, chunk=len(futures))
             else:
                 func = _compute_groups_serial
             futures.append(
@@ -268,27 +361,133 @@ def compute_groups(
                     base_tmp_dir=base_tmp_dir,
                 )
             )
+        def result(ci: int) -> Iterable[Group]:
+            with stage('wait', chunk=ci):
+                rit = futures[ci].result()
+            if threads is not None:
+                rit = map(PathTable(chunks[ci]).unpack, rit)
+            return rit
+
         emitted: set[Path] = set()
-        for chunk, f in zip(chunks, futures):
-            last = chunk[0]
-            rit = f.result()
-            for r in rit:
-                emitted |= set(r.items)
-                yield r
+        if len(chunks) == 1:
+            # nothing to stitch, so can keep it lazy
+            rgroups = result(0)
+        else:
+            rgroups = _stitched(paths, chunks=chunks, result=result, Normaliser=Normaliser, base_tmp_dir=base_tmp_dir)
+        for r in rgroups:
+            emitted |= set(r.items)
+            yield r
     assert emitted == set(paths), (paths, emitted)  # just in case
 
 
+def _next_start(g: Group, *, index: Mapping[Path, int]) -> int:
+    '''
+    Position of the next group, same as _compute_groups_serial advances 'left' after emitting the group
+    '''
+    last = index[g.items[-1]]
+    # with two pivots, the right pivot is also the left pivot of the next group
+    return last if len(g.pivots) == 2 else last + 1
+
+
+def _stitched(
+    paths: Sequence[Path],
+    *,
+    chunks: Sequence[Sequence[Path]],
+    result: Callable[[int], Iterable[Group]],
+    Normaliser: type[BaseNormaliser],
+    base_tmp_dir: Path,
+) -> Iterator[Group]:
+    '''
+    Groups from independently processed chunks, combined so they are the same as if all paths were processed serially
+
+    Serial processing only depends on the position where the current group starts, so groups of a chunk match
+    as long as the chunk starts where some group starts -- except for the last group of the chunk, which is cut short at the chunk end.
+    So in that case we redo the cut group serially, until the groups line up with some chunk again (normally right after the boundary).
+    '''
+    index = {p: i for i, p in enumerate(paths)}
+    offsets: list[int] = []
+    offset = 0
+    for c in chunks:
+        offsets.append(offset)
+        offset += len(c)
+    assert offset == len(paths), (offset, len(paths))
+
+    # NOTE: waiting on the chunks in path order is fine, the later chunks keep getting processed in the meantime
+    cgroups: dict[int, list[Group]] = {}
+    cstarts: dict[int, list[int]] = {}
+
+    def load(ci: int) -> None:
+        if ci in cgroups:
+            return
+        groups = list(result(ci))
+        cgroups[ci] = groups
+        cstarts[ci] = [offsets[ci]] + [_next_start(g, index=index) for g in groups[:-1]]
+
+    def lined_up(pos: int, ci: int) -> bool:
+        load(ci)
+        starts = cstarts[ci]
+        # last group of a chunk is cut short (unless it's the last chunk), so no point switching to it
+        return pos in starts and (pos != starts[-1] or ci == len(chunks) - 1)
+
+    pos = 0  # where the next group starts
+    ci = 0
+    while ci < len(chunks):
+        if lined_up(pos, ci):
+            i = cstarts[ci].index(pos)
+            groups = cgroups.pop(ci)
+            if ci == len(chunks) - 1:
+                yield from groups[i:]
+            else:
+                yield from groups[i: -1]
+                pos = cstarts[ci][-1]
+            ci += 1
+            continue
+
+        # a group spans the chunk boundary, so redoing it serially
+        logger.debug('stitching chunks from %s', paths[pos])
+        serial = _compute_groups_serial(paths[pos:], Normaliser=Normaliser, base_tmp_dir=base_tmp_dir)
+        try:
+            while True:
+                with stage('stitch', paths[pos]):
+                    g = next(serial)
+                yield g
+                if g.items[-1] == paths[-1]:
+                    return
+                pos = _next_start(g, index=index)
+                # chunk where the next group starts
+                nci = max(i for i, o in enumerate(offsets) if o <= pos)
+                for i in range(ci, nci):
+                    cgroups.pop(i, None)  # superseded
+                ci = nci
+                if lined_up(pos, ci):
+                    break
+        finally:
+            serial.close()
+
+
+# NOTE: plumbum takes a while to import, so keeping it lazy (and same for other heavy deps)
+# otherwise it adds up to startup time if bleanser is called often, e.g. from cron
+
 @lru_cache(1)
 def get_diff_binary():
+    from plumbum import local
+
     diff = local['diff']
     version = diff['--version']()
     assert 'GNU' in version, (version, "GNU diff isn't detected, make sure to run 'brew install diffutils' if you are on OSX")
     return diff
 
 
-grep = local['grep']
-cmp_cmd = local['cmp']
-sort = local['sort']
+@lru_cache(1)
+def get_grep_binary():
+    from plumbum import local
+    return local['grep']
+
+
+@lru_cache(1)
+def get_sort_binary():
+    from plumbum import local
+    return local['sort'].with_env(**_SORT_ENV)
 
 # ok so there is no time difference if using special diff line format
 # $ hyperfine -i -- 'diff --new-line-format="> %L" --old-line-format="" --unchanged-line-format="" tmp/lastfm_2017-08-29_sorted tmp/lastfm_2017-09-01_sorted'
@@ -315,13 +514,13 @@ def do_diff(lfile: Path, rfile: Path, *, diff_filter: str | None) -> list[str]:
         assert diff_filter.strip() != '', diff_filter
 
         # shortcut...
-        if diff_filter == '> ':
+        if diff_filter == _FILTER_ALL_ADDED:
             # TODO wtf?? is plumbum messing with "" escaping or something??
             # passing '--old-line-format="< %L"' ended up in extra double quotes emitted
             dcmd = dcmd['--new-line-format=', '--unchanged-line-format=', '--old-line-format=< %L']
             filter_crap = False
         else:
-            dcmd = dcmd | grep['-vE', '^' + diff_filter]
+            dcmd = dcmd | get_grep_binary()['-vE', '^' + diff_filter]
     diff_lines = dcmd(retcode=(0, 1))
 
     # FIXME move splitlines under print_diff and len() check
@@ -352,31 +551,72 @@ def do_diff(lfile: Path, rfile: Path, *, diff_filter: str | None) -> list[str]:
 # TODO shit. it has to own tmp dir...
 # we do need a temporary copy after all?
 class FileSet:
-    def __init__(self, items: Sequence[Path]=(), *, wdir: Path) -> None:
+    def __init__(self, items: Sequence[Path]=(), *, wdir: Path, compress: bool = False) -> None:
+        '''
+        compress: keep merged file compressed (see ztmp.py)
+        '''
         self.wdir = wdir
+        self.compress = compress
         self.items: list[Path] = []
-        tfile = NamedTemporaryFile(dir=self.wdir, delete=False)
+        tfile = NamedTemporaryFile(dir=self.wdir, delete=False, suffix=ztmp.SUFFIX if compress else None)
         self.merged = Path(tfile.name)
         self._union(*items)
 
-    def _copy(self) -> FileSet:
-        fs = FileSet(wdir=self.wdir)
-        fs.items = list(self.items)
-        shutil.copy(str(self.merged), str(fs.merged))
-        return fs
-
     def union(self, *paths: Path) -> FileSet:
-        u = self._copy()
-        u._union(*paths)
+        u = FileSet(wdir=self.wdir, compress=self.compress)
+        u.items = list(self.items)
+        # merging straight from our merged file, so no need to copy it first
+        u._union(*paths, src=self.merged)
         return u
 
-    def _union(self, *paths: Path) -> None:
+    def _union(self, *paths: Path, src: Path | None = None) -> None:
+        '''
+        src: merged file for the current items, by default self.merged
+        '''
+        with stage('union'):
+            self._union_aux(*paths, src=self.merged if src is None else src)
+
+    def _union_aux(self, *paths: Path, src: Path) -> None:
         extra = [p for p in paths if p not in self.items]
+        import more_itertools
+
         extra = list(more_itertools.unique_everseen(extra))
 
         if len(extra) == 0:
             # short circuit
+            if src != self.merged:
+                if src.is_dir():
+                    self.merged.unlink()
+                    shutil.copytree(src, self.merged, copy_function=shards.link)
+                else:
+                    shutil.copy(str(src), str(self.merged))
+            return
+
+        # allow it not to have merged file if set is empty
+        tomerge = ([] if len(self.items) == 0 else [src]) + extra
+
+        if self._is_columnar(extra):
+            # merged file only keeps distinct row hashes, that's all we need for comparisons
+            columnar.merge_hashes(tomerge, to=self.merged)
+            self.items.extend(extra)
             return
+        if any(columnar.is_columnar(p) for p in self.items):
+            # merged file for columnar items only has hashes, so can't be used as a source for text lines
+            tomerge = [*self.items, *extra]
+
+        sharded = [shards.is_sharded(p) for p in tomerge]
+        if all(sharded):
+            self._union_shards(tomerge)
+            self.items.extend(extra)
+            return
+
+        to_flatten = [sh or columnar.is_columnar(p) for p, sh in zip(tomerge, sharded)]
+        flattened = []
+        if any(to_flatten):
+            # meh, shouldn't normally happen unless normaliser only emits sharded/columnar output for some files
+            flattened = [self._flatten(p) for p, fl in zip(tomerge, to_flatten) if fl]
+            it = iter(flattened)
+            tomerge = [next(it) if fl else p for p, fl in zip(tomerge, to_flatten)]
 
         # todo so we could also sort individual dumps... then could use sort --merged to just merge...
         # it seems to be marginally better, like 25% maybe
@@ -392,54 +632,171 @@ class FileSet:
         # 'This file can be the same as one of the input files.'
         # https://pubs.opengroup.org/onlinepubs/9699919799/utilities/sort.html
 
-        # allow it not to have merged file if set is empty
-        tomerge = ([] if len(self.items) == 0 else [self.merged]) + extra
-
         # hmm sadly sort command doesn't detect it itself?
         # todo make less hacky... ideally the callee would maintain the sorted files
         is_sorted = []
-        for p in tomerge: # todo no need to check self.merged?
-            (rc, _, _) = sort['--check', p].run(retcode=(0, 1))
+        for p in tomerge[len(tomerge) - len(extra):]:
+            # note: no need to check src, it's the output of sort below, so always sorted
+            with ztmp.readable(p) as rp:
+                (rc, _, _) = get_sort_binary()['--check', rp].run(retcode=(0, 1))
             is_sorted.append(rc == 0)
         mflag = []
         if all(is_sorted):
             mflag = ['--merge']
 
-        # sort also has --parallel option... but pretty pointless, in most cases we'll be merging two files?
-        (sort['--unique'])(*mflag, *tomerge, '-o', self.merged)
+        with ztmp.readables(tomerge) as rtomerge:
+            # sort also has --parallel option... but pretty pointless, in most cases we'll be merging two files?
+            if self.compress:
+                (get_sort_binary().bound_command('--unique', *mflag, *rtomerge) | ztmp.compress_cmd(to=self.merged))()
+            else:
+                (get_sort_binary()['--unique'])(*mflag, *rtomerge, '-o', self.merged)
 
+        for f in flattened:
+            f.unlink()
         self.items.extend(extra)
 
+    def _union_shards(self, tomerge: Sequence[Path]) -> None:
+        # merging shard by shard, so shards that are the same in all inputs are just linked
+        import more_itertools
+
+        self.merged.unlink()
+        self.merged.mkdir()
+        manifests = [shards.read_manifest(p) for p in tomerge]
+        names = list(more_itertools.unique_everseen(name for m in manifests for name in m))
+        manifest: shards.Manifest = {}
+        for idx, name in enumerate(names):
+            inputs = [(p, m[name]) for p, m in zip(tomerge, manifests) if name in m]
+            file = f'{idx:05d}'
+            if len({sh.hash for _, sh in inputs}) == 1:
+                (p, sh) = inputs[0]
+                shards.link(p / sh.file, self.merged / file)
+                manifest[name] = shards.Shard(file=file, lines=sh.lines, hash=sh.hash)
+            else:
+                # shards are always sorted, so can just merge
+                ifiles = [str(p / sh.file) for p, sh in inputs]
+                get_sort_binary().bound_command('--unique', '--merge', '-o', str(self.merged / file), *ifiles)()
+                manifest[name] = shards.stat(self.merged, file=file)
+        shards.write_manifest(self.merged, manifest)
+
+    def _flatten(self, path: Path) -> Path:
+        tfile = NamedTemporaryFile(dir=self.wdir, delete=False)
+        if columnar.is_columnar(path):
+            return columnar.flatten([path], to=Path(tfile.name))
+        return shards.flatten(path, to=Path(tfile.name))
+
+    def _is_columnar(self, extra: Sequence[Path] = ()) -> bool:
+        '''
+        True if merged file only has row hashes (see columnar.py)
+        '''
+        items = [*self.items, *extra]
+        return len(items) > 0 and all(columnar.is_columnar(p) for p in items)
+
+    def flat(self) -> Path:
+        '''
+        Merged items as a single uncompressed file, e.g. for diffing
+        '''
+        columnar_ = self._is_columnar()
+        if not columnar_ and not self.merged.is_dir() and not ztmp.is_compressed(self.merged):
+            return self.merged
+        flat = Path(str(self.merged) + '.flat')
+        if flat.exists():
+            # merged is never modified after union, so fine to reuse
+            return flat
+        if columnar_:
+            # merged file only has hashes, so rendering the actual rows from the items
+            return columnar.flatten(self.items, to=flat)
+        if ztmp.is_compressed(self.merged):
+            return ztmp.decompress(self.merged, to=flat)
+        return shards.flatten(self.merged, to=flat)
+
+    def _file(self) -> Path:
+        # for comparisons we don't want to decompress, ztmp can handle compressed files
+        return self.flat() if self.merged.is_dir() or self._is_columnar() else self.merged
+
     def issame(self, other: FileSet) -> bool:
-        lfile = self.merged
-        rfile = other.merged
-        # TODO meh. maybe get rid of cmp, it's not really faster
-        # even on exactly same file (copy) it seemed to be slower
-        # https://unix.stackexchange.com/questions/153286/is-cmp-faster-than-diff-q
-        (rc, _, _) = cmp_cmd['--silent', lfile, rfile].run(retcode=(0, 1))
-        return rc == 0
+        with stage('same'):
+            return self._issame(other)
+
+    def _issame(self, other: FileSet) -> bool:
+        if self._is_columnar() and other._is_columnar():
+            return columnar.issame(self.merged, other.merged)
+        lsharded = self.merged.is_dir()
+        rsharded = other.merged.is_dir()
+        if lsharded and rsharded:
+            # shards are deduplicated, so same hashes mean same sets of lines
+            lm = shards.read_manifest(self.merged)
+            rm = shards.read_manifest(other.merged)
+            return {n: s.hash for n, s in lm.items()} == {n: s.hash for n, s in rm.items()}
+        lfile = self._file()
+        rfile = other._file()
+        if ztmp.is_compressed(lfile) or ztmp.is_compressed(rfile):
+            return ztmp.issame(lfile, rfile)
+        # compares sizes first and mmaps otherwise, so no need to fork cmp
+        return native.issame(lfile, rfile)
 
     def issubset(self, other: FileSet, *, diff_filter: str | None) -> bool:
+        with stage('subset'):
+            return self._issubset(other, diff_filter=diff_filter)
+
+    def _issubset(self, other: FileSet, *, diff_filter: str | None) -> bool:
         # short circuit
         # this doesn't really speed up much though? so guess better to keep the code more uniform..
         # if set(self.items) <= set(other.items):
         #     return True
-        lfile = self.merged
-        rfile = other.merged
+        if self.merged.is_dir() and other.merged.is_dir():
+            return self._issubset_shards(other, diff_filter=diff_filter)
+        if diff_filter == _FILTER_ALL_ADDED and self._is_columnar() and other._is_columnar():
+            # custom filters need the actual lines, so these go through the usual diff on rendered rows
+            return columnar.is_subset(self.merged, other.merged)
+
+        lfile = self._file()
+        rfile = other._file()
+        compressed = ztmp.is_compressed(lfile) or ztmp.is_compressed(rfile)
         # upd: hmm, this function is actually super fast... guess diff is quite a bit optimized
 
         # TODO tbh should just use cmp/comm for the rest... considering it's all sorted
         # first check if they are identical (should be super fast, stops at the first byte difference)
         # TODO this is more or less usefless ATM.. because files in fileset are always different
-        (rc, _, _) = cmp_cmd['--silent', lfile, rfile].run(retcode=(0, 1))
-        if rc == 0:
+        # (for compressed files it's not cheap at all, so skipping)
+        if not compressed and native.issame(lfile, rfile):
             return True
 
-        remaining = do_diff(lfile, rfile, diff_filter=diff_filter)
+        if diff_filter == _FILTER_ALL_ADDED:
+            if compressed:
+                return ztmp.is_subset(lfile, rfile, env=_SORT_ENV)
+            # most common case, so worth doing in-process without spawning diff
+            # merged files are sorted, so we can just do a merge scan over them, and bail early on the first missing line
+            return native.is_subset(lfile, rfile)
+
+        with ztmp.readables([lfile, rfile]) as (rlfile, rrfile):
+            remaining = do_diff(rlfile, rrfile, diff_filter=diff_filter)
         # TODO maybe log verbose differences to a file?
         return len(remaining) == 0
         # TODO could return diff...
 
+    def _issubset_shards(self, other: FileSet, *, diff_filter: str | None) -> bool:
+        lm = shards.read_manifest(self.merged)
+        rm = shards.read_manifest(other.merged)
+        # lines always end up in the same shard, so can compare shard by shard
+        for name, lsh in lm.items():
+            if lsh.lines == 0:
+                continue
+            rsh = rm.get(name)
+            if rsh is not None and rsh.hash == lsh.hash:
+                # unchanged, no need to compare
+                continue
+            lfile = self.merged / lsh.file
+            rfile = Path(os.devnull) if rsh is None else other.merged / rsh.file
+            if diff_filter == _FILTER_ALL_ADDED:
+                # shards are deduplicated, so if left has more lines, something is definitely missing
+                if rsh is None or lsh.lines > rsh.lines:
+                    return False
+                if not native.is_subset(lfile, rfile):
+                    return False
+            elif len(do_diff(lfile, rfile, diff_filter=diff_filter)) > 0:
+                return False
+        return True
+
     def __repr__(self) -> str:
         return repr((self.items, self.merged))
 
@@ -450,7 +807,11 @@ class FileSet:
         self.close()
 
     def close(self) -> None:
-        self.merged.unlink(missing_ok=True)
+        if self.merged.is_dir():
+            shutil.rmtree(self.merged)
+        else:
+            self.merged.unlink(missing_ok=True)
+        Path(str(self.merged) + '.flat').unlink(missing_ok=True)
 
 
 def test_fileset(tmp_path: Path) -> None:
@@ -495,62 +856,221 @@ def test_fileset(tmp_path: Path) -> None:
     fa = lines(['a'])
     fscea = fsce.union(fa)
     assert fsce.issubset(fscea, diff_filter=_FILTER_ALL_ADDED)
+    assert fscea.items == [fc, fe, fa]
+    assert fscea.merged.read_text() == 'a\nc\ne\n'
+    assert fsce.merged.read_text() == 'c\ne\n'  # shouldn't be affected by union
+
+    # should be sorted bytewise regardless of the locale
+    fmixed = FS(lines(['b', 'B', 'a', 'A', '_']))
+    assert fmixed.merged.read_text() == 'A\nB\n_\na\nb\n'
+    assert FS(lines(['a', 'B'])).issubset(fmixed, diff_filter=_FILTER_ALL_ADDED)
 
 
 # just for process pool
-def _compute_groups_serial_as_list(*args: Any, **kwargs: Any) -> Iterable[Group]:
-    return list(_compute_groups_serial(*args, **kwargs))
+def _compute_groups_serial_as_list(*, paths: Sequence[Path], chunk: int | None = None, **kwargs: Any) -> list[PackedGroup]:
+    # chunk: only used for instrumentation, so it's possible to tell which chunk a worker was processing
+    # groups are returned as indices into paths, which is way cheaper to pickle (see PathTable)
+    table = PathTable(paths)
+    with stage('chunk', chunk=chunk):
+        return [table.pack(g) for g in _compute_groups_serial(paths, **kwargs)]
 
 
 IRes = Union[Exception, Normalised]
 
 
+class _Results:
+    """
+    Normalisation results, computed lazily as they're indexed (by input position)
+
+    Unlike more_itertools.peekable, only keeps results that might still be needed (i.e. from the current group onwards).
+    Results before release() position are dropped and their normaliser contexts are exited,
+    so memory and temporary files are bounded by the window rather than the number of inputs.
+    """
+
+    def __init__(self, it: Iterator[tuple[IRes, ExitStack]]) -> None:
+        self._it = it
+        self._start = 0  # position of the first buffered result
+        self._buf: deque[tuple[IRes, ExitStack]] = deque()
+
+    def __getitem__(self, idx: int) -> IRes:
+        assert idx >= self._start, (idx, self._start)  # already released
+        while idx >= self.computed:
+            nxt = next(self._it, None)
+            if nxt is None:
+                raise IndexError(idx)
+            self._buf.append(nxt)
+        return self._buf[idx - self._start][0]
+
+    @property
+    def computed(self) -> int:
+        return self._start + len(self._buf)
+
+    def exit(self, idx: int) -> None:
+        """
+        Exits normaliser context early, while still keeping the result around
+        """
+        self._buf[idx - self._start][1].close()
+
+    def release(self, upto: int) -> list[IRes]:
+        """
+        Drops results before the position. Returns the dropped results
+        """
+        released = []
+        while self._start < upto and len(self._buf) > 0:
+            (res, ctx) = self._buf.popleft()
+            ctx.close()
+            released.append(res)
+            self._start += 1
+        return released
+
+    def close(self) -> None:
+        self.release(self.computed)
+
+
+def _prefetched(it: Iterator[tuple[IRes, ExitStack]], *, ahead: int) -> Generator[tuple[IRes, ExitStack], None, None]:
+    '''
+    Computes up to 'ahead' normalisation results in a background thread (see BaseNormaliser.PREFETCH)
+    '''
+    if ahead == 0:
+        yield from it
+        return
+
+    # taken before computing each result and given back when it's consumed, so at most 'ahead' are computed in advance
+    # otherwise a fast normaliser would fill up the temporary directory while the comparisons catch up
+    slots = threading.Semaphore(ahead)
+    results: queue.Queue[tuple[tuple[IRes, ExitStack] | None, BaseException | None]] = queue.Queue()
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            while True:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                nxt = next(it, None)
+                if nxt is None:
+                    break
+                results.put((nxt, None))
+        except BaseException as e:
+            results.put((None, e))
+        finally:
+            results.put((None, None))
+
+    thread = threading.Thread(target=produce, name='bleanser-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            (nxt, error) = results.get()
+            if error is not None:
+                raise error
+            if nxt is None:
+                return
+            slots.release()
+            yield nxt
+    finally:
+        stop.set()
+        slots.release()  # in case it's waiting for a slot
+        thread.join()
+        # results that were computed in advance, but won't be used (e.g. if the consumer bailed early)
+        while not results.empty():
+            (nxt, _) = results.get_nowait()
+            if nxt is not None:
+                nxt[1].close()
+
+
 # todo these are already normalized paths?
 # although then harder to handle exceptions... ugh
 def _compute_groups_serial(
-    paths: Sequence[Path],
+    paths: Iterable[Path],
     *,
     Normaliser: type[BaseNormaliser],
     base_tmp_dir: Path,
-) -> Iterable[Group]:
-    assert len(paths) > 0
-
+) -> Generator[Group, None, None]:
+    '''
+    paths: normally a sequence, but could also be an iterator (e.g. lazily producing new files in watch mode)
+    '''
     cleaned2orig: dict[IRes, Path] = {}
-    cleaned = []
-
-    def iter_results() -> Iterator[IRes]:
-        with ExitStack() as exit_stack:
-            for idx, input in enumerate(paths):  # noqa: A001
-                normaliser = Normaliser(original=input, base_tmp_dir=base_tmp_dir)
-
-                logger.info('processing %s (%d/%d)', input, idx, len(paths))
 
-                res: IRes
-                # ds = total_dir_size(wdir)
-                # logger.debug('total wdir(%s) size: %s', wdir, ds)
-                before = time()
-                try:
-                    res = exit_stack.enter_context(normaliser.do_normalise())
-                except Exception as e:
-                    logger.exception(e)
-                    res = e
-                after = time()
-                logger.debug('cleanup(%s): took %.2f seconds', input, after - before)
-                # TODO ugh. Exception isn't hashable in general, so at least assert to avoid ambiguity
-                # not sure what would be the proper fix...
-                assert res not in cleaned2orig, res
-                cleaned2orig[res] = input
-                cleaned.append(res)
-                yield res
+    total_str = str(len(paths)) if isinstance(paths, Sized) else '?'
+
+    def iter_results() -> Iterator[tuple[IRes, ExitStack]]:
+        for idx, input in enumerate(paths):  # noqa: A001
+            normaliser = Normaliser(original=input, base_tmp_dir=base_tmp_dir)
+
+            logger.info('processing %s (%d/%s)', input, idx, total_str)
+
+            # each result gets its own context, so it can be exited as soon as the result isn't needed
+            ctx = ExitStack()
+            res: IRes
+            # ds = total_dir_size(wdir)
+            # logger.debug('total wdir(%s) size: %s', wdir, ds)
+            before = time()
+            try:
+                with stage('normalise', input):
+                    res = ctx.enter_context(normaliser.do_normalise())
+            except Exception as e:
+                logger.exception(e)
+                res = e
+            after = time()
+            logger.debug('cleanup(%s): took %.2f seconds', input, after - before)
+            # TODO ugh. Exception isn't hashable in general, so at least assert to avoid ambiguity
+            # not sure what would be the proper fix...
+            assert res not in cleaned2orig, res
+            cleaned2orig[res] = input
+            if use_sketches and not isinstance(res, Exception):
+                with stage('sketch', input):
+                    sketches[res] = Sketch.of(res)
+            if use_hashes and not isinstance(res, Exception):
+                with stage('hashes', input):
+                    hashes[res] = line_hashes(res)
+            # NOTE: parquet is compressed already
+            if Normaliser.COMPRESS_TMP and not isinstance(res, Exception) and res != input and res.is_file() and not columnar.is_columnar(res):
+                # sketches/hashes need uncompressed data, so only compressing after computing them
+                with stage('compress', input):
+                    zres = ztmp.compress(res)
+                cleaned2orig[zres] = cleaned2orig.pop(res)
+                if res in sketches:
+                    sketches[zres] = sketches.pop(res)
+                if res in hashes:
+                    hashes[zres] = hashes.pop(res)
+                res = zres
+            yield (res, ctx)
+
+
+    # sketches are only used in two-way mode -- in multiway mode we need to compare against union of pivots
+    use_sketches = Normaliser._SKETCH_PRESCREEN and not Normaliser.MULTIWAY
+    sketches: dict[Path, Sketch] = {}
+
+    def prescreened_different(lfile: Path, rfile: Path) -> bool:
+        '''
+        True if sketches prove rfile doesn't dominate lfile, so there is no need for a full comparison
+        '''
+        if not use_sketches:
+            return False
+        lsketch = sketches[lfile]
+        rsketch = sketches[rfile]
+        if Normaliser.PRUNE_DOMINATED:
+            if Normaliser._DIFF_FILTER != _FILTER_ALL_ADDED:
+                # custom filters might ignore some of the differences
+                return False
+            return lsketch.missing_from(rsketch)
+        else:
+            return lsketch.differs(rsketch)
 
+    # in multiway mode, pivots (lpfile and right) need to contain all the items
+    # so if some item line hash isn't present in either pivot, there is no need for a full comparison
+    use_hashes = Normaliser._PIVOT_FILTER and Normaliser.MULTIWAY and Normaliser._DIFF_FILTER == _FILTER_ALL_ADDED
+    hashes: dict[Path, frozenset[int]] = {}
 
     fileset_wdir = base_tmp_dir / 'fileset'
     fileset_wdir.mkdir(parents=True, exist_ok=True)
 
     def fset(*paths: Path) -> FileSet:
-        return FileSet(paths, wdir=fileset_wdir)
+        return FileSet(paths, wdir=fileset_wdir, compress=Normaliser.COMPRESS_TMP)
 
     def unlink_tmp_output(cleaned: Path) -> None:
+        sketches.pop(cleaned, None)
+        hashes.pop(cleaned, None)
         # meh. unlink is a bit manual, but bounds the filesystem use by two dumps
         # todo maybe unlink whole tmp_dir for normaliser?
         orig = cleaned2orig[cleaned]
@@ -560,143 +1080,182 @@ def _compute_groups_serial(
         # meh... just in case
         assert str(cleaned.resolve()).startswith(str(Path(gettempdir()).resolve())), cleaned
         # todo no need to unlink in debug mode?
-        cleaned.unlink(missing_ok=True)
-
-    total = len(paths)
-
-    # ok. this is a bit hacky
-    # ... but making it properly iterative would be complicated and error prone
-    # since sometimes we do need lookahead (for right + 1)
-    # so using peekable seems like a good compromise
-    ires = more_itertools.peekable(iter_results())
-    # it would be nice to also release older iterator entries (calling next())
-    # but it seems to change indexing... so a bit of a mess.
-
-    ires[0] # ugh. a bit crap, but we're nudging it to initialize wdir...
-
+        if cleaned.is_dir():
+            # sharded output
+            shutil.rmtree(cleaned)
+        else:
+            cleaned.unlink(missing_ok=True)
+
+    # making it properly iterative would be complicated and error prone
+    # since sometimes we do need lookahead (for right + 1), so indexing into a sliding window of results
+    prefetched = _prefetched(iter_results(), ahead=Normaliser.PREFETCH)
+    ires = _Results(prefetched)
+
+    def release(upto: int) -> None:
+        for res in ires.release(upto):
+            if not isinstance(res, Exception):
+                # might be already gone if it was unlinked
+                sketches.pop(res, None)
+                hashes.pop(res, None)
+            del cleaned2orig[res]
+
+    def has(idx: int) -> bool:
+        # note: this might block if paths is lazy (e.g. waiting for new files in watch mode)
+        try:
+            ires[idx]
+        except IndexError:
+            return False
+        return True
 
-    left  = 0
     # empty fileset is easier than optional
     items = fset()
-    while left < total:
-        lfile = ires[left]
-
-        if isinstance(lfile, Exception):
-            # todo ugh... why are we using exception as a dict index??
-            yield Group(
-                items =[cleaned2orig[lfile]],
-                pivots=[cleaned2orig[lfile]],
-                error=True,
-            )
-            left += 1
-            continue
-
-        items.close()
-        items = fset(lfile)
-
-        lpivot = left
-        lpfile = lfile
-
-        rpivot = left
-        rpfile = lfile
-        # invaraint
-        # - items, lpivot, rpivot are all valid
-        # - sets corresponding to lpivot + rpivot contain all of 'items'
-        # next we attempt to
-        # - rpivot: hopefully advance as much as possible
-        # - items : expand to include as much as possible
-
-        right = left + 1
-        while True:
-            with ExitStack() as rstack:
-                pivots = rstack.enter_context(fset(lpfile, rpfile))
-
-                def group(*, rm_last: bool) -> Group:
-                    gitems = items.items
-                    citems = [cleaned2orig[i] for i in gitems]
-                    cpivots = [cleaned2orig[i] for i in pivots.items]
-                    g =  Group(
-                        items =citems,
-                        pivots=cpivots,
-                        error=False,
-                    )
-                    logger.debug('emitting group pivoted on %s, size %d', list(map(str, cpivots)), len(citems))
-                    to_unlink = gitems[: len(gitems) if rm_last else -1]
-                    for i in to_unlink:
-                        unlink_tmp_output(i)
-                    return g
-
-                if right == total:
-                    # end of sequence, so the whole tail is in the same group
-                    left = total
-                    yield group(rm_last=True)
-                    break
-
-                # else try to advance right while maintaining invariants
-                right_res = ires[right]
-
-                next_state: tuple[FileSet, Path] | None
-                if isinstance(right_res, Exception):
-                    # short circuit... error itself will be handled when right_res is the leftmost element
-                    next_state = None
-                else:
-                    nitems  = items.union(right_res)
-
-                    if Normaliser.MULTIWAY:
-                        # otherwise doesn't make sense?
-                        assert Normaliser.PRUNE_DOMINATED
-
-                        # in multiway mode we check if the boundaries (pivots) contain the rest
-                        npivots = rstack.enter_context(fset(lpfile, right_res))
-                        dominated = nitems.issubset(npivots, diff_filter=Normaliser._DIFF_FILTER)
-                    else:
-                        # in two-way mode we check if successive paths include each other
-                        before_right = nitems.items[-2]
-                        s1 = rstack.enter_context(fset(before_right))
-                        s2 = rstack.enter_context(fset(right_res))
-
-                        if not Normaliser.PRUNE_DOMINATED:
-                            dominated = s1.issame(s2)
-                        else:
-                            dominated = s1.issubset(s2, diff_filter=Normaliser._DIFF_FILTER)
+    try:
+        assert has(0)  # ugh. a bit crap, but we're nudging it to initialize wdir...
+
+
+        left  = 0
+        while has(left):
+            # nothing before left will be used anymore
+            release(left)
+            lfile = ires[left]
+
+            if isinstance(lfile, Exception):
+                # todo ugh... why are we using exception as a dict index??
+                yield Group(
+                    items =[cleaned2orig[lfile]],
+                    pivots=[cleaned2orig[lfile]],
+                    error=True,
+                )
+                left += 1
+                continue
 
-                    if dominated:
-                        next_state = (nitems, right_res)
-                    else:
+            items.close()
+            items = fset(lfile)
+            # union of line hashes for all items
+            items_hashes: set[int] = set(hashes[lfile]) if use_hashes else set()
+
+            lpivot = left
+            lpfile = lfile
+
+            rpivot = left
+            rpfile = lfile
+            # invaraint
+            # - items, lpivot, rpivot are all valid
+            # - sets corresponding to lpivot + rpivot contain all of 'items'
+            # next we attempt to
+            # - rpivot: hopefully advance as much as possible
+            # - items : expand to include as much as possible
+
+            right = left + 1
+            while True:
+                with ExitStack() as rstack:
+                    pivots = rstack.enter_context(fset(lpfile, rpfile))
+
+                    def group(*, rm_last: bool) -> Group:
+                        with stage('emit', cleaned2orig[lpfile]):
+                            return group_aux(rm_last=rm_last)
+
+                    def group_aux(*, rm_last: bool) -> Group:
+                        gitems = items.items
+                        citems = [cleaned2orig[i] for i in gitems]
+                        cpivots = [cleaned2orig[i] for i in pivots.items]
+                        g =  Group(
+                            items =citems,
+                            pivots=cpivots,
+                            error=False,
+                        )
+                        logger.debug('emitting group pivoted on %s, size %d', list(map(str, cpivots)), len(citems))
+                        to_unlink = gitems[: len(gitems) if rm_last else -1]
+                        for i in to_unlink:
+                            unlink_tmp_output(i)
+                        return g
+
+                    if not has(right):
+                        # end of sequence, so the whole tail is in the same group
+                        left = right
+                        yield group(rm_last=True)
+                        break
+
+                    # else try to advance right while maintaining invariants
+                    right_res = ires[right]
+
+                    next_state: tuple[FileSet, Path] | None
+                    if isinstance(right_res, Exception):
+                        # short circuit... error itself will be handled when right_res is the leftmost element
+                        next_state = None
+                    elif prescreened_different(items.items[-1], right_res):
+                        # cheap, so no need to merge & compare the files
+                        next_state = None
+                    elif use_hashes and len(items_hashes.difference(hashes[lpfile], hashes[right_res])) > 0:
+                        # some lines of items aren't present in new pivots
                         next_state = None
-                        rstack.push(nitems)  # won't need it anymore, recycle
-
-                if next_state is None:
-                    # ugh. a bit crap, but seems that a special case is necessary
-                    # otherwise left won't ever get advanced?
-                    if len(pivots.items) == 2:
-                        left = rpivot
-                        rm_last = False
                     else:
-                        left = rpivot + 1
-                        rm_last = True
-                    yield group(rm_last=rm_last)
-                    break
-
-                # else advance it, keeping lpivot unchanged
-                (nitems, rres) = next_state
-                rstack.push(items)  # recycle
-                items = nitems
-                rpivot = right
-                rpfile = rres
-                # right will not be read anymore?
-
-                # intermediate files won't be used anymore
-                for i in items.items[1: -1]:
-                    unlink_tmp_output(i)
-
-                right += 1
+                        with stage('compare', cleaned2orig[right_res]):
+                            nitems  = items.union(right_res)
+
+                            if Normaliser.MULTIWAY:
+                                # otherwise doesn't make sense?
+                                assert Normaliser.PRUNE_DOMINATED
+
+                                # in multiway mode we check if the boundaries (pivots) contain the rest
+                                npivots = rstack.enter_context(fset(lpfile, right_res))
+                                dominated = nitems.issubset(npivots, diff_filter=Normaliser._DIFF_FILTER)
+                            else:
+                                # in two-way mode we check if successive paths include each other
+                                before_right = nitems.items[-2]
+                                s1 = rstack.enter_context(fset(before_right))
+                                s2 = rstack.enter_context(fset(right_res))
+
+                                if not Normaliser.PRUNE_DOMINATED:
+                                    dominated = s1.issame(s2)
+                                else:
+                                    dominated = s1.issubset(s2, diff_filter=Normaliser._DIFF_FILTER)
+
+                            if dominated:
+                                next_state = (nitems, right_res)
+                            else:
+                                next_state = None
+                                rstack.push(nitems)  # won't need it anymore, recycle
+
+                    if next_state is None:
+                        # ugh. a bit crap, but seems that a special case is necessary
+                        # otherwise left won't ever get advanced?
+                        if len(pivots.items) == 2:
+                            left = rpivot
+                            rm_last = False
+                        else:
+                            left = rpivot + 1
+                            rm_last = True
+                        yield group(rm_last=rm_last)
+                        break
+
+                    # else advance it, keeping lpivot unchanged
+                    (nitems, rres) = next_state
+                    rstack.push(items)  # recycle
+                    items = nitems
+                    if use_hashes:
+                        items_hashes |= hashes[rres]
+                    rpivot = right
+                    rpfile = rres
+                    # right will not be read anymore?
+
+                    # intermediate files won't be used anymore
+                    for i in items.items[1: -1]:
+                        unlink_tmp_output(i)
+                    if right - 1 > left:
+                        # previous right pivot just became intermediate
+                        ires.exit(right - 1)
 
-    items.close()
+                    right += 1
 
-    # meh. hacky but sort of does the trick
-    cached = len(getattr(ires, '_cache'))
-    assert cached == total, 'Iterator should be fully processed!'
+        assert ires.computed == left, 'Iterator should be fully processed!'
+        release(left)
+    finally:
+        # also on exceptions, or if the consumer bailed early (i.e. the generator was closed)
+        # otherwise the remaining normaliser contexts (and the prefetching thread) would only be cleaned up whenever gc gets to them
+        items.close()
+        ires.close()
+        prefetched.close()
 
     # TODO: this is not thread safe, should check this above the call stack when Pool is finished
     # stale_files = [p for p in base_tmp_dir.rglob('*') if p.is_file()]
@@ -799,6 +1358,42 @@ def test_bounded_resources(*, tmp_path: Path, multiway: bool, randomize: bool) -
     assert took_space > 20
 
 
+@parametrize('multiway', [False, True])
+def test_bounded_contexts(*, tmp_path: Path, multiway: bool) -> None:
+    """
+    Check that normaliser contexts are exited as soon as results aren't needed, rather than at the very end
+    """
+    opened = 0
+    max_opened = 0
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = True
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            nonlocal opened, max_opened
+            opened += 1
+            max_opened = max(max_opened, opened)
+            try:
+                yield path
+            finally:
+                opened -= 1
+
+    paths = []
+    for i in range(30):
+        p = tmp_path / f'{i:02d}.txt'
+        # growing files within group, so groups are long
+        p.write_text(''.join(f'{i // 10} {x}\n' for x in range(i % 10 + 1)))
+        paths.append(p)
+
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser))
+    assert len(groups[0].items) == 10
+    assert opened == 0
+    # left pivot, right pivot, next file, and maybe a file left from the previous group
+    assert max_opened <= 4
+
+
 @parametrize('multiway', [False, True])
 def test_many_files(*, tmp_path: Path, multiway: bool) -> None:
     N = 2000
@@ -821,6 +1416,178 @@ def test_many_files(*, tmp_path: Path, multiway: bool) -> None:
     assert len(groups) == expected
 
 
+def test_thread_executor(tmp_path: Path) -> None:
+    from bleanser.tests.common import growing_groups
+
+    normalised_in: set[str] = set()
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+        # local class can't be pickled, so it would crash with processes
+        EXECUTOR = 'thread'
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            normalised_in.add(threading.current_thread().name)
+            yield path
+
+    paths = growing_groups(tmp_path, count=12)
+
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser, threads=2))
+    instructions = list(groups_to_instructions(groups))
+    assert [i.path for i in instructions] == paths
+    assert any(isinstance(i, Prune) for i in instructions)
+
+    # main thread only normalises files around chunk boundaries, when stitching the groups
+    workers = normalised_in - {threading.main_thread().name}
+    assert 0 < len(workers) <= 2
+
+
+@parametrize('multiway', [False, True])
+def test_chunks_stitched(*, tmp_path: Path, multiway: bool) -> None:
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = True
+        EXECUTOR = 'thread'
+
+    paths: list[Path] = []
+    # runs of growing files, some of them (e.g. 25) way longer than a chunk, so would definitely span chunk boundaries
+    for run, length in enumerate([1, 7, 3, 25, 2, 12, 1, 1, 9, 4, 16, 5, 14]):
+        for i in range(length):
+            p = tmp_path / f'{len(paths):03}.txt'
+            p.write_text(''.join(f'{run} {x}\n' for x in range(i + 1)))
+            paths.append(p)
+    assert len(paths) == 100
+
+    expected = list(compute_groups(paths, Normaliser=TestNormaliser))
+    assert len(expected) < 30  # sanity check
+    for threads in [1, 2, 4]:
+        groups = list(compute_groups(paths, Normaliser=TestNormaliser, threads=threads))
+        assert groups == expected, threads
+
+
+@parametrize('multiway', [False, True])
+def test_prefetch(*, tmp_path: Path, multiway: bool) -> None:
+    from itertools import islice
+
+    from bleanser.tests.common import growing_groups
+
+    computed: list[int] = []
+    closed: list[int] = []
+
+    def results() -> Iterator[tuple[IRes, ExitStack]]:
+        for i in range(10):
+            computed.append(i)
+            ctx = ExitStack()
+            ctx.callback(closed.append, i)
+            yield (tmp_path / str(i), ctx)
+
+    it = _prefetched(results(), ahead=2)
+    for consumed, (_, ctx) in enumerate(islice(it, 5), start=1):
+        sleep(0.05)  # give it a chance to run ahead
+        assert consumed < len(computed) <= consumed + 2
+        ctx.close()
+    it.close()
+    # results computed in advance are cleaned up too
+    assert sorted(closed) == computed
+    assert len(computed) < 10
+
+    def make(prefetch: int) -> type[BaseNormaliser]:
+        class TestNormaliser(BaseNormaliser):
+            MULTIWAY = multiway
+            PRUNE_DOMINATED = True
+            PREFETCH = prefetch
+
+            @contextmanager
+            def normalise(self, *, path: Path) -> Iterator[Normalised]:
+                res = self.tmp_dir / 'normalised'
+                shutil.copy(path, res)
+                yield res
+        return TestNormaliser
+
+    paths = growing_groups(tmp_path, count=20)
+
+    expected = list(compute_groups(paths, Normaliser=make(0)))
+    assert list(compute_groups(paths, Normaliser=make(3))) == expected
+
+
+@parametrize('prefetch', [0, 3])
+def test_cleanup_on_error(*, tmp_path: Path, prefetch: int) -> None:
+    from unittest.mock import patch
+
+    import pytest
+
+    from bleanser.tests.common import growing_groups
+
+    opened: set[Path] = set()
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+        PREFETCH = prefetch
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            opened.add(path)
+            try:
+                yield path
+            finally:
+                opened.remove(path)
+
+    paths = growing_groups(tmp_path, count=12)
+
+    calls = 0
+    orig_issubset = FileSet.issubset
+
+    def issubset(self, *args, **kwargs) -> bool:
+        nonlocal calls
+        calls += 1
+        if calls == 5:
+            raise RuntimeError('comparison failed')
+        return orig_issubset(self, *args, **kwargs)
+
+    with bleanser_tmp_directory() as base_tmp_dir, patch.object(FileSet, 'issubset', issubset):
+        with pytest.raises(RuntimeError, match='comparison failed') as excinfo:
+            list(_compute_groups_serial(paths, Normaliser=TestNormaliser, base_tmp_dir=base_tmp_dir))
+        # traceback keeps the generator frame (and results it holds) alive, so can't rely on refcounting to clean up
+        assert excinfo.tb is not None
+        assert len(opened) == 0
+        assert not any(t.name == 'bleanser-prefetch' for t in threading.enumerate())
+
+
+@parametrize('multiway', [False, True])
+def test_compress_tmp(*, tmp_path: Path, multiway: bool) -> None:
+    from unittest.mock import patch
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = True
+
+    paths = []
+    for i in range(30):
+        p = tmp_path / f'{i:02d}.txt'
+        # mix of growing files, rolling window and duplicates
+        start = 0 if i < 15 else i - (i % 2)
+        p.write_text(''.join(f'line {x}\n' for x in range(start, 100 + i * 10 - (i % 3) * 10)))
+        paths.append(p)
+
+    compressed: list[Path] = []
+    orig_close = FileSet.close
+
+    def close(self) -> None:
+        if ztmp.is_compressed(self.merged):
+            compressed.append(self.merged)
+        orig_close(self)
+
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser))
+    with patch.object(TestNormaliser, 'COMPRESS_TMP', new=True), patch.object(FileSet, 'close', close):
+        cgroups = list(compute_groups(paths, Normaliser=TestNormaliser))
+    assert groups == cgroups
+    assert len(groups) < len(paths)
+    assert len(compressed) > 0
+
+
 def test_special_characters(tmp_path: Path) -> None:
     class TestNormaliser(BaseNormaliser):
         MULTIWAY = True
@@ -1017,15 +1784,16 @@ def groups_to_instructions(groups: Iterable[Group]) -> Iterator[Instruction]:
     for group in groups:
         # TODO groups can overlap on their pivots.. but nothing else
 
+        # only emitting after the whole group passed the checks below
+        # otherwise with prune --stream, some of the group might be already pruned by the time we find out it's bogus
+        ginstructions: list[Instruction] = []
         # TODO add split method??
         for i in group.items:
             if i in group.pivots:
                 # pivots might be already emitted py the previous groups
                 pi = done.get(i)
                 if pi is None:
-                    keep = Keep(path=i, group=group)
-                    yield keep
-                    done[i] = keep
+                    ginstructions.append(Keep(path=i, group=group))
                 else:
                     if not isinstance(pi, Keep):
                         raise RuntimeError(f'{i}: used both as pivot and non-pivot: {group} AND {pi}')
@@ -1033,9 +1801,10 @@ def groups_to_instructions(groups: Iterable[Group]) -> Iterator[Instruction]:
                 if i in done:
                     raise RuntimeError(f'{i}: occurs in multiple groups: {group} AND {done[i]}')
                 assert i not in done, (i, done)
-                deli = Prune(path=i, group=group)
-                yield deli
-                done[i] = deli
+                ginstructions.append(Prune(path=i, group=group))
+        for ins in ginstructions:
+            done[ins.path] = ins
+        yield from ginstructions
 
 
 def test_groups_to_instructions() -> None:
@@ -1130,6 +1899,16 @@ def test_groups_to_instructions() -> None:
             ('b', 'a'),
         )
 
+    # nothing from the bogus group should be emitted, otherwise x and y would be already pruned with prune --stream
+    emitted: list[str] = []
+    with pytest.raises(RuntimeError, match='multiple groups'):
+        for ins in groups_to_instructions([
+            Group(items=list(map(Path, g)), pivots=(Path(g[0]), Path(g[-1])), error=False)
+            for g in ['abc', 'cxybe']
+        ]):
+            emitted.append(str(ins.path))
+    assert emitted == ['a', 'b', 'c']
+
 
     # # TODO not sure if should raise... no pivot overlap?
     # with pytest.raises(AssertionError):
@@ -1144,11 +1923,17 @@ def compute_instructions(
     *,
     Normaliser: type[BaseNormaliser],
     threads: int | None,
+    checkpoint: Path | None = None,
+    weights: Mapping[Path, float] | None = None,
+    executor: ExecutorKind | None = None,
 ) -> Iterator[Instruction]:
     groups: Iterable[Group] = compute_groups(
         paths=paths,
         Normaliser=Normaliser,
         threads=threads,
+        checkpoint=checkpoint,
+        weights=weights,
+        executor=executor,
     )
     instructions: Iterable[Instruction] = groups_to_instructions(groups)
     total = len(paths)
@@ -1161,14 +1946,239 @@ def compute_instructions(
     assert done == len(paths)  # just in case
 
 
+def verify_groups(
+    groups: Sequence[Group],
+    *,
+    Normaliser: type[BaseNormaliser],
+    threads: int | None,
+    executor: ExecutorKind | None = None,
+) -> list[Path]:
+    '''
+    Independent cross-check of the groups (see prune --verify): for each file that would be pruned,
+    checks that all of its normalised lines are present in the union of its group pivots
+
+    Each file is normalised & read once per group, without any sorting/merging/diffing, so it's much cheaper than the original run.
+    Groups are checked in parallel
+
+    Returns files that failed the check (normally, there shouldn't be any)
+    '''
+    # custom filters ignore some of the differences, so pruned files might legitimately have lines that pivots don't
+    assert Normaliser._DIFF_FILTER == _FILTER_ALL_ADDED, "can't verify normalisers with custom diff filters"
+
+    todo = [g for g in groups if not g.error and any(p not in g.pivots for p in g.items)]
+    logger.info('verifying %d groups', len(todo))
+    kind = Normaliser.EXECUTOR if executor is None else executor
+    failed: list[Path] = []
+    with _make_pool(threads=threads, kind=kind) as pool, bleanser_tmp_directory() as base_tmp_dir:
+        futures = [
+            pool.submit(
+                _verify_group,
+                group=g,
+                Normaliser=Normaliser,
+                # adjacent groups share a pivot, so they need separate dirs in case they are normalised concurrently
+                base_tmp_dir=base_tmp_dir / f'verify{i}',
+            )
+            for i, g in enumerate(todo)
+        ]
+        for f in futures:
+            failed.extend(f.result())
+    return failed
+
+
+def _verify_group(*, group: Group, Normaliser: type[BaseNormaliser], base_tmp_dir: Path) -> list[Path]:
+    # note: hashes are only comparable within the same process (see strong_line_hashes), so the whole group is checked here
+    pivot_hashes: set[int] = set()
+    for p in group.pivots:
+        # note: normalising is most of the verification cost, so it's within the stage
+        with stage('verify', p), Normaliser(original=p, base_tmp_dir=base_tmp_dir).do_normalise() as res:
+            pivot_hashes |= strong_line_hashes(res)
+    failed = []
+    for p in group.items:
+        if p in group.pivots:
+            continue
+        with stage('verify', p), Normaliser(original=p, base_tmp_dir=base_tmp_dir).do_normalise() as res:
+            if not all_lines_in(res, pivot_hashes):
+                logger.error("%s isn't contained in the pivots of its group %s", p, list(map(str, group.pivots)))
+                failed.append(p)
+    return failed
+
+
+@parametrize('multiway', [False, True])
+def test_verify_groups(*, tmp_path: Path, multiway: bool) -> None:
+    from bleanser.tests.common import growing_groups
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = True
+
+    paths = growing_groups(tmp_path, count=10)
+
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser))
+    assert any(isinstance(i, Prune) for i in groups_to_instructions(groups))
+    records: list[dict] = []
+    with instrument.reporting(on_records=records.extend):
+        assert verify_groups(groups, Normaliser=TestNormaliser, threads=None) == []
+    # normalising is the bulk of the work, so should be accounted for in the verify stage
+    verify = [r for r in records if r['stage'] == 'verify']
+    unpack = [r for r in records if r['stage'] == 'unpack']
+    assert len(verify) > 0
+    assert len(unpack) == len(verify)
+    assert all(r['depth'] == 0 for r in verify)
+    assert all(r['depth'] == 1 for r in unpack)
+
+    # simulate bogus verdicts: 0.txt isn't contained in the next group, but 3.txt is contained in 5.txt
+    bogus = Group(items=[paths[0], paths[3], paths[5]], pivots=[paths[5]], error=False)
+    assert verify_groups([bogus], Normaliser=TestNormaliser, threads=None) == [paths[0]]
+
+
+def watch_groups(
+    get_paths: Callable[[], Sequence[Path]],
+    *,
+    Normaliser: type[BaseNormaliser],
+    interval: float,
+    idle_timeout: float | None = None,
+    identities: dict[Path, tuple[int, int, int, int]] | None = None,
+) -> Iterator[Group]:
+    """
+    Keeps polling get_paths for new files and emits groups as soon as they are 'closed'
+    I.e. a group is emitted when the next file isn't dominated by it, so the last group is only emitted when we stop watching
+
+    The normaliser state (including normalised pivots of the current group) is kept in memory between the polls,
+    so it's much cheaper than running prune every time a new file arrives
+
+    idle_timeout: stop watching if no new files arrived for this many seconds (None means watch forever)
+    identities: if passed, filled with identities of files (see _identity) as they are picked up for processing
+        so they can be passed to _apply_instructions, to make sure files weren't replaced by the time they are pruned
+    """
+    from .state import Fingerprint
+
+    def new_paths() -> Iterator[Path]:
+        seen: set[Path] = set()
+        last: Path | None = None
+        # files that might still be being written, we only process them once they stop changing between polls
+        pending: dict[Path, Fingerprint] = {}
+        last_arrived = time()
+        while True:
+            ready = []
+            for p in get_paths():
+                if p in seen:
+                    continue
+                try:
+                    st = p.stat()
+                except FileNotFoundError:
+                    # removed (e.g. rotated) since it was listed
+                    pending.pop(p, None)
+                    continue
+                fp = Fingerprint(size=st.st_size, mtime_ns=st.st_mtime_ns)
+                if pending.get(p) == fp:
+                    ready.append(p)
+                    if identities is not None:
+                        # same stat as the one we know the file settled by, so it's what we are going to process
+                        identities[p] = ingest.identity(st)
+                else:
+                    pending[p] = fp
+
+            for p in ready:
+                del pending[p]
+                seen.add(p)
+                if last is not None and p < last:
+                    # not much we can do about it, but results still make sense, just possibly suboptimal
+                    logger.warning('%s arrived out of order (after %s)', p, last)
+                last = p
+                yield p
+
+            if len(ready) > 0 or len(pending) > 0:
+                last_arrived = time()
+            elif idle_timeout is not None and time() - last_arrived >= idle_timeout:
+                logger.info('no new files in %.1f seconds, stopping', idle_timeout)
+                return
+            sleep(interval)
+
+    with bleanser_tmp_directory() as base_tmp_dir:
+        # NOTE: _compute_groups_serial releases results (and their normaliser contexts) once the group is emitted
+        # so memory/disk use only depends on the current group (and PREFETCH), not on how long we watch
+        yield from _compute_groups_serial(new_paths(), Normaliser=Normaliser, base_tmp_dir=base_tmp_dir)
+
+
+def test_watch_groups(tmp_path: Path) -> None:
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+    # simulate files arriving one at a time
+    contents = [
+        'a\n',
+        'a\nb\n',
+        'a\nb\nc\n',
+        'x\n',
+        'x\ny\n',
+    ]
+    arrived: list[Path] = []
+    emitted: list[tuple[list[Path], int]] = []
+    # listed, but removed before it settled
+    gone = tmp_path / 'gone.txt'
+
+    def get_paths() -> list[Path]:
+        if not gone.exists() and len(arrived) == 0:
+            gone.write_text('whatever\n')
+        else:
+            gone.unlink(missing_ok=True)
+        # last file only arrives after the first group is emitted, so if groups were only emitted in the end, it would never arrive
+        if len(arrived) < len(contents) - 1 or (len(arrived) < len(contents) and len(emitted) > 0):
+            p = tmp_path / f'{len(arrived)}.txt'
+            p.write_text(contents[len(arrived)])
+            arrived.append(p)
+        return [*arrived, gone]
+
+    [p0, p1, p2, p3, p4] = [tmp_path / f'{i}.txt' for i in range(len(contents))]
+
+    for g in watch_groups(get_paths, Normaliser=TestNormaliser, interval=0, idle_timeout=0.1):
+        # groups are emitted as soon as they are closed, not just at the very end
+        emitted.append((list(g.items), len(arrived)))
+    assert emitted == [
+        ([p0, p1, p2], 4),  # emitted as soon as 3.txt settled (was seen twice) and turned out not to be dominated
+        ([p2]        , 4),
+        ([p3, p4]    , 5),
+    ]
+
+    identities: dict[Path, tuple[int, int, int, int]] = {}
+    instructions = list(groups_to_instructions(watch_groups(lambda: [p0, p1, p2], Normaliser=TestNormaliser, interval=0, idle_timeout=0, identities=identities)))
+    assert [type(i) for i in instructions] == [Keep, Prune, Keep]
+    assert identities == {p: _identity(p) for p in [p0, p1, p2]}
+
+    # replaced after it was grouped, so shouldn't be pruned
+    p1.unlink()
+    p1.write_text('something else\n')
+    assert _apply_instructions(instructions, mode=Remove(), need_confirm=False, identities=identities) == 1
+    assert p1.read_text() == 'something else\n'
+
+
 def apply_instructions(instructions: Iterable[Instruction], *, mode: Mode = Dry(), need_confirm: bool=True) -> NoReturn:  # noqa: B008
+    exit_code = _apply_instructions(instructions, mode=mode, need_confirm=need_confirm)
+    sys.exit(exit_code)
+
+
+def _apply_instructions(
+    instructions: Iterable[Instruction],
+    *,
+    mode: Mode,
+    need_confirm: bool,
+    identities: Mapping[Path, tuple[int, int, int, int]] | None = None,
+) -> int:
+    """
+    Same as apply_instructions, but returns exit code instead of exiting
+
+    identities: if passed, files are pruned as soon as their group is computed (so there is no one to confirm)
+        these should be taken (see _identity) before processing: files that were changed since, or whose group pivots were, are kept
+    """
     import click
 
-    # TODO hmm...
-    # if we keep it as iterator, would be kinda nice, then it'd print cleaning stats as you run it
-    # NOTE: will also need to remove (list) call in 'clean' subcommand
+    streaming = identities is not None
+    if streaming:
+        assert not need_confirm, "can't confirm when pruning files as we go"
+
     totals: str
-    if not isinstance(mode, Dry):
+    if not isinstance(mode, Dry) and not streaming:
         # force for safety
         instructions = list(instructions)
         totals = f'{len(instructions):>3}'
@@ -1210,9 +2220,22 @@ def apply_instructions(instructions: Iterable[Instruction], *, mode: Mode = Dry(
             action = click.style('will keep        ', fg='green')
         elif isinstance(ins, Prune):
             action = rm_action
-            rem_bytes += sz
-            rem_files += 1
-            to_delete.append(ins.path)
+            if identities is not None and not isinstance(mode, Dry):
+                # the group is final, so can prune right away -- as long as files are the same ones we processed
+                changed = [p for p in [ip, *ins.group.pivots] if not p.exists() or _identity(p) != identities.get(p)]
+                if len(changed) > 0:
+                    logger.error('%s: %s changed while processing, not pruning', ip, list(map(str, changed)))
+                    errored.append(ip)
+                    action = click.style('changed, keeping ', fg='red')
+                else:
+                    _check_not_under_pytest()
+                    _prune_file(ip, mode=mode)
+                    rem_bytes += sz
+                    rem_files += 1
+            else:
+                rem_bytes += sz
+                rem_files += 1
+                to_delete.append(ins.path)
         else:
             raise RuntimeError(ins)
         logger.info(f'processing {idx:>4}/{totals:>4} %s : %s  ; %s', ip, action, stat())
@@ -1226,44 +2249,89 @@ def apply_instructions(instructions: Iterable[Instruction], *, mode: Mode = Dry(
 
     if isinstance(mode, Dry):
         logger.info('dry mode! not touching anything')
-        sys.exit(exit_code)
+        return exit_code
+
+    if streaming:
+        # already pruned everything
+        return exit_code
 
-    from .utils import under_pytest
-    assert not under_pytest  # just a paranoid check to prevent deleting something under tests by accident
+    _check_not_under_pytest()
 
     if len(to_delete) == 0:
         logger.info('no files to prune!')
-        sys.exit(exit_code)
+        return exit_code
 
     if need_confirm and not click.confirm(f'Ready to {rm_action.strip().lower()} {len(to_delete)} files?', abort=True):
-        sys.exit(exit_code)
+        return exit_code
+
+    for i in instructions:
+        # just in case, to make sure no one messed with files in the meantime
+        assert i.path.exists(), i.path
+
+    for p in to_delete:
+        _prune_file(p, mode=mode)
+
+    return exit_code
+
 
-    move_to: Path | None = None
+def _check_not_under_pytest() -> None:
+    from . import utils
+    assert not utils.under_pytest  # just a paranoid check to prevent deleting something under tests by accident
+
+
+def _identity(p: Path) -> tuple[int, int, int, int]:
+    return ingest.identity(p.stat())
+
+
+def _prune_file(p: Path, *, mode: Mode) -> None:
+    assert p.is_absolute(), p  # just in case
     if   isinstance(mode, Move):
         move_to = mode.path
         # just in case
         assert move_to.is_absolute(), move_to
+        tgt = move_to / Path(*p.parts[1:])
+        tgt.parent.mkdir(parents=True, exist_ok=True)
+        logger.info('mv %s %s', p, tgt)
+        shutil.move(str(p), str(tgt))
     elif isinstance(mode, Remove):
-        pass
+        logger.info('rm %s', p)
+        p.unlink()
     else:
         raise RuntimeError(mode, type(mode))
 
-    for i in instructions:
-        # just in case, to make sure no one messed with files in the meantime
-        assert i.path.exists(), i.path
 
-    for p in to_delete:
-        assert p.is_absolute(), p  # just in case
-        if move_to is not None:
-            tgt = move_to / Path(*p.parts[1:])
-            tgt.parent.mkdir(parents=True, exist_ok=True)
-            logger.info('mv %s %s', p, tgt)
-            shutil.move(str(p), str(tgt))
-        else:
-            logger.info('rm %s', p)
-            p.unlink()
+def test_apply_streaming(tmp_path: Path) -> None:
+    from unittest.mock import patch
 
-    sys.exit(exit_code)
+    from bleanser.tests.common import growing_groups
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    paths = growing_groups(idir, count=6)
+    [_, p1, _, p3, p4, _] = paths
+
+    identities = {p: _identity(p) for p in paths}
+    # touching is enough to consider the file changed
+    os.utime(p4, ns=(0, 0))
+
+    def instructions() -> Iterator[Instruction]:
+        for ins in compute_instructions(paths, Normaliser=TestNormaliser, threads=None):
+            if ins.path == p3:
+                # previous group should already be pruned by now
+                assert not p1.exists()
+            yield ins
+
+    moved = tmp_path / 'moved'
+    moved.mkdir()
+    with patch('bleanser.core.utils.under_pytest', new=False):
+        exit_code = _apply_instructions(instructions(), mode=Move(moved), need_confirm=False, identities=identities)
+    assert exit_code == 1  # since p4 couldn't be pruned
+    assert [p for p in paths if not p.exists()] == [p1]
+    assert (moved / Path(*p1.parts[1:])).exists()
 
 
 # TODO write a test for this
@@ -1300,8 +2368,8 @@ def compute_diff(paths: list[Path], *, Normaliser: type[BaseNormaliser]) -> list
 
         fs1 = FileSet([r for _, r in group1], wdir=base_tmp_dir)
         fs2 = FileSet([r for _, r in group2], wdir=base_tmp_dir)
-        c1 = fs1.merged
-        c2 = fs2.merged
+        c1 = fs1.flat()
+        c2 = fs2.flat()
 
         if difftool is not None:
             # note: we don't want to exec here, otherwise context manager won't have a chance to clean up?
@@ -0,0 +1,202 @@
+"""
+Sharded normalised output: instead of a single sorted file, a normaliser can emit a directory of shards
+(e.g. one per sqlite table, or per top-level JSON key), along with a manifest with line counts and hashes for each shard.
+
+Each shard is sorted & deduplicated, and the same line always needs to end up in the same shard
+(e.g. because lines are prefixed with the table/key name). Then set operations on normalised files
+can be done shard by shard, and shards that didn't change can be skipped just by comparing their hashes.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Mapping
+
+from .native import mapped
+
+MANIFEST = 'manifest.json'
+
+
+@dataclass(frozen=True)
+class Shard:
+    file: str
+    """
+    relative to the sharded directory
+    """
+
+    lines: int
+    hash: str
+
+
+Manifest = Dict[str, Shard]
+"""
+shard name -> shard
+"""
+
+
+def is_sharded(path: Path) -> bool:
+    return (path / MANIFEST).is_file()
+
+
+def read_manifest(path: Path) -> Manifest:
+    j = json.loads((path / MANIFEST).read_text())
+    return {name: Shard(**s) for name, s in j.items()}
+
+
+def write_manifest(path: Path, manifest: Manifest) -> None:
+    (path / MANIFEST).write_text(json.dumps({name: asdict(s) for name, s in manifest.items()}, indent=1))
+
+
+def stat(path: Path, *, file: str) -> Shard:
+    # NOTE: unlike sketches, here the hash needs to be collision resistant -- shards with the same hash are considered same
+    chunk = 1 << 20
+    with mapped(path / file) as buf:
+        # mmap doesn't have count(), so need to slice
+        lines = sum(buf[i: i + chunk].count(b'\n') for i in range(0, len(buf), chunk))
+        if len(buf) > 0 and buf[-1:] != b'\n':
+            lines += 1
+        h = hashlib.blake2b(buf, digest_size=16).hexdigest()
+    return Shard(file=file, lines=lines, hash=h)
+
+
+def finalise(path: Path, shards: Mapping[str, Path], *, presorted: bool = False) -> Path:
+    '''
+    path: directory with shard files
+    shards: shard name -> shard file (has to be within the directory)
+    presorted: if shard files are already sorted, only need to deduplicate them
+
+    Sorts & deduplicates the shards and writes the manifest. Returns the path for convenience
+    '''
+    from .processor import get_sort_binary
+
+    manifest: Manifest = {}
+    for name, sfile in shards.items():
+        file = str(sfile.relative_to(path))
+        mflag = ['--merge'] if presorted else []
+        get_sort_binary().bound_command('--unique', *mflag, '-o', str(sfile), str(sfile))()
+        manifest[name] = stat(path, file=file)
+    write_manifest(path, manifest)
+    return path
+
+
+def files(path: Path) -> list[Path]:
+    '''
+    Files with normalised data -- just the path itself if it's not sharded
+    '''
+    if not is_sharded(path):
+        return [path]
+    return [path / s.file for s in read_manifest(path).values()]
+
+
+def flatten(path: Path, *, to: Path) -> Path:
+    '''
+    Merges all shards into a single sorted file (e.g. for diffing)
+    '''
+    from .processor import get_sort_binary
+
+    shard_files = [str(f) for f in files(path)]
+    if len(shard_files) == 0:
+        to.touch()
+    else:
+        get_sort_binary().bound_command('--merge', '-o', str(to), *shard_files)()
+    return to
+
+
+def link(src: str | Path, dst: str | Path) -> None:
+    # shards are never modified once written, so hardlinking is safe and way cheaper than copying
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. different filesystems
+        shutil.copyfile(src, dst)
+
+
+def test_shards(tmp_path: Path) -> None:
+    d = tmp_path / 'sharded'
+    d.mkdir()
+    (d / 'a').write_text('a 2\na 1\na 2\n')
+    (d / 'b').write_text('b 1')
+    (d / 'c').touch()
+
+    assert not is_sharded(d)
+    assert finalise(d, {'shard a': d / 'a', 'shard b': d / 'b', 'empty': d / 'c'}) == d
+    assert is_sharded(d)
+
+    m = read_manifest(d)
+    assert list(m) == ['shard a', 'shard b', 'empty']
+    assert (d / 'a').read_text() == 'a 1\na 2\n'
+    assert m['shard a'].lines == 2
+    assert m['shard b'].lines == 1
+    assert m['empty'].lines == 0
+    assert m['shard a'].hash != m['shard b'].hash
+
+    flat = flatten(d, to=tmp_path / 'flat')
+    assert flat.read_text() == 'a 1\na 2\nb 1\n'
+    assert files(flat) == [flat]
+
+
+def test_fileset(tmp_path: Path) -> None:
+    from .processor import _FILTER_ALL_ADDED, FileSet
+
+    wdir = tmp_path / 'wdir'
+    wdir.mkdir()
+
+    idx = 0
+
+    def sharded(**kwargs: list[str]) -> Path:
+        nonlocal idx
+        idx += 1
+        d = tmp_path / f'sharded{idx}'
+        d.mkdir()
+        sfiles = {}
+        for name, lines in kwargs.items():
+            sfile = d / name
+            sfile.write_text(''.join(f'{name} {l}\n' for l in lines))
+            sfiles[name] = sfile
+        return finalise(d, sfiles)
+
+    def FS(*paths: Path) -> FileSet:
+        return FileSet(paths, wdir=wdir)
+
+    dfilter = _FILTER_ALL_ADDED
+
+    x1 = sharded(a=['1', '2'], b=['1'])
+    x2 = sharded(a=['1', '2'], b=['1', '2'])
+    x3 = sharded(a=['1', '2'], c=['1'])
+    x4 = sharded(a=['2', '1', '1'], b=['1'])
+
+    assert FS(x1).issame(FS(x4))
+    assert not FS(x1).issame(FS(x2))
+
+    assert FS(x1).issubset(FS(x2), diff_filter=dfilter)
+    assert not FS(x2).issubset(FS(x1), diff_filter=dfilter)
+    assert not FS(x1).issubset(FS(x3), diff_filter=dfilter)
+    assert FS(x1, x3).issubset(FS(x2, x3), diff_filter=dfilter)
+    # custom filter goes through diff
+    assert FS(x1).issubset(FS(x2), diff_filter='>')
+    assert not FS(x2).issubset(FS(x1), diff_filter='>')
+
+    u = FS(x1).union(x3)
+    assert u.items == [x1, x3]
+    m = read_manifest(u.merged)
+    assert list(m) == ['a', 'b', 'c']
+    # unchanged shard is just linked
+    assert (u.merged / m['a'].file).stat().st_ino == (x1 / read_manifest(x1)['a'].file).stat().st_ino
+    assert u.flat().read_text() == 'a 1\na 2\nb 1\nc 1\n'
+    assert FS(x1, x2).issame(FS(x2))
+
+    # shouldn't normally happen, but mixing sharded and regular files should work too
+    plain = tmp_path / 'plain'
+    plain.write_text('a 1\nb 1\n')
+    assert FS(plain).issubset(FS(x1), diff_filter=dfilter)
+    assert FS(x1).issubset(FS(plain, x1), diff_filter=dfilter)
+    assert not FS(x2).issubset(FS(plain), diff_filter=dfilter)
+    assert FS(plain, x3).flat().read_text() == 'a 1\na 2\nb 1\nc 1\n'
+
+    u.close()
+    assert not u.merged.exists()
@@ -0,0 +1,264 @@
+"""
+Bottom-k sketches of normalised files: a cheap way to prove that two files are DIFFERENT without comparing them fully
+
+The sketch keeps k smallest (distinct) line hashes. If a left hash isn't in the right sketch, but is smaller than
+the largest hash in it, the corresponding line can't be present in the right file (since otherwise its hash
+would have made it into the right sketch).
+
+Hash collisions can only hide differences, never invent them, so 'differs' verdicts are always sound.
+If the sketch can't tell, the full comparison has to run anyway.
+
+For multiway mode there are also full sets of line hashes (see line_hashes), since there we need to check
+against a union of pivots, which a sketch can't do.
+"""
+
+from __future__ import annotations
+
+import heapq
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AbstractSet, Any, Callable, Iterator, Sequence
+
+from . import columnar, shards
+from .native import mapped
+
+K = 256
+
+# lines are hashed in chunks, so we don't have to keep the whole file in memory as python objects
+_CHUNK = 1 << 22
+
+
+def _iter_hashes(path: Path, *, hasher: Callable[[bytes], int] = zlib.crc32) -> Iterator[set[int]]:
+    '''
+    Yields sets of line hashes, chunk by chunk
+    '''
+    # NOTE: crc32 isn't a great hash, but it's way faster than anything in hashlib (~3x vs blake2b)
+    # it only needs to be deterministic across processes (unlike builtin hash()), and collisions don't affect correctness
+    if columnar.is_columnar(path):
+        # rows are already hashed (64 bit, so good enough for any purpose), no need to render them
+        yield set(columnar.row_hashes(path))
+        return
+    for f in shards.files(path):
+        with mapped(f) as buf:
+            n = len(buf)
+            i = 0
+            while i < n:
+                e = buf.find(b'\n', min(i + _CHUNK, n) - 1)
+                if e == -1:
+                    e = n
+                chunk = buf[i: e]
+                yield set(map(hasher, chunk.split(b'\n')))
+                i = e + 1
+
+
+def line_hashes(path: Path) -> frozenset[int]:
+    '''
+    Hashes of all lines in the file
+
+    Unlike the sketch, this takes memory proportional to the file (~60 bytes per distinct line),
+    but can tell that some line is missing from a union of files without merging them
+    '''
+    res: set[int] = set()
+    for hs in _iter_hashes(path):
+        res |= hs
+    return frozenset(res)
+
+
+# NOTE: for verification, a collision could hide a missing line, so using 64 bit builtin hash() instead of crc32
+# it's randomised per process though, so these hashes are only comparable within the same process
+
+def strong_line_hashes(path: Path) -> set[int]:
+    '''
+    Same as line_hashes, but collisions are very unlikely
+    '''
+    res: set[int] = set()
+    for hs in _iter_hashes(path, hasher=hash):
+        res |= hs
+    return res
+
+
+def all_lines_in(path: Path, hashes: AbstractSet[int]) -> bool:
+    '''
+    True if hashes (see strong_line_hashes) contain all lines of the file
+    Doesn't keep the file hashes in memory, and bails at the first missing chunk
+    '''
+    return all(hs <= hashes for hs in _iter_hashes(path, hasher=hash))
+
+
+@dataclass(frozen=True)
+class Sketch:
+    hashes: tuple[int, ...]
+    """
+    k smallest distinct line hashes, sorted
+    """
+
+    complete: bool
+    """
+    true if the file had fewer than k distinct hashes, i.e. the sketch contains all of them
+    """
+
+    @classmethod
+    def of(cls, path: Path, *, k: int = K) -> Sketch:
+        # NOTE: crc32 isn't a great hash, but it's way faster than anything in hashlib (~3x vs blake2b)
+        # it only needs to be deterministic across processes (unlike builtin hash()), and collisions don't affect correctness
+        best: list[int] = []
+        for hs in _iter_hashes(path):
+            best = heapq.nsmallest(k, hs.union(best))
+        return cls(hashes=tuple(best), complete=len(best) < k)
+
+    def missing_from(self, other: Sketch) -> bool:
+        '''
+        True if some line of this file is definitely not present in the other file
+        False means we don't know
+        '''
+        if len(self.hashes) == 0:
+            return False
+        ohashes = set(other.hashes)
+        if other.complete:
+            return any(h not in ohashes for h in self.hashes)
+        othreshold = other.hashes[-1]
+        return any(h not in ohashes for h in self.hashes if h <= othreshold)
+
+    def differs(self, other: Sketch) -> bool:
+        '''
+        True if the files are definitely different (as sets of lines)
+        '''
+        # sets are equal only if their bottom-k sketches are equal
+        return self.hashes != other.hashes
+
+
+def test_sketch(tmp_path: Path) -> None:
+    def write(name: str, lines: list[str]) -> Sketch:
+        p = tmp_path / name
+        p.write_text(''.join(l + '\n' for l in lines))
+        return Sketch.of(p, k=8)
+
+    empty = write('empty', [])
+    ab = write('ab', ['a', 'b'])
+    abc = write('abc', ['a', 'b', 'c'])
+    abc_dup = write('abc_dup', ['a', 'a', 'b', 'c', 'c'])
+
+    assert empty.complete
+    assert empty.hashes == ()
+    assert abc.complete
+    assert abc == abc_dup  # sketch is over distinct lines
+
+    assert not ab.missing_from(abc)
+    assert abc.missing_from(ab)
+    assert not empty.missing_from(ab)
+    assert ab.missing_from(empty)
+    assert ab.differs(abc)
+    assert not abc.differs(abc_dup)
+
+    # incomplete sketches
+    many = [f'line {i}' for i in range(1000)]
+    big = write('big', many)
+    assert not big.complete
+    assert len(big.hashes) == 8
+
+    # it's not gonna detect all differences, but shouldn't ever claim something is missing when it's not
+    for i in range(0, 1000, 50):
+        sub = write(f'sub{i}', many[:i])
+        assert not sub.missing_from(big)
+        sup = write(f'sup{i}', [*many[:i], *many[i + 1:]])
+        assert not sup.missing_from(big)
+        # the other way around might be detected, depending on whether the missing line hash is small enough
+        if big.missing_from(sup):
+            [missing] = [h for h in big.hashes if h not in sup.hashes and h <= sup.hashes[-1]]
+            assert missing == zlib.crc32(many[i].encode())
+
+    # if the only missing line has the smallest hash, it's always detected
+    smallest = min(many, key=lambda l: zlib.crc32(l.encode()))
+    without = write('without', [l for l in many if l != smallest])
+    assert big.missing_from(without)
+    assert big.differs(without)
+
+
+def test_sketch_chunks(tmp_path: Path) -> None:
+    # lines shouldn't get split or merged at chunk boundaries
+    from unittest.mock import patch
+
+    lines = [f'{i:05d}' for i in range(500)]
+    p = tmp_path / 'file'
+    p.write_text(''.join(l + '\n' for l in lines))
+    expected = Sketch.of(p, k=1000)
+    assert expected.complete
+    assert set(expected.hashes) == {zlib.crc32(l.encode()) for l in lines}
+
+    for chunk in [1, 5, 6, 7, 100]:
+        with patch.dict(globals(), {'_CHUNK': chunk}):
+            assert Sketch.of(p, k=1000) == expected, chunk
+
+
+def _groups_and_unions(paths: Sequence[Path], *, Normaliser: Any, **overrides: Any) -> tuple[list, int]:
+    '''
+    Groups computed with the normaliser attributes patched, and how many FileSet unions (i.e. full comparisons) it took
+    '''
+    from contextlib import ExitStack
+    from unittest.mock import patch
+
+    from .processor import FileSet, compute_groups
+
+    unions = 0
+    orig_union = FileSet.union
+
+    def union(self, *args):
+        nonlocal unions
+        unions += 1
+        return orig_union(self, *args)
+
+    with ExitStack() as stack:
+        for k, v in overrides.items():
+            stack.enter_context(patch.object(Normaliser, k, v))
+        stack.enter_context(patch.object(FileSet, 'union', union))
+        groups = list(compute_groups(paths, Normaliser=Normaliser))
+    return (groups, unions)
+
+
+def test_prescreen(tmp_path: Path) -> None:
+    from .processor import BaseNormaliser
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+    # rolling window, so most adjacent files are different
+    paths = []
+    for i in range(20):
+        p = tmp_path / f'{i:02d}.txt'
+        start = i if i % 3 == 0 else i - 1
+        p.write_text(''.join(f'line {x}\n' for x in range(start, start + 300)))
+        paths.append(p)
+
+    (groups, unions) = _groups_and_unions(paths, Normaliser=TestNormaliser, _SKETCH_PRESCREEN=False)
+    (pgroups, punions) = _groups_and_unions(paths, Normaliser=TestNormaliser, _SKETCH_PRESCREEN=True)
+    assert groups == pgroups
+    assert punions < unions
+
+
+def test_pivot_filter(tmp_path: Path) -> None:
+    from .processor import BaseNormaliser
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = True
+        PRUNE_DOMINATED = True
+
+    a = tmp_path / 'a'
+    a.write_text('a\nb\n')
+    assert line_hashes(a) == {zlib.crc32(b'a'), zlib.crc32(b'b')}
+
+    # growing files (which can be pruned), followed by files with unique lines (which can't)
+    paths = []
+    for i in range(20):
+        p = tmp_path / f'{i:02d}.txt'
+        extra = [] if i < 10 else [f'extra {i}']
+        p.write_text(''.join(l + '\n' for l in [*(f'line {x}' for x in range(i * 10 + 100)), *extra]))
+        paths.append(p)
+
+    (groups, unions) = _groups_and_unions(paths, Normaliser=TestNormaliser, _PIVOT_FILTER=False)
+    (fgroups, funions) = _groups_and_unions(paths, Normaliser=TestNormaliser, _PIVOT_FILTER=True)
+    assert groups == fgroups
+    assert funions < unions
+    # first 10 files are growing, so intermediate ones should be pruned
+    assert len(groups[0].items) >= 10
@@ -0,0 +1,332 @@
+"""
+Helpers for keeping bits of state between bleanser runs (e.g. for prune --incremental/--resume)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterator, Sequence
+
+from .common import Group, logger
+
+if TYPE_CHECKING:
+    from .processor import BaseNormaliser
+
+
+def bleanser_state_dir() -> Path:
+    # TODO add a cli setting for it?
+    sdir = os.environ.get('BLEANSER_STATE_DIR')
+    if sdir is not None:
+        return Path(sdir)
+    xdg = os.environ.get('XDG_STATE_HOME')
+    base = Path(xdg) if xdg else Path('~/.local/state').expanduser()
+    return base / 'bleanser'
+
+
+def state_file(*, kind: str, Normaliser: type[BaseNormaliser], key: str) -> Path:
+    '''
+    kind: what sort of state it is, e.g. 'incremental'
+    key : distinguishes different inputs processed by the same normaliser (e.g. the path passed to prune)
+    '''
+    nname = '.'.join(Normaliser._relative_base_tmp_dir().parts)
+    khash = hashlib.sha1(key.encode('utf8')).hexdigest()[:16]
+    return bleanser_state_dir() / kind / f'{nname}-{khash}.json'
+
+
+@dataclass
+class Fingerprint:
+    """
+    Cheap way to detect that a file was changed/replaced since the last time we saw it
+    """
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def of(cls, path: Path) -> Fingerprint:
+        st = path.stat()
+        return cls(size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+
+@dataclass
+class IncrementalState:
+    last: Path
+    """
+    Last (in sort order) path processed by the previous run
+    """
+
+    pivots: dict[Path, Fingerprint]
+    """
+    Pivots of the last group emitted by the previous run.
+    This group is still 'open', i.e. newly arrived files might extend it, so the next run resumes from these
+    """
+
+    @classmethod
+    def from_last_group(cls, *, group: Group, paths: Sequence[Path]) -> IncrementalState:
+        return cls(
+            last=max(paths),
+            pivots={p: Fingerprint.of(p) for p in group.pivots},
+        )
+
+    def paths_to_process(self, paths: Sequence[Path]) -> list[Path]:
+        '''
+        paths: all input paths (sorted by name)
+
+        Returns the pivots of the last group + files that arrived after the previous run
+        Falls back onto all paths if pivots were removed or modified in the meantime
+        '''
+        for p, fp in self.pivots.items():
+            if not p.exists() or Fingerprint.of(p) != fp:
+                logger.warning("pivot %s from the previous run doesn't exist or was modified, processing all files", p)
+                return list(paths)
+        res = [p for p in paths if p in self.pivots or p > self.last]
+        logger.info('incremental mode: %d files left to process (out of %d)', len(res), len(paths))
+        return res
+
+    @classmethod
+    def load(cls, sfile: Path) -> IncrementalState | None:
+        if not sfile.exists():
+            return None
+        j = json.loads(sfile.read_text())
+        return cls(
+            last=Path(j['last']),
+            pivots={Path(p): Fingerprint(**fp) for p, fp in j['pivots'].items()},
+        )
+
+    def save(self, sfile: Path) -> None:
+        j = {
+            'last': str(self.last),
+            'pivots': {str(p): {'size': fp.size, 'mtime_ns': fp.mtime_ns} for p, fp in self.pivots.items()},
+        }
+        sfile.parent.mkdir(parents=True, exist_ok=True)
+        tmp = sfile.with_suffix('.tmp')
+        tmp.write_text(json.dumps(j, indent=1))
+        tmp.replace(sfile)  # atomic, so we don't end up with half written state if interrupted
+
+
+class Checkpoint:
+    """
+    Groups emitted by compute_groups so far, so an interrupted run can skip straight to the unfinished part
+
+    Stored as jsonl: normaliser config on the first line, then a line per group.
+    That way checkpointing after each group is just an append, even if there are thousands of groups.
+    """
+
+    def __init__(self, sfile: Path, *, Normaliser: type[BaseNormaliser]) -> None:
+        self.sfile = sfile
+        # if any of these changed, the groups would be different
+        self.config = {
+            'multiway'       : Normaliser.MULTIWAY,
+            'prune_dominated': Normaliser.PRUNE_DOMINATED,
+            'diff_filter'    : Normaliser._DIFF_FILTER,
+        }
+
+    def load(self, paths: Sequence[Path]) -> tuple[list[Group], list[Path]]:
+        '''
+        paths: all input paths (in processing order)
+
+        Returns groups finished by the previous run, and paths that still need processing
+        Falls back onto processing all paths if the checkpoint doesn't match the inputs anymore
+        '''
+        everything: tuple[list[Group], list[Path]] = ([], list(paths))
+        if not self.sfile.exists():
+            return everything
+        lines = self.sfile.read_text().splitlines()
+        if len(lines) == 0 or json.loads(lines[0]) != self.config:
+            logger.warning('checkpoint %s was created with different settings, processing all files', self.sfile)
+            return everything
+
+        pathset = set(paths)
+        groups: list[Group] = []
+        covered: list[Path] = []
+        for line in lines[1:]:
+            try:
+                j = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line might be half written if we were killed
+                break
+            pivots = [Path(p) for p in j['pivots']]
+            # non-pivot items might be gone if they were already pruned
+            items = [Path(p) for p in j['items'] if Path(p) in pathset]
+            fingerprints = {Path(p): Fingerprint(**fp) for p, fp in j['fingerprints'].items()}
+            if not set(pivots) <= set(items):
+                logger.warning("pivots %s from the checkpoint don't exist anymore, processing all files", pivots)
+                return everything
+            for p in items:
+                if Fingerprint.of(p) != fingerprints.get(p):
+                    logger.warning('%s was modified since it was checkpointed, processing all files', p)
+                    return everything
+            groups.append(Group(items=items, pivots=pivots, error=j['error']))
+            # groups might overlap on the boundary pivot
+            covered.extend(p for p in items if p not in covered[-1:])
+
+        if list(paths[: len(covered)]) != covered:
+            logger.warning("checkpoint %s doesn't match the inputs, processing all files", self.sfile)
+            return everything
+
+        resume_from = len(covered)
+        if 0 < resume_from < len(paths):
+            last = groups[-1]
+            if not last.error and len(last.pivots) == 2:
+                # the right pivot might extend into the next group, so need to start from it again
+                resume_from -= 1
+        todo = list(paths[resume_from:]) if resume_from < len(paths) else []
+        logger.info('resuming from checkpoint: %d groups already done, %d files left to process', len(groups), len(todo))
+        return (groups, todo)
+
+    @contextmanager
+    def writer(self, groups: Sequence[Group]) -> Iterator[Callable[[Group], None]]:
+        '''
+        Starts a fresh checkpoint with the groups (normally, the ones returned by load)
+        Returns a function to checkpoint further groups
+        '''
+        def dump(g: Group) -> str:
+            j = {
+                'items' : [str(p) for p in g.items],
+                'pivots': [str(p) for p in g.pivots],
+                'error' : g.error,
+                'fingerprints': {str(p): asdict(Fingerprint.of(p)) for p in g.items},
+            }
+            return json.dumps(j) + '\n'
+
+        self.sfile.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.sfile.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.config) + '\n' + ''.join(map(dump, groups)))
+        tmp.replace(self.sfile)
+
+        with self.sfile.open('a') as fo:
+            def add(g: Group) -> None:
+                fo.write(dump(g))
+                # otherwise might lose everything in the buffer if we're killed
+                fo.flush()
+            yield add
+
+    def remove(self) -> None:
+        if self.sfile.exists():
+            self.sfile.unlink()
+
+
+def test_incremental(tmp_path: Path) -> None:
+    from .common import Keep, Prune
+    from .processor import BaseNormaliser, compute_instructions
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+
+    def write(name: str, *lines: str) -> Path:
+        p = idir / name
+        p.write_text(''.join(l + '\n' for l in lines))
+        return p
+
+    p0 = write('0.txt', 'a')
+    p1 = write('1.txt', 'a', 'b')
+    p2 = write('2.txt', 'a', 'b', 'c')
+
+    paths = [p0, p1, p2]
+    instructions = list(compute_instructions(paths, Normaliser=TestNormaliser, threads=None))
+    assert [type(i) for i in instructions] == [Keep, Prune, Keep]
+
+    sfile = tmp_path / 'state.json'
+    IncrementalState.from_last_group(group=instructions[-1].group, paths=paths).save(sfile)
+
+    # simulate the previous run pruning files
+    p1.unlink()
+
+    p3 = write('3.txt', 'a', 'b', 'c', 'd')
+    p4 = write('4.txt', 'x')
+    paths = [p0, p2, p3, p4]
+
+    state = IncrementalState.load(sfile)
+    assert state is not None
+    to_process = state.paths_to_process(paths)
+    assert to_process == [p0, p2, p3, p4]  # previous group was pivoted on p0 and p2
+
+    instructions = list(compute_instructions(to_process, Normaliser=TestNormaliser, threads=None))
+    assert [type(i) for i in instructions] == [Keep, Prune, Keep, Keep]
+    IncrementalState.from_last_group(group=instructions[-1].group, paths=to_process).save(sfile)
+
+    # nothing new arrived -- only need to look at the last group pivots
+    state = IncrementalState.load(sfile)
+    assert state is not None
+    assert state.paths_to_process(paths) == [p4]
+
+    # if the pivot was modified, we can't trust the state anymore
+    p4.write_text('y\n')
+    assert state.paths_to_process(paths) == paths
+
+
+def test_checkpoint(tmp_path: Path) -> None:
+    from itertools import islice
+
+    from bleanser.tests.common import growing_groups
+
+    from .common import Keep, Prune
+    from .processor import BaseNormaliser, compute_groups, groups_to_instructions
+
+    normalised: list[str] = []
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = False
+        PRUNE_DOMINATED = True
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Path]:
+            normalised.append(path.name)
+            yield path
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    paths = growing_groups(idir, count=10)
+
+    expected = list(compute_groups(paths, Normaliser=TestNormaliser))
+    kinds = [type(i) for i in groups_to_instructions(expected)]
+    assert kinds == [Keep, Prune, Keep] * 3 + [Keep]
+
+    sfile = tmp_path / 'checkpoint.jsonl'
+
+    # simulate interrupted run
+    normalised.clear()
+    it = compute_groups(paths, Normaliser=TestNormaliser, checkpoint=sfile)
+    assert list(islice(it, 2)) == expected[:2]
+    it.close()  # type: ignore[attr-defined]  # it is a generator
+    assert len(normalised) < 10
+
+    normalised.clear()
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser, checkpoint=sfile))
+    assert [type(i) for i in groups_to_instructions(groups)] == kinds
+    assert groups[:2] == expected[:2]
+    # should only process the unfinished part (the first two groups are [0, 1, 2] and [2])
+    assert normalised[0] == '03.txt'
+
+    # everything is done, so nothing to process
+    normalised.clear()
+    assert list(compute_groups(paths, Normaliser=TestNormaliser, checkpoint=sfile)) == groups
+    assert normalised == []
+
+    # pruned files are fine, they just disappear from the groups
+    paths.pop(1).unlink()
+    normalised.clear()
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser, checkpoint=sfile))
+    assert [type(i) for i in groups_to_instructions(groups)] == [Keep, Keep, *kinds[3:]]
+    assert normalised == []
+
+    # but if pivots are modified, checkpoint can't be trusted
+    paths[-1].write_text('whatever\n')
+    normalised.clear()
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser, checkpoint=sfile))
+    assert len(normalised) == len(paths)
+
+    # half written line at the end shouldn't break anything
+    with sfile.open('a') as fo:
+        fo.write('{"items": ["')
+    normalised.clear()
+    assert list(compute_groups(paths, Normaliser=TestNormaliser, checkpoint=sfile)) == groups
+    assert normalised == []
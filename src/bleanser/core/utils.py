@@ -74,12 +74,102 @@ def _magic() -> Callable[[Path], str | None]:
         return lambda path: mm.from_file(str(path))
 
 
+# magic bytes for formats we care about, mimes are the same as libmagic would report
+_SIGNATURES: list[tuple[bytes, str]] = [
+    (b'SQLite format 3\x00', 'application/vnd.sqlite3'),
+    (b'\x1f\x8b'            , 'application/gzip'),
+    (b'\xfd7zXZ\x00'        , 'application/x-xz'),
+    (b'\x28\xb5\x2f\xfd'    , 'application/zstd'),
+    (b'BZh'                 , 'application/x-bzip2'),
+    (b'PK\x03\x04'          , 'application/zip'),
+    (b'PK\x05\x06'          , 'application/zip'),  # empty zip archive
+]
+
+
+def sniff(path: Path) -> str | None:
+    '''
+    Cheap mime detection by looking at the first few bytes of the file
+    Returns None if not sure, in which case it's worth falling back onto libmagic
+    '''
+    with path.open('rb') as fo:
+        head = fo.read(256)
+    for sig, mtype in _SIGNATURES:
+        if head.startswith(sig):
+            return mtype
+
+    # text formats -- need to be a bit more careful here to avoid false positives
+    bom = b'\xef\xbb\xbf'  # utf8
+    text = (head[len(bom):] if head.startswith(bom) else head).lstrip()
+    if text.startswith(b'<?xml'):
+        return 'text/xml'
+    if text[:1] in {b'{', b'['}:
+        rest = text[1:].lstrip()
+        # todo meh, rest might be empty if there is a long whitespace/indentation? but whatever
+        allowed = b'"}' if text[:1] == b'{' else b'"{[]-0123456789tfn'
+        if rest[:1] != b'' and rest[:1] in allowed:
+            return 'application/json'
+    return None
+
+
 def mime(path: Path) -> str | None:
+    # first try sniffing the header, this is way faster than libmagic & avoids loading magic database in each worker
+    res = sniff(path)
+    if res is not None:
+        return res
     # next, libmagic, it might access the file, so a bit slower
     magic = _magic()
     return magic(path)
 
 
+def test_sniff(tmp_path: Path) -> None:
+    import bz2
+    import gzip
+    import lzma
+    import sqlite3
+    import zipfile
+
+    db = tmp_path / 'db.sqlite'
+    with sqlite3.connect(db) as conn:
+        conn.execute('CREATE TABLE t (x)')
+    conn.close()
+    assert sniff(db) == 'application/vnd.sqlite3'
+    assert mime(db) == 'application/vnd.sqlite3'
+
+    data = b'{"a": 1}'
+    compressors: list[tuple[str, Callable[[bytes], bytes], str]] = [
+        ('x.gz' , gzip.compress, 'application/gzip'),
+        ('x.xz' , lzma.compress, 'application/x-xz'),
+        ('x.bz2', bz2.compress , 'application/x-bzip2'),
+    ]
+    for name, compress, expected in compressors:
+        p = tmp_path / name
+        p.write_bytes(compress(data))
+        assert sniff(p) == expected, name
+
+    zp = tmp_path / 'x.zip'
+    with zipfile.ZipFile(zp, 'w') as zf:
+        zf.writestr('x.json', data)
+    assert sniff(zp) == 'application/zip'
+
+    texts: list[tuple[str, str | None]] = [
+        ('{"a": 1}'                                , 'application/json'),
+        ('\ufeff  \n [{"a": 1}]'                    , 'application/json'),
+        ('[]'                                      , 'application/json'),
+        ('[section]\nkey=value'                    , None),  # ini file
+        ('<?xml version="1.0"?><root/>'            , 'text/xml'),
+        ('<!DOCTYPE html><html></html>'            , None),  # let libmagic figure this out
+        ('just some text'                          , None),
+    ]
+    for text, emime in texts:
+        p = tmp_path / 'x.txt'
+        p.write_text(text, encoding='utf8')
+        assert sniff(p) == emime, text
+
+    empty = tmp_path / 'empty'
+    empty.touch()
+    assert sniff(empty) is None
+
+
 from typing import Any
 Json = Any
 
@@ -0,0 +1,174 @@
+"""
+zstd-compressed temporary files (normalised dumps & merged filesets), see BaseNormaliser.COMPRESS_TMP
+
+Normalised dumps are very redundant text, so compress ~5-10x even on fast compression levels.
+Compressed files are never decompressed on disk: tools that do the actual work (sort/cmp/comm/diff) read them through
+named pipes fed by zstd processes.
+"""
+
+from __future__ import annotations
+
+import os
+import signal
+import subprocess
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator, Sequence
+
+# deliberately unusual suffix, so we never confuse it with a user's compressed file (e.g. with 'identity' normaliser)
+SUFFIX = '.bleanser.zst'
+
+# fast levels still give most of the benefit on text dumps
+LEVEL = 3
+
+
+@lru_cache(1)
+def get_zstd_binary():
+    from plumbum import local
+    return local['zstd']
+
+
+def is_compressed(path: Path) -> bool:
+    return path.name.endswith(SUFFIX)
+
+
+def compress(path: Path) -> Path:
+    '''
+    Compresses the file, removing the original. Returns path to the compressed file
+    '''
+    res = path.with_name(path.name + SUFFIX)
+    get_zstd_binary()['-q', '--rm', '-T0', f'-{LEVEL}', str(path), '-o', str(res)]()
+    return res
+
+
+def compress_cmd(*, to: Path):
+    '''
+    Command that compresses its stdin into the file
+    '''
+    return get_zstd_binary()['-q', '-f', '-T0', f'-{LEVEL}', '-o', str(to)]
+
+
+def decompress(path: Path, *, to: Path) -> Path:
+    get_zstd_binary()['-q', '-d', '-f', str(path), '-o', str(to)]()
+    return to
+
+
+@contextmanager
+def readable(path: Path) -> Iterator[Path]:
+    '''
+    Path that tools can read the (uncompressed) contents from
+    If the file is compressed, it's a named pipe, so it can only be read once!
+    '''
+    if not is_compressed(path):
+        yield path
+        return
+    with TemporaryDirectory(prefix='bleanser-zst') as td:
+        fifo = Path(td) / path.name[: -len(SUFFIX)]
+        os.mkfifo(fifo)
+        # -f is necessary, otherwise zstd refuses to write into a fifo
+        cmd = get_zstd_binary()['-q', '-d', '-f', str(path), '-o', str(fifo)]
+        proc = cmd.popen()
+        try:
+            yield fifo
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        rc = _wait_writer(proc, fifo)
+        # SIGPIPE means the reader bailed early (e.g. cmp at the first difference), which is fine
+        # otherwise it must have succeeded, e.g. if the file is truncated, the reader might see partial output as valid
+        if rc not in {0, -signal.SIGPIPE}:
+            raise subprocess.CalledProcessError(rc, str(cmd))
+
+
+def _wait_writer(proc, fifo: Path) -> int:
+    while True:
+        try:
+            return proc.wait(timeout=0.1)
+        except subprocess.TimeoutExpired:
+            pass
+        # the reader might not have opened the pipe at all (e.g. if it failed on the other file), so zstd is stuck in open()
+        # opening & closing the read end releases it, and then it gets SIGPIPE on write
+        # NOTE: not killing it here, otherwise we could miss an error from zstd that finished but isn't reaped yet
+        fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        os.close(fd)
+
+
+@contextmanager
+def readables(paths: Sequence[Path]) -> Iterator[list[Path]]:
+    with ExitStack() as stack:
+        yield [stack.enter_context(readable(p)) for p in paths]
+
+
+def issame(lfile: Path, rfile: Path) -> bool:
+    with readables([lfile, rfile]) as (l, r):
+        rc = subprocess.run(['cmp', '--silent', str(l), str(r)], check=False).returncode
+    # 0: same, 1: different, 2: trouble
+    if rc not in {0, 1}:
+        raise subprocess.CalledProcessError(rc, 'cmp')
+    return rc == 0
+
+
+def is_subset(lfile: Path, rfile: Path, *, env: dict[str, str]) -> bool:
+    '''
+    Same as native.is_subset, but works with compressed files
+    env: needs to have the same collation as the one used for sorting the files
+    '''
+    with readables([lfile, rfile]) as (l, r):
+        # comm -23 only emits lines that are unique to the left file, so need to check it's empty
+        with subprocess.Popen(['comm', '-23', str(l), str(r)], stdout=subprocess.PIPE, env={**os.environ, **env}) as proc:
+            assert proc.stdout is not None
+            missing = proc.stdout.read(1)
+            if len(missing) > 0:
+                # no need to wait for the rest if something is missing
+                proc.kill()
+                return False
+            rc = proc.wait()
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, 'comm')
+    return True
+
+
+def test_compressed(tmp_path: Path) -> None:
+    import pytest
+
+    def write(name: str, lines: list[str]) -> Path:
+        p = tmp_path / name
+        p.write_text(''.join(l + '\n' for l in lines))
+        return compress(p)
+
+    env = {'LC_ALL': 'C'}
+    abc = write('abc', ['a', 'b', 'c'])
+    ac  = write('ac' , ['a', 'c'])
+    assert is_compressed(abc)
+    assert not (tmp_path / 'abc').exists()
+    assert not is_compressed(tmp_path / 'whatever.zst')
+
+    assert issame(abc, abc)
+    assert not issame(abc, ac)
+    assert is_subset(ac, abc, env=env)
+    assert not is_subset(abc, ac, env=env)
+
+    # mixing compressed & uncompressed should work too
+    plain = tmp_path / 'plain'
+    plain.write_text('a\nb\nc\n')
+    assert issame(abc, plain)
+    assert is_subset(ac, plain, env=env)
+
+    big = write('big', [f'line {i:06d}' for i in range(100000)])
+    # shouldn't hang when bailing early
+    assert not is_subset(big, ac, env=env)
+    assert not issame(big, ac)
+    with readable(big):
+        pass  # never opened, shouldn't hang either
+    assert decompress(big, to=tmp_path / 'big_plain').read_text().startswith('line 000000\n')
+
+    # truncated/corrupt files shouldn't look like they are empty (which would be 'dominated' by anything)
+    truncated = tmp_path / ('truncated' + SUFFIX)
+    truncated.write_bytes(big.read_bytes()[:20])
+    with pytest.raises(subprocess.CalledProcessError):
+        is_subset(truncated, ac, env=env)
+    with pytest.raises(subprocess.CalledProcessError):
+        issame(truncated, truncated)
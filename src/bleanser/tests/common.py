@@ -67,3 +67,15 @@ def hack_attribute(Normaliser, key, value):
         yield
     finally:
         setattr(Normaliser, key, prev)
+
+
+def growing_groups(d: Path, *, count: int) -> list[Path]:
+    '''
+    Writes text files in groups of 3 growing files, so with PRUNE_DOMINATED the middle file of each group can be pruned
+    '''
+    paths = []
+    for i in range(count):
+        p = d / f'{i:02}.txt'
+        p.write_text(''.join(f'{i // 3} {x}\n' for x in range(i % 3 + 1)))
+        paths.append(p)
+    return paths